@@ -0,0 +1,229 @@
+# action_journal.py
+
+import asyncio
+import discord
+import logging
+import random
+import time
+from config import JOURNAL_CONCURRENCY, JOURNAL_MAX_ATTEMPTS
+from db import add_actions, get_due_actions, complete_actions, retry_action, fail_action
+from metrics import JOURNAL_ACTIONS
+
+
+def role_action(guild_id, user_id, role_id, add):
+    """A journal entry that gives or takes a role; it replaces any pending change to the same role.
+
+    Its idempotency key, 'role:<guild_id>:<user_id>:<role_id>', is filled in by the database,
+    which keeps sweeps that journal tens of thousands of promotions cheap on the event loop.
+    """
+    return (None, guild_id, user_id, 'add_role' if add else 'remove_role', role_id, None)
+
+
+def dm_action(guild_id, user_id, content, key):
+    """A journal entry that DMs a member; `key` names what the DM is about, so it is only journaled once."""
+    return (f'dm:{guild_id}:{user_id}:{key}', guild_id, user_id, 'dm', None, content)
+
+
+def shard_filter(bot):
+    """The shard count and shard IDs a bot process runs, or (None, None) if it runs every shard."""
+    shard_count = getattr(bot, 'shard_count', None)
+    shard_ids = getattr(bot, 'shard_ids', None)
+    return (shard_count, shard_ids) if shard_count and shard_ids else (None, None)
+
+
+class DeliveryFailed(Exception):
+    """Raised for a DM the outbound queue gave up on, e.g. DMs closed and no general channel.
+
+    The queue has already retried whatever could be retried, so sending it again won't help.
+    """
+
+
+class ActionJournal:
+    """Applies the role changes and DMs recorded in the action_journal table.
+
+    Callers journal actions in the same transaction as the change they follow from,
+    then call wake(). A dispatcher reads due actions oldest first and runs up to
+    `concurrency` of them at once. Rate-limit (429) and server (5xx) errors, and
+    guilds that aren't available yet, are retried with jittered exponential backoff
+    up to max_attempts; an action that has nothing left to do (member gone, role
+    deleted) is dropped, and one that can't succeed (missing permissions, a DM
+    that can't be delivered) is given up on at once. Actions still in the journal
+    when the bot stops are picked up again on the next start.
+
+    Finished actions are deleted from the journal in batches. One that finished
+    just before a crash may run again; role changes are skipped if already made.
+    """
+
+    def __init__(self, bot, messaging, concurrency=JOURNAL_CONCURRENCY, max_attempts=JOURNAL_MAX_ATTEMPTS,
+                 backoff_base=2.0, batch_size=100, poll_interval=5.0):
+        self.bot = bot
+        self.messaging = messaging
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval  # Seconds between checks for retries coming due
+        self.in_flight = set()  # IDs of the actions being applied or finished but not yet deleted
+        self.running = set()  # Tasks applying actions
+        self.completed = []  # (id, revision) of finished actions waiting to be deleted
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        """Starts the dispatcher; it waits for the bot to be ready before applying anything."""
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=5.0):
+        """Stops taking new actions and waits up to `timeout` seconds for the running ones to finish."""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.running:
+            done, pending = await asyncio.wait(self.running, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logging.warning(f"Stopped {len(pending)} journaled actions mid-flight; they will run on the next start.")
+        await self._flush_completed()
+
+    def wake(self):
+        """Tells the dispatcher new actions have been journaled."""
+        self.wakeup.set()
+
+    async def record(self, actions):
+        """Journals actions on their own and wakes the dispatcher."""
+        if actions:
+            await add_actions(actions)
+            self.wake()
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            self.wakeup.clear()
+            try:
+                await self._flush_completed()
+                rows = await get_due_actions(time.time(), self.batch_size, *shard_filter(self.bot))
+            except Exception:
+                # E.g. the database is locked by another shard process; try again on the next poll
+                logging.exception("Failed to read the action journal; retrying.")
+                rows = []
+            for row in rows:
+                if row[0] in self.in_flight:
+                    continue
+                await slots.acquire()
+                self.in_flight.add(row[0])
+                task = asyncio.create_task(self._run_action(row))
+                self.running.add(task)
+                task.add_done_callback(lambda task, action_id=row[0]: self._finished(slots, task, action_id))
+            if len(rows) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _finished(self, slots, task, action_id):
+        self.running.discard(task)
+        slots.release()
+        if task.cancelled() or task.exception() or not task.result():
+            # Not finished, so not waiting to be deleted either
+            self.in_flight.discard(action_id)
+        # Delete finished actions once a batch has built up, or once nothing else is running
+        if len(self.completed) >= self.batch_size or self.completed and not self.running:
+            self.wake()
+
+    async def _flush_completed(self):
+        """Deletes the actions that have finished since the last flush."""
+        if not self.completed:
+            return
+        completed, self.completed = self.completed, []
+        try:
+            await complete_actions(completed)
+        except Exception:
+            self.completed = completed + self.completed  # Deleted on the next flush instead
+            raise
+        self.in_flight.difference_update(action_id for action_id, revision in completed)
+
+    async def _run_action(self, row):
+        """Applies a journaled action and records the outcome; returns whether it finished."""
+        action_id, revision, guild_id, user_id, action, role_id, content, attempts = row
+        try:
+            done = await self._apply(guild_id, user_id, action, role_id, content)
+            error = None if done else "guild not available"
+        except (discord.HTTPException, DeliveryFailed) as e:
+            if isinstance(e, DeliveryFailed) or e.status != 429 and e.status < 500:
+                # Forbidden, NotFound, an undeliverable DM and the like won't succeed on a retry
+                logging.warning(f"Dropping {action} for {user_id} in {guild_id}: {e}")
+                await fail_action(action_id, revision, time.time())
+                JOURNAL_ACTIONS.inc(outcome='failed')
+                await self._notify_failure(guild_id, user_id, action, role_id, e)
+                return False
+            error = str(e)
+        except Exception as e:
+            logging.exception(f"Unexpected error applying {action} for {user_id} in {guild_id}.")
+            error = repr(e)
+
+        if error is None:
+            self.completed.append((action_id, revision))
+            JOURNAL_ACTIONS.inc(outcome='completed')
+            return True
+        if attempts + 1 >= self.max_attempts:
+            logging.warning(f"Giving up on {action} for {user_id} in {guild_id} after {attempts + 1} attempts: {error}")
+            await fail_action(action_id, revision, time.time())
+            JOURNAL_ACTIONS.inc(outcome='failed')
+            await self._notify_failure(guild_id, user_id, action, role_id, error)
+        else:
+            backoff = self.backoff_base * 2 ** attempts * random.uniform(0.5, 1.5)
+            logging.info(f"{action} for {user_id} in {guild_id} failed ({error}); retry {attempts + 1} in {backoff:.1f}s.")
+            await retry_action(action_id, revision, time.time() + backoff)
+            JOURNAL_ACTIONS.inc(outcome='retried')
+        return False
+
+    async def _notify_failure(self, guild_id, user_id, action, role_id, error):
+        """Tells the guild owner right away about a role change that was given up on, e.g. for missing permissions."""
+        guild = self.bot.get_guild(guild_id)
+        if action == 'dm' or guild is None:
+            return
+        role = guild.get_role(role_id)
+        role_name = role.name if role else f"role {role_id}"
+        if action == 'add_role':
+            change = f"give {role_name} to <@{user_id}>"
+        else:
+            change = f"take {role_name} from <@{user_id}>"
+        await self.messaging.notify_admin(guild, f"Could not {change}: {error}. Check the bot's permissions "
+                                                 f"and that its role is above {role_name}.", urgent=True)
+
+    async def _apply(self, guild_id, user_id, action, role_id, content):
+        """Applies one action, skipping it if the member already has what it asks for.
+
+        Returns False if it should be tried again later.
+        """
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return False
+        member = guild.get_member(user_id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(user_id)
+            except discord.NotFound:
+                logging.info(f"Dropping {action} for {user_id} in {guild_id}: no longer a member.")
+                return True
+
+        if action == 'dm':
+            if not await self.messaging.deliver_private_message(member, content):
+                raise DeliveryFailed("the DM could not be delivered")
+            return True
+
+        role = guild.get_role(role_id)
+        if role is None:
+            logging.info(f"Dropping {action} for {user_id} in {guild_id}: role {role_id} no longer exists.")
+            return True
+        has_role = member.get_role(role_id) is not None
+        if action == 'add_role' and not has_role:
+            await member.add_roles(role)
+            logging.info(f"Gave {role.name} to {member.name} ({member.id}) in {guild.name}.")
+        elif action == 'remove_role' and has_role:
+            await member.remove_roles(role)
+            logging.info(f"Took {role.name} from {member.name} ({member.id}) in {guild.name}.")
+        return True
@@ -0,0 +1,302 @@
+# benchmarks/fake_discord.py
+
+import asyncio
+import itertools
+import random
+from collections import Counter
+from datetime import timedelta
+
+import discord
+
+# Local stand-ins for the discord.py objects the cogs touch. They expose the same
+# attributes and coroutines the bot uses, and every call that would hit the Discord
+# API goes through FakeHTTP instead, which counts it and can add simulated latency.
+
+_ids = itertools.count(10 ** 17)
+
+
+def next_id():
+    return next(_ids)
+
+
+class FakeHTTP:
+    """Mock HTTP layer: counts API calls by route and waits `latency` seconds per call."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+
+    async def request(self, route):
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+
+class FakeRole:
+    def __init__(self, guild, name, role_id=None):
+        self.guild = guild
+        self.id = role_id or next_id()
+        self.name = name
+        self.mention = f'<@&{self.id}>'
+
+    @property
+    def members(self):
+        return [member for member in self.guild.members if self.id in member._roles]
+
+    def __repr__(self):
+        return f'<FakeRole {self.name}>'
+
+
+class FakeMessage:
+    def __init__(self, http, content=None, attachments=()):
+        self.http = http
+        self.content = content
+        self.attachments = list(attachments)
+
+    async def edit(self, **kwargs):
+        await self.http.request('edit_message')
+
+
+class FakeAttachment:
+    """An uploaded file, e.g. the list of user IDs for a bulk tag command."""
+
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+
+class FakeChannel:
+    def __init__(self, guild, http, name='general'):
+        self.guild = guild
+        self.http = http
+        self.id = next_id()
+        self.name = name
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await self.http.request('channel_message')
+        self.sent += 1
+        return FakeMessage(self.http, content)
+
+
+class FakeMember:
+    def __init__(self, guild, http, name, status=discord.Status.offline, joined_at=None, dm_open=True, member_id=None):
+        self.guild = guild
+        self.http = http
+        self.id = member_id or next_id()
+        self.name = name
+        self.display_name = name
+        self.mention = f'<@{self.id}>'
+        self.status = status
+        self.joined_at = joined_at or discord.utils.utcnow()
+        self.dm_open = dm_open
+        self._roles = set()
+
+    @property
+    def roles(self):
+        return [self.guild.default_role] + [role for role in self.guild.roles if role.id in self._roles]
+
+    def get_role(self, role_id):
+        return self.guild.get_role(role_id) if role_id in self._roles else None
+
+    async def add_roles(self, *roles, reason=None):
+        for role in roles:
+            await self.http.request('add_role')
+            self._roles.add(role.id)
+
+    async def remove_roles(self, *roles, reason=None):
+        for role in roles:
+            await self.http.request('remove_role')
+            self._roles.discard(role.id)
+
+    async def send(self, content=None, **kwargs):
+        await self.http.request('dm')
+        if not self.dm_open:
+            raise discord.Forbidden(_FakeResponse(403), 'Cannot send messages to this user')
+        return FakeMessage(self.http, content)
+
+    def copy_with_status(self, status):
+        """A snapshot of this member with another status, as passed to on_presence_update."""
+        snapshot = object.__new__(FakeMember)
+        snapshot.__dict__.update(self.__dict__)
+        snapshot.status = status
+        return snapshot
+
+    def __str__(self):
+        return self.name
+
+
+class _FakeResponse:
+    """Just enough of an aiohttp response for discord.HTTPException."""
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'Fake'
+
+
+class FakeGuild:
+    """A guild whose full member list lives "on Discord's side" in `_remote`.
+
+    `_members` is the bot's member cache. Members added with cache=False only reach
+    it through connect(), chunk(), query_members() or fetch_member(), the way they
+    would with chunk_guilds_at_startup turned off.
+    """
+
+    def __init__(self, http, name='Benchmark Guild', guild_id=None):
+        self.http = http
+        self.id = guild_id or next_id()
+        self.name = name
+        self.default_role = FakeRole(self, '@everyone', role_id=self.id)
+        self.roles = [self.default_role]
+        self._members = {}
+        self._remote = {}  # user_id -> (name, status, joined_at, dm_open) for every member
+        self.system_channel = FakeChannel(self, http)
+        self.owner_id = None
+
+    @property
+    def owner(self):
+        """The owner's cached member, or None if the owner isn't cached, as in discord.py."""
+        return self._members.get(self.owner_id)
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    @property
+    def member_count(self):
+        return len(self._remote)
+
+    @property
+    def chunked(self):
+        return len(self._members) >= len(self._remote)
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+    def _cache_member(self, user_id):
+        """The cached member with this ID, building it from the remote member list if needed."""
+        member = self._members.get(user_id)
+        if member is None:
+            name, status, joined_at, dm_open = self._remote[user_id]
+            member = FakeMember(self, self.http, name, status, joined_at, dm_open, member_id=user_id)
+            self._members[user_id] = member
+        return member
+
+    def connect(self):
+        """Caches the members a GUILD_CREATE carries for a large guild: the ones online."""
+        for user_id, (name, status, joined_at, dm_open) in self._remote.items():
+            if status != discord.Status.offline:
+                self._cache_member(user_id)
+
+    async def chunk(self):
+        """Caches the whole member list, one gateway chunk of 1000 members at a time."""
+        missing = [user_id for user_id in self._remote if user_id not in self._members]
+        for i in range(0, len(missing), 1000):
+            await self.http.request('request_guild_members')
+            for user_id in missing[i:i + 1000]:
+                self._cache_member(user_id)
+        return self.members
+
+    async def query_members(self, query=None, *, limit=5, user_ids=None, cache=True, **kwargs):
+        await self.http.request('request_guild_members')
+        return [self._cache_member(user_id) for user_id in user_ids[:limit] if user_id in self._remote]
+
+    async def fetch_member(self, user_id):
+        await self.http.request('fetch_member')
+        if user_id not in self._remote:
+            raise discord.NotFound(_FakeResponse(404), 'Unknown Member')
+        return self._cache_member(user_id)
+
+    def get_role(self, role_id):
+        for role in self.roles:
+            if role.id == role_id:
+                return role
+        return None
+
+    def add_role(self, name):
+        role = FakeRole(self, name)
+        self.roles.append(role)
+        return role
+
+    async def create_role(self, name, **kwargs):
+        await self.http.request('create_role')
+        return self.add_role(name)
+
+    def add_members(self, count, online_fraction=0.3, max_age_days=120, seed=0, cache=True):
+        """Adds `count` members with random statuses and join dates; the guild's first member owns it.
+
+        With cache=False they only join the remote member list, and nothing is returned.
+        """
+        rng = random.Random(seed)
+        now = discord.utils.utcnow()
+        statuses = (discord.Status.online, discord.Status.idle, discord.Status.dnd)
+        added = []
+        for i in range(count):
+            status = rng.choice(statuses) if rng.random() < online_fraction else discord.Status.offline
+            joined_at = now - timedelta(days=rng.uniform(0, max_age_days))
+            user_id = next_id()
+            self._remote[user_id] = (f'member{len(self._remote)}', status, joined_at, rng.random() > 0.1)
+            if self.owner_id is None:
+                self.owner_id = user_id
+            if cache:
+                added.append(self._cache_member(user_id))
+        return added
+
+
+class FakeContext:
+    """Command context for invoking a cog command directly."""
+
+    def __init__(self, guild, author, attachments=()):
+        self.guild = guild
+        self.author = author
+        self.http = guild.http
+        self.message = FakeMessage(guild.http, attachments=attachments)
+        self.replies = []
+
+    async def send(self, content=None, **kwargs):
+        await self.http.request('channel_message')
+        self.replies.append(content)
+        return FakeMessage(self.http, content)
+
+
+class FakeBot:
+    """The parts of commands.Bot the cogs and helpers use."""
+
+    def __init__(self, http):
+        self.http = http
+        self.guilds = []
+        self.user = None
+        self._ready = asyncio.Event()
+
+    def add_guild(self, guild):
+        self.guilds.append(guild)
+        return guild
+
+    def get_guild(self, guild_id):
+        for guild in self.guilds:
+            if guild.id == guild_id:
+                return guild
+        return None
+
+    def get_channel(self, channel_id):
+        for guild in self.guilds:
+            if guild.system_channel.id == channel_id:
+                return guild.system_channel
+        return None
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def set_ready(self):
+        self._ready.set()
+
+    async def wait_until_ready(self):
+        await self._ready.wait()
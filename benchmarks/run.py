@@ -0,0 +1,730 @@
+# benchmarks/run.py
+"""Load-simulation benchmarks that drive the real cogs against a fake gateway.
+
+Run from the repository root:
+
+    python -m benchmarks.run                      # every workload, compared to baseline.json
+    python -m benchmarks.run presence_storm --scale 0.1
+    python -m benchmarks.run --save-baseline      # record the current numbers as the baseline
+
+Exits with status 1 if any metric is worse than the baseline by more than --tolerance.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from functools import partial
+
+# config.py refuses to load without a token; the benchmarks never connect to Discord
+os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+
+import discord
+from config import LOG_SAMPLE_RATES, LOG_RATE_LIMITS, PROMOTION_TIERS
+from log_pipeline import configure_logging
+
+import db
+from cogs.event_handlers import EventHandlers
+from cogs.tag_management import TagManagement, DEFAULT_TAG_ROLE
+from cogs.user_status import UserStatus, ROLLUP_RETENTION, hour_buckets
+from cogs.vip_management import VIPManagement
+from action_journal import ActionJournal
+from messaging import Messaging
+from session_store import SessionStore
+from snapshot import SnapshotWriter, load_snapshot
+from vip_manager import VIPManager
+from benchmarks.fake_discord import FakeAttachment, FakeBot, FakeContext, FakeGuild, FakeHTTP
+
+WORKDIR = tempfile.mkdtemp(prefix='gurak-benchmark-')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Metrics where a higher value is better; every other metric is better when lower
+HIGHER_IS_BETTER = {'throughput'}
+# Metrics too noisy or too small to compare against the baseline
+NOT_COMPARED = {'events', 'loop_lag_max_ms', 'http_calls'}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a task that sleeps `interval` seconds."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    def reset(self):
+        self.lags = []
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval))
+
+
+class DBCounter:
+    """Counts db.py calls by function and SQL statements executed by the database thread."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.statements = 0
+        self._original_call = db._call
+
+    def install(self):
+        def counted_call(func, *args, **kwargs):
+            self.calls[func.__name__] += 1
+            return self._original_call(func, *args, **kwargs)
+        db._call = counted_call
+
+    async def trace_connection(self):
+        """Hooks the statement counter into the current database connection."""
+        def trace(conn):
+            conn.set_trace_callback(self._count_statement)
+        await asyncio.get_running_loop().run_in_executor(db._executor, lambda: trace(db._get_connection()))
+
+    def _count_statement(self, statement):
+        self.statements += 1
+
+    def uninstall(self):
+        db._call = self._original_call
+
+    def reset(self):
+        self.calls.clear()
+        self.statements = 0
+
+
+class Harness:
+    """A fresh database, fake bot and the real cogs, wired up the way main.py does it."""
+
+    def __init__(self, name, http_latency=0.0):
+        self.name = name
+        self.http = FakeHTTP(http_latency)
+        self.bot = FakeBot(self.http)
+        self.messaging = Messaging(self.bot)
+        self.journal = ActionJournal(self.bot, self.messaging)
+        self.vip_manager = VIPManager(self.bot, self.journal)
+        self.lag = LoopLagMonitor()
+        self.db_counter = DBCounter()
+        self.cogs = {}
+
+    async def __aenter__(self):
+        await db.close_db()
+        db.DATABASE = os.path.join(WORKDIR, f'{self.name}.db')
+        await db.init_db()
+        self.db_counter.install()
+        await self.db_counter.trace_connection()
+        self.messaging.start()
+        self.journal.start()
+        self.lag.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        user_status = self.cogs.get('UserStatus')
+        if user_status:
+            await user_status.cog_unload()
+        event_handlers = self.cogs.get('EventHandlers')
+        if event_handlers:
+            await event_handlers.cog_unload()
+        self.vip_manager.stop_expiry_scheduler()
+        await self.journal.stop(timeout=1.0)
+        await self.messaging.stop(timeout=1.0)
+        self.lag.stop()
+        self.db_counter.uninstall()
+        await db.close_db()
+
+    async def load_cogs(self):
+        """Creates the cogs and runs their cog_load, as add_cog would."""
+        for cog in (VIPManagement(self.bot, self.vip_manager, self.messaging),
+                    EventHandlers(self.bot, self.vip_manager),
+                    TagManagement(self.bot),
+                    UserStatus(self.bot, self.journal)):
+            await cog.cog_load()
+            self.cogs[type(cog).__name__] = cog
+        # The periodic sweeps are run explicitly by the workloads that measure them
+        self.cogs['UserStatus'].check_role_promotion.cancel()
+        self.cogs['EventHandlers'].compact_departed_members.cancel()
+        self.cogs['EventHandlers'].compact_admin_notifications.cancel()
+        self.cogs['UserStatus'].roll_up_presence_buckets.cancel()
+
+    def reset_counters(self):
+        self.lag.reset()
+        self.db_counter.reset()
+        self.http.calls.clear()
+
+    def result(self, events, seconds, latencies=(), **extra):
+        """Summarizes the counters since the last reset_counters for `events` events."""
+        result = {
+            'events': events,
+            'seconds': round(seconds, 4),
+            'throughput': round(events / seconds, 1) if seconds else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'loop_lag_p99_ms': round(percentile(self.lag.lags, 99) * 1000, 3),
+            'loop_lag_max_ms': round(max(self.lag.lags, default=0.0) * 1000, 3),
+            'db_calls_per_event': round(sum(self.db_counter.calls.values()) / max(events, 1), 4),
+            'sql_per_event': round(self.db_counter.statements / max(events, 1), 4),
+            'http_calls': self.http.total,
+        }
+        result.update(extra)
+        return result
+
+
+def timed(func, latencies):
+    """Wraps a coroutine function to record how long each call takes."""
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+async def drain(messaging):
+    """Seconds until every queued and digested notice has been sent, rate limits included."""
+    start = time.perf_counter()
+    while messaging.pending_fallbacks or messaging.queue_depth:
+        await messaging.join()
+        await asyncio.sleep(0.1)
+    await messaging.join()
+    return round(time.perf_counter() - start, 4)
+
+
+async def drain_journal(journal):
+    """Seconds until every journaled role change and DM has been applied or given up on."""
+    start = time.perf_counter()
+    journal.wake()
+    while (await db.count_actions())[0]:
+        await asyncio.sleep(0.05)
+    return round(time.perf_counter() - start, 4)
+
+
+def command(cog, name):
+    """A cog's command as a plain coroutine function, skipping argument conversion and checks."""
+    return partial(next(cmd for cmd in cog.get_commands() if cmd.name == name).callback, cog)
+
+
+def build_guild(bot, members, online_fraction=0.3, seed=0):
+    """A guild with the roles the bot expects and `members` random members."""
+    guild = bot.add_guild(FakeGuild(bot.http))
+    guild.add_role(DEFAULT_TAG_ROLE)
+    for role_name, min_days, min_hours, window in PROMOTION_TIERS:
+        guild.add_role(role_name)
+    guild.add_members(members, online_fraction, seed=seed)
+    return guild
+
+
+async def add_subscriptions(guild, members, expires_at, vip_role=None):
+    """Stores VIP subscriptions for `members`, optionally giving them the VIP role already."""
+    for member in members:
+        await db.add_subscription(guild.id, member.id, expires_at)
+        if vip_role:
+            member._roles.add(vip_role.id)
+
+
+# -------------------------------
+# Workloads
+# -------------------------------
+
+async def ready_50k(scale, http_latency):
+    """Startup against a large guild: cog loading, expiry scheduling and presence resync in on_ready."""
+    async with Harness('ready_50k', http_latency) as harness:
+        members = int(50000 * scale)
+        guild = build_guild(harness.bot, members)
+        vip_role = guild.add_role(harness.vip_manager.vip_role_name)
+        rng = random.Random(1)
+        sample = rng.sample(guild.members, members // 20)
+        now = time.time()
+        # Half active, half lapsed; a fifth of each lacks or wrongly holds the role
+        await add_subscriptions(guild, sample[:len(sample) // 2], now + 86400)
+        await add_subscriptions(guild, sample[len(sample) // 2:], now - 86400, vip_role)
+        harness.reset_counters()
+
+        latencies = []
+        start = time.perf_counter()
+        await timed(harness.load_cogs, latencies)()
+        await timed(harness.vip_manager.start_expiry_scheduler, latencies)()
+        harness.bot.set_ready()
+        for name in ('UserStatus', 'EventHandlers', 'TagManagement'):
+            await timed(harness.cogs[name].on_ready, latencies)()
+        seconds = time.perf_counter() - start
+        drain_seconds = await drain_journal(harness.journal) + await drain(harness.messaging)
+        return harness.result(members, seconds, latencies, drain_seconds=round(drain_seconds, 4))
+
+
+async def presence_storm(scale, http_latency, rate=1000, duration=10.0):
+    """Presence updates replayed at `rate` events per second, dispatched as tasks like the gateway does."""
+    async with Harness('presence_storm', http_latency) as harness:
+        guild = build_guild(harness.bot, int(20000 * scale))
+        await harness.load_cogs()
+        harness.bot.set_ready()
+        user_status = harness.cogs['UserStatus']
+        await user_status.on_ready()
+
+        rng = random.Random(2)
+        members = guild.members
+        statuses = (discord.Status.online, discord.Status.idle, discord.Status.dnd, discord.Status.offline)
+        count = int(rate * duration * scale)
+        harness.reset_counters()
+
+        latencies = []
+
+        async def dispatch(member, status, scheduled):
+            before = member.copy_with_status(member.status)
+            member.status = status
+            await user_status.on_presence_update(before, member)
+            latencies.append(time.perf_counter() - scheduled)
+
+        tasks = []
+        start = time.perf_counter()
+        for i in range(count):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            member = rng.choice(members)
+            status = rng.choice([status for status in statuses if status != member.status])
+            tasks.append(asyncio.create_task(dispatch(member, status, scheduled)))
+        await asyncio.gather(*tasks)
+        await user_status.flush_presence_buffer()
+        seconds = time.perf_counter() - start
+        return harness.result(count, seconds, latencies, target_rate=rate)
+
+
+async def vip_expiry(scale, http_latency):
+    """Thousands of subscriptions expiring at once through the expiry scheduler."""
+    async with Harness('vip_expiry', http_latency) as harness:
+        guild = build_guild(harness.bot, int(20000 * scale))
+        vip_role = guild.add_role(harness.vip_manager.vip_role_name)
+        expiring = guild.members[:int(5000 * scale)]
+        await add_subscriptions(guild, expiring, time.time() - 1, vip_role)
+        await harness.load_cogs()
+
+        latencies = []  # Per expiry batch
+        expired = []
+        expire_batch = harness.vip_manager._expire_batch
+
+        async def counted_expire_batch(keys, deadlines):
+            await expire_batch(keys, deadlines)
+            expired.extend(keys)
+        harness.vip_manager._expire_batch = timed(counted_expire_batch, latencies)
+        harness.reset_counters()
+        start = time.perf_counter()
+        await harness.vip_manager.start_expiry_scheduler()
+        harness.bot.set_ready()
+        while len(expired) < len(expiring):
+            await asyncio.sleep(0.01)
+        seconds = time.perf_counter() - start
+        drain_seconds = await drain_journal(harness.journal) + await drain(harness.messaging)
+        return harness.result(len(expiring), seconds, latencies, drain_seconds=round(drain_seconds, 4))
+
+
+async def bulk_tags(scale, http_latency, rounds=5, single_commands=1000):
+    """Bulk tag commands over a file of user IDs, plus a stream of single assign_tag commands."""
+    async with Harness('bulk_tags', http_latency) as harness:
+        guild = build_guild(harness.bot, int(20000 * scale))
+        await harness.load_cogs()
+        harness.bot.set_ready()
+        tag_management = harness.cogs['TagManagement']
+        author = guild.members[0]
+        author._roles.add(discord.utils.get(guild.roles, name=DEFAULT_TAG_ROLE).id)
+        id_file = FakeAttachment(' '.join(str(member.id) for member in guild.members).encode())
+        harness.reset_counters()
+
+        latencies = []
+        events = 0
+        start = time.perf_counter()
+        for i in range(rounds):
+            ctx = FakeContext(guild, author, attachments=[id_file])
+            await timed(command(tag_management, 'bulk_assign_tag'), latencies)(ctx, f'bulk{i}')
+            await timed(command(tag_management, 'bulk_remove_tag'), latencies)(ctx, f'bulk{i}')
+            events += 2 * guild.member_count
+        rng = random.Random(3)
+        for i in range(int(single_commands * scale)):
+            ctx = FakeContext(guild, author)
+            await timed(command(tag_management, 'assign_tag'), latencies)(ctx, rng.choice(guild.members), f'tag{i % 50}')
+            events += 1
+        seconds = time.perf_counter() - start
+        return harness.result(events, seconds, latencies)
+
+
+async def promotion_sweep(scale, http_latency):
+    """The daily role promotion sweep over a large guild with stored presence totals."""
+    async with Harness('promotion_sweep', http_latency) as harness:
+        guild = build_guild(harness.bot, int(50000 * scale))
+        rng = random.Random(4)
+        await db.store_user_presence_batch({(guild.id, member.id): rng.uniform(0, 400 * 3600)
+                                            for member in guild.members})
+        await harness.load_cogs()
+        harness.bot.set_ready()
+        user_status = harness.cogs['UserStatus']
+        harness.reset_counters()
+
+        start = time.perf_counter()
+        await user_status.check_role_promotion()
+        seconds = time.perf_counter() - start
+        pending, failed = await db.count_actions()
+        return harness.result(guild.member_count, seconds, [seconds], promotions_queued=pending)
+
+
+async def startup_modes(scale, http_latency):
+    """Startup and a promotion sweep with MEMBER_CHUNKING=startup and =lazy, side by side.
+
+    Each mode connects to a large guild (caching its online members), chunks it in
+    startup mode, loads the cogs and runs on_ready, with tracemalloc measuring what
+    that allocates; tracemalloc slows both modes alike, so ready times compare but
+    run longer than they would without it. Presence totals follow a long tail, so
+    few members are candidates for promotion.
+    """
+    members = int(50000 * scale)
+    metrics = {}
+    for mode in ('startup', 'lazy'):
+        async with Harness(f'startup_{mode}', http_latency) as harness:
+            guild = build_guild(harness.bot, 0)
+            guild.add_members(members, cache=False)
+            rng = random.Random(5)
+            await db.store_user_presence_batch({(guild.id, user_id): rng.expovariate(1 / (20 * 3600))
+                                                for user_id in guild._remote})
+            harness.reset_counters()
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            guild.connect()
+            if mode == 'startup':
+                await guild.chunk()
+            await harness.load_cogs()
+            await harness.vip_manager.start_expiry_scheduler()
+            harness.bot.set_ready()
+            for name in ('UserStatus', 'EventHandlers', 'TagManagement'):
+                await harness.cogs[name].on_ready()
+            ready_seconds = time.perf_counter() - start
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            startup_requests = harness.http.calls['request_guild_members']
+            # Let the catch-up on_ready started in the background finish, so it isn't timed with the sweep
+            await harness.cogs['EventHandlers'].catch_up_task
+
+            harness.http.calls.clear()
+            start = time.perf_counter()
+            await harness.cogs['UserStatus'].check_role_promotion()
+            metrics.update({
+                f'{mode}_ready_seconds': round(ready_seconds, 4),
+                f'{mode}_memory_mb': round(memory / 2 ** 20, 2),
+                f'{mode}_cached_members': len(guild._members),
+                f'{mode}_member_requests': startup_requests,
+                f'{mode}_sweep_seconds': round(time.perf_counter() - start, 4),
+                f'{mode}_sweep_member_requests': harness.http.calls['request_guild_members'],
+            })
+    return {'events': members, **metrics}
+
+
+async def presence_rollups(scale, http_latency, days=35, queries=1000):
+    """Presence rollups after `days` days of sessions: the hourly rollup job, and 7- and 30-day window queries.
+
+    A day's sessions are flushed as hourly buckets and rolled up at the end of each
+    simulated day, so the rollups hold hourly, daily and weekly buckets by the end.
+    """
+    async with Harness('presence_rollups', http_latency) as harness:
+        guild = build_guild(harness.bot, int(5000 * scale))
+        await harness.load_cogs()
+        harness.bot.set_ready()
+        user_status = harness.cogs['UserStatus']
+        rng = random.Random(7)
+        members = guild.members
+        now = time.time()
+        start_of_history = now - days * db.DAY
+        rollup_latencies = []
+        for day in range(days):
+            day_end = start_of_history + (day + 1) * db.DAY
+            hourly = {}
+            for member in members:
+                if rng.random() < 0.6:
+                    end = day_end - rng.uniform(0, db.DAY)
+                    for hour, seconds in hour_buckets(end - rng.expovariate(1 / 7200), end):
+                        hourly[(guild.id, member.id, hour)] = hourly.get((guild.id, member.id, hour), 0) + seconds
+            await db.save_presence_checkpoint({}, {}, [], day_end, hourly)
+            await timed(db.roll_up_presence, rollup_latencies)(day_end, ROLLUP_RETENTION)
+        harness.reset_counters()
+
+        latencies = []
+        start = time.perf_counter()
+        for i in range(queries):
+            member = rng.choice(members)
+            await timed(user_status.get_recent_presence, latencies)(member, 7 if i % 2 else 30)
+        seconds = time.perf_counter() - start
+        guild_start = time.perf_counter()
+        since = now - 30 * db.DAY
+        await db.get_guild_presence_since(guild.id, db.DAY, since)
+        guild_query_ms = (time.perf_counter() - guild_start) * 1000
+        return harness.result(queries, seconds, latencies, guild_30d_query_ms=round(guild_query_ms, 3),
+                              rollup_job_ms=round(max(rollup_latencies) * 1000, 3))
+
+
+async def leaderboard(scale, http_latency, updates=20000, commands=500):
+    """The in-memory leaderboard over 50,000 members: loading it, adding closed sessions and !leaderboard."""
+    async with Harness('leaderboard', http_latency) as harness:
+        guild = build_guild(harness.bot, int(50000 * scale))
+        rng = random.Random(8)
+        await db.store_user_presence_batch({(guild.id, member.id): rng.uniform(0, 400 * 3600)
+                                            for member in guild.members})
+        await harness.load_cogs()
+        harness.bot.set_ready()
+        user_status = harness.cogs['UserStatus']
+        totals = await db.get_all_presence_totals()
+        start = time.perf_counter()
+        user_status.rankings.load(totals)
+        load_ms = (time.perf_counter() - start) * 1000
+
+        members = guild.members
+        start = time.perf_counter()
+        for i in range(int(updates * scale)):
+            user_status.rankings.add(guild.id, rng.choice(members).id, rng.uniform(60, 7200))
+        update_us = (time.perf_counter() - start) / int(updates * scale) * 10 ** 6
+        await asyncio.sleep(harness.lag.interval * 2)  # Lets the lag monitor record the updates above first
+        harness.reset_counters()
+
+        latencies = []
+        start = time.perf_counter()
+        for i in range(commands):
+            ctx = FakeContext(guild, rng.choice(members))
+            await timed(command(user_status, 'leaderboard'), latencies)(ctx, 25)
+        seconds = time.perf_counter() - start
+        return harness.result(commands, seconds, latencies, load_ms=round(load_ms, 3), update_us=round(update_us, 3))
+
+
+async def session_store(scale, http_latency, guilds=10):
+    """Open presence sessions held in SessionStore versus the dict of datetimes it replaced.
+
+    Compares memory for 100,000 open sessions, the cost of a close and reopen (one
+    offline and one online event), and ending every session at once.
+    """
+    count = int(100000 * scale)
+    rng = random.Random(6)
+    pairs = [(rng.choice(range(guilds)) + 10 ** 17, 10 ** 17 + i) for i in range(count)]
+    churn = [pairs[rng.randrange(count)] for i in range(count)]
+    metrics = {}
+
+    # Before: (guild_id, user_id) -> timezone-aware datetime
+    tracemalloc.start()
+    sessions = {}
+    for guild_id, user_id in pairs:
+        sessions[(guild_id, user_id)] = discord.utils.utcnow()
+    metrics['dict_memory_mb'] = round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 2)
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for guild_id, user_id in churn:
+        key = (guild_id, user_id)
+        (discord.utils.utcnow() - sessions.pop(key)).total_seconds()
+        sessions[key] = discord.utils.utcnow()
+    metrics['dict_event_us'] = round((time.perf_counter() - start) / (2 * count) * 10 ** 6, 3)
+    start = time.perf_counter()
+    now = discord.utils.utcnow()
+    {key: (now - started).total_seconds() for key, started in sessions.items()}
+    sessions.clear()
+    metrics['dict_close_all_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    del sessions
+
+    tracemalloc.start()
+    store = SessionStore()
+    for guild_id, user_id in pairs:
+        store.open((guild_id, user_id))
+    metrics['store_memory_mb'] = round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 2)
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for guild_id, user_id in churn:
+        key = (guild_id, user_id)
+        store.close(key)
+        store.open(key)
+    metrics['store_event_us'] = round((time.perf_counter() - start) / (2 * count) * 10 ** 6, 3)
+    start = time.perf_counter()
+    store.close_all()
+    metrics['store_close_all_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return {'events': count, **metrics}
+
+
+async def warm_restart(scale, http_latency):
+    """Restoring the caches at startup: loading them from the database versus from a snapshot.
+
+    The data is 10,000 VIP subscriptions, 3 tags on each of 30,000 members, presence
+    totals for 50,000 members and 15,000 open sessions.
+    """
+    async with Harness('warm_restart', http_latency) as harness:
+        guild = build_guild(harness.bot, int(50000 * scale))
+        members = guild.members
+        rng = random.Random(9)
+        now = time.time()
+        for member in members[:int(10000 * scale)]:
+            await db.add_subscription(guild.id, member.id, now + rng.uniform(3600, 90 * 24 * 3600))
+        for i, tag in enumerate(('raid', 'pvp', 'trader')):
+            await db.add_tag_to_users(guild.id, [member.id for member in members[i::2][:int(30000 * scale)]], tag)
+        await db.store_user_presence_batch({(guild.id, member.id): rng.uniform(0, 400 * 3600) for member in members})
+        await db.save_presence_checkpoint({}, {(guild.id, member.id): now - rng.uniform(0, 8 * 3600)
+                                               for member in members[:int(15000 * scale)]}, [], now)
+
+        async def load(snapshot):
+            """The three caches as setup_hook builds them, from `snapshot` or the database."""
+            vip_manager = VIPManager(harness.bot, harness.journal)
+            await vip_manager.start_expiry_scheduler(snapshot.get('subscriptions'))
+            vip_manager.stop_expiry_scheduler()
+            tag_management = TagManagement(harness.bot, snapshot.get('tags'))
+            user_status = UserStatus(harness.bot, harness.journal, snapshot.get('presence'))
+            for loop in (user_status.check_role_promotion, user_status.flush_presence,
+                         user_status.roll_up_presence_buckets):
+                loop.cancel()
+            await tag_management.cog_load()
+            await user_status.cog_load()
+            return vip_manager, tag_management, user_status
+
+        start = time.perf_counter()
+        cold = await load({})
+        cold_ms = (time.perf_counter() - start) * 1000
+
+        path = os.path.join(WORKDIR, 'warm_restart.snapshot')
+        writer = SnapshotWriter(path, {'subscriptions': cold[0].snapshot_state, 'tags': cold[1].snapshot_state,
+                                       'presence': cold[2].snapshot_state}, prepare=cold[2].flush_presence_buffer)
+        start = time.perf_counter()
+        written = await writer.write()
+        write_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        warm = await load(await load_snapshot(path))
+        warm_ms = (time.perf_counter() - start) * 1000
+        assert set(written) == {'subscriptions', 'tags', 'presence'}
+        assert warm[0]._expiry_deadlines == cold[0]._expiry_deadlines
+        assert warm[1].tag_index.user_tags == cold[1].tag_index.user_tags
+        assert warm[2].restored_sessions == cold[2].restored_sessions
+        assert warm[2].rankings.top(guild.id, 100) == cold[2].rankings.top(guild.id, 100)
+
+        # A tag written after the snapshot makes only that section stale
+        await db.add_tag_to_user(guild.id, members[-1].id, 'late')
+        stale = await load_snapshot(path)
+        assert set(stale) == {'subscriptions', 'presence'}
+        return {'events': len(written), 'cold_load_ms': round(cold_ms, 3), 'warm_load_ms': round(warm_ms, 3),
+                'snapshot_write_ms': round(write_ms, 3), 'snapshot_kib': round(os.path.getsize(path) / 1024, 1)}
+
+
+WORKLOADS = {
+    'ready_50k': ready_50k,
+    'presence_storm': presence_storm,
+    'vip_expiry': vip_expiry,
+    'bulk_tags': bulk_tags,
+    'promotion_sweep': promotion_sweep,
+    'startup_modes': startup_modes,
+    'session_store': session_store,
+    'presence_rollups': presence_rollups,
+    'leaderboard': leaderboard,
+    'warm_restart': warm_restart,
+}
+
+
+# -------------------------------
+# Reporting
+# -------------------------------
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Lists (workload, metric, baseline, current) for every metric worse than baseline by more than tolerance.
+
+    Millisecond metrics must also be worse by at least min_delta_ms, since small timings are mostly noise.
+    """
+    regressions = []
+    for name, result in results.items():
+        for metric, value in result.items():
+            base = baseline.get(name, {}).get(metric)
+            if metric in NOT_COMPARED or not isinstance(base, (int, float)) or not base:
+                continue
+            change = (base - value) / base if metric in HIGHER_IS_BETTER else (value - base) / base
+            if metric.endswith('_ms') and value - base < min_delta_ms:
+                continue
+            if change > tolerance:
+                regressions.append((name, metric, base, value))
+    return regressions
+
+
+def print_results(results, baseline):
+    for name, result in results.items():
+        print(f'\n{name}')
+        for metric, value in result.items():
+            base = baseline.get(name, {}).get(metric)
+            versus = f'  (baseline {base})' if base is not None else ''
+            print(f'  {metric:<30} {value}{versus}')
+
+
+async def run(names, scale, http_latency):
+    results = {}
+    for name in names:
+        print(f'Running {name}...', file=sys.stderr)
+        results[name] = await WORKLOADS[name](scale, http_latency)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('workloads', nargs='*', metavar='workload',
+                        help=f'Workloads to run (default: all): {", ".join(WORKLOADS)}.')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier for workload sizes.')
+    parser.add_argument('--http-latency', type=float, default=0.0, help='Simulated seconds per Discord API call.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative regression before a metric fails (default 0.25).')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0,
+                        help='Smallest change in a millisecond metric that counts as a regression (default 5).')
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline.')
+    args = parser.parse_args()
+
+    names = args.workloads or list(WORKLOADS)
+    unknown = [name for name in names if name not in WORKLOADS]
+    if unknown:
+        parser.error(f'unknown workloads: {", ".join(unknown)}')
+    # Log through the bot's own pipeline, into the scratch directory instead of the repository
+    listener = configure_logging({}, 'benchmark.log', WORKDIR, sample_rates=LOG_SAMPLE_RATES,
+                                 rate_limits=LOG_RATE_LIMITS)
+    try:
+        results = asyncio.run(run(names, args.scale, args.http_latency))
+    finally:
+        listener.stop()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if baseline and baseline.get('scale') != args.scale:
+        print(f'Baseline was recorded at scale {baseline.get("scale")}; not comparing.', file=sys.stderr)
+        baseline = {}
+    print_results(results, baseline.get('workloads', {}))
+
+    if args.save_baseline:
+        saved = {'scale': args.scale, 'workloads': {**baseline.get('workloads', {}), **results}}
+        with open(args.baseline, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        print(f'\nBaseline written to {args.baseline}.')
+        return
+
+    regressions = compare(results, baseline.get('workloads', {}), args.tolerance, args.min_delta_ms)
+    for name, metric, base, value in regressions:
+        print(f'REGRESSION {name}.{metric}: {base} -> {value}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 # cogs/error_handler.py
 
 import discord
+import logging
 from discord.ext import commands
 
+logger = logging.getLogger(__name__)
+
 class ErrorHandler(commands.Cog):
     """Cog for handling command errors globally."""
 
@@ -18,9 +21,10 @@ class ErrorHandler(commands.Cog):
             await ctx.send('Command not found. Please check the available commands and try again.')
         elif isinstance(error, commands.MissingPermissions):
             await ctx.send('You do not have the required permissions to execute this command.')
+        elif isinstance(error, commands.NoPrivateMessage):
+            await ctx.send('This command can only be used in a server.')
         elif isinstance(error, commands.MemberNotFound):
             await ctx.send('Member not found. Please ensure the member is in the server and try again.')
         else:
             await ctx.send('An unexpected error occurred. Please contact the administrator.')
-            # Optionally log the error details for debugging
-            print(f'Unhandled error: {error}')
+            logger.error("Unhandled error in %s: %s", ctx.command, error, exc_info=error)
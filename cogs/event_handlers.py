@@ -1,24 +1,170 @@
 # cogs/event_handlers.py
 
+import asyncio
 import discord
-from discord.ext import commands
+import logging
+import time
+from discord.ext import commands, tasks
+from action_journal import shard_filter
+from config import DEPARTED_RETENTION_DAYS, ADMIN_NOTIFICATION_RETENTION_DAYS
+from db import (mark_member_departed, clear_member_departed, purge_departed_members, get_member_records,
+                update_departed_members, get_job_runs, set_job_run, purge_admin_notifications)
+from member_cache import ensure_chunked
+
+logger = logging.getLogger(__name__)
+
+# Seconds between catch-ups of a guild whose member list isn't cached (MEMBER_CHUNKING=lazy),
+# since those download the whole list first
+CATCH_UP_INTERVAL = 24 * 3600
 
 class EventHandlers(commands.Cog):
-    """Cog for handling bot events."""
+    """Cog for handling bot events.
+
+    Member events keep the stored state in step one member at a time: joins and
+    hand-made VIP role changes are checked against the member's subscription, and
+    departures are recorded so the member's data can be compacted away once they
+    have been gone for DEPARTED_RETENTION_DAYS. Other cogs drop their in-memory
+    copies of purged members' data in an on_members_purged listener.
+
+    Joins and departures while the bot was offline are caught up by comparing each
+    guild's stored data with its member list. Guilds whose member list is cached are
+    caught up in the background after every ready event; the others are caught up by
+    the hourly compaction, at most once every CATCH_UP_INTERVAL.
+    """
 
     def __init__(self, bot, vip_manager):
         self.bot = bot
         self.vip_manager = vip_manager
+        self.caught_up = set()  # Guilds caught up since the last ready event
+        self.catch_up_lock = asyncio.Lock()  # Keeps the ready event and the hourly job from catching up at once
+        self.catch_up_task = None  # Catch-up started by the last ready event
+        self.compact_departed_members.start()
+        self.compact_admin_notifications.start()
+
+    async def cog_unload(self):
+        self.compact_departed_members.cancel()
+        self.compact_admin_notifications.cancel()
+        if self.catch_up_task:
+            self.catch_up_task.cancel()
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
         """Handles the event when a new member joins and assigns roles if needed."""
+        await clear_member_departed(member.guild.id, member.id)
         await self.vip_manager.manage_vip_role(member)
 
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload):
+        """Records that a member left; raw, so members missing from the member cache count too."""
+        await mark_member_departed(payload.guild_id, payload.user.id, time.time())
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        """Checks a change to a member's VIP role against their subscription."""
+        vip_role = discord.utils.get(after.guild.roles, name=self.vip_manager.vip_role_name)
+        if vip_role and (vip_role in before.roles) != (vip_role in after.roles):
+            await self.vip_manager.sync_vip_role(after)
+
     @commands.Cog.listener()
     async def on_ready(self):
-        """Handles the event when the bot is ready and initializes roles."""
-        print('Bot is online and ready!')
-        for guild in self.bot.guilds:
-            for member in guild.members:
+        """Handles the event when the bot is ready."""
+        logger.info("Bot is online and ready")
+        # A new session may have missed member events, so every guild is caught up again
+        self.catch_up_task = asyncio.create_task(self.catch_up_after_ready())
+
+    async def catch_up_after_ready(self):
+        """Catches up the guilds whose member list is cached; the others wait for compact_departed_members."""
+        try:
+            async with self.catch_up_lock:
+                self.caught_up.clear()
+                await self.catch_up_guilds(cached_only=True)
+        except Exception:
+            logger.exception("Member catch-up after the ready event failed", extra={'event': 'member_catch_up'})
+
+    async def catch_up_members(self, guild, now):
+        """Applies the joins and departures in a guild that happened while the bot wasn't listening.
+
+        Members with stored data who are no longer in the guild are recorded as departed
+        at `now`. Members recorded as departed who are back, and subscribers without the
+        VIP role, get their VIP role set from their subscription. Needs the guild's
+        full member list. Returns (departed, returned) member counts.
+        """
+        stored, departed, subscriptions = await get_member_records(guild.id)
+        present = {member.id for member in guild.members}
+        left = stored - present - departed.keys()
+        returned = departed.keys() & present
+        await update_departed_members(guild.id, left, returned, now)
+
+        vip_role = discord.utils.get(guild.roles, name=self.vip_manager.vip_role_name)
+        for user_id in returned | {user_id for user_id, expires_at in subscriptions.items() if expires_at > now}:
+            member = guild.get_member(user_id)
+            if member and (user_id in returned or vip_role not in member.roles):
                 await self.vip_manager.manage_vip_role(member)
+        return len(left), len(returned)
+
+    async def catch_up_guilds(self, cached_only=False):
+        """Runs catch_up_members in every guild not caught up since the last ready event.
+
+        Guilds whose member list isn't cached are skipped with cached_only, or until
+        CATCH_UP_INTERVAL has passed since their last catch-up, then downloaded in full first.
+        """
+        now = time.time()
+        last_runs = await get_job_runs('member_catch_up')
+        caught_up = []
+        for guild in self.bot.guilds:
+            if guild.id in self.caught_up:
+                continue
+            if not guild.chunked:
+                if cached_only or now - last_runs.get(guild.id, 0) < CATCH_UP_INTERVAL:
+                    continue
+                await ensure_chunked(guild)
+            departed, returned = await self.catch_up_members(guild, now)
+            self.caught_up.add(guild.id)
+            caught_up.append(guild.id)
+            if departed or returned:
+                logger.info("Caught up on %d departures and %d returns in %s (%d)", departed, returned,
+                            guild.name, guild.id, extra={'event': 'member_catch_up', 'guild_id': guild.id,
+                                                         'departed': departed, 'returned': returned})
+        if caught_up:
+            await set_job_run('member_catch_up', caught_up, now)
+
+    @tasks.loop(hours=1)
+    async def compact_departed_members(self):
+        """Purges the data of members who left more than DEPARTED_RETENTION_DAYS ago, in guilds on this process's shards.
+
+        Guilds missed by the catch-up at the last ready event (see catch_up_guilds) are caught up first.
+        """
+        async with self.catch_up_lock:
+            await self.catch_up_guilds()
+
+        now = time.time()
+        left_before = now - DEPARTED_RETENTION_DAYS * 24 * 3600
+        purged = 0
+        while True:
+            keys = await purge_departed_members(left_before, now, *shard_filter(self.bot))
+            if not keys:
+                break
+            purged += len(keys)
+            self.bot.dispatch('members_purged', keys)
+        if purged:
+            logger.info("Purged the data of %d departed members", purged,
+                        extra={'event': 'departed_purge', 'purged': purged})
+
+    @compact_departed_members.before_loop
+    async def before_compact_departed_members(self):
+        """Waits until the bot is ready, so shard IDs are known."""
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(hours=1)
+    async def compact_admin_notifications(self):
+        """Deletes admin notifications older than ADMIN_NOTIFICATION_RETENTION_DAYS, in guilds on this process's shards."""
+        purged = await purge_admin_notifications(time.time() - ADMIN_NOTIFICATION_RETENTION_DAYS * 24 * 3600,
+                                                 *shard_filter(self.bot))
+        if purged:
+            logger.info("Purged %d old admin notifications", purged,
+                        extra={'event': 'admin_notification_purge', 'purged': purged})
+
+    @compact_admin_notifications.before_loop
+    async def before_compact_admin_notifications(self):
+        """Waits until the bot is ready, so shard IDs are known."""
+        await self.bot.wait_until_ready()
@@ -0,0 +1,136 @@
+# cogs/stats.py
+
+import discord
+from discord.ext import commands, tasks
+import time
+from datetime import timedelta
+from config import MEMBER_CHUNKING
+from db import count_actions
+from metrics import (REGISTRY, COMMAND_LATENCY, COMMAND_ERRORS, DB_CALL_LATENCY, GATEWAY_EVENTS, LOOP_LAG,
+                     LOOP_LAG_LAST, OUTBOUND_QUEUE_DEPTH, OUTBOUND_SENT, OUTBOUND_FAILED, OUTBOUND_LATENCY,
+                     JOURNAL_ACTIONS, PRESENCE_FLUSH_SIZE, PRESENCE_FLUSH_LATENCY, START_TIME, CACHED_MEMBERS,
+                     PEAK_RSS, peak_rss)
+
+
+def top_series(histogram, limit=5, key=lambda series: sum(series[:-1])):
+    """The label values of a histogram's busiest series, by observation count unless `key` says otherwise."""
+    ranked = sorted(histogram.series.items(), key=lambda item: key(item[1]), reverse=True)
+    return [labels[0] for labels, series in ranked[:limit]]
+
+
+class Stats(commands.Cog):
+    """Cog that records command and gateway metrics and reports them with !stats."""
+
+    def __init__(self, bot, messaging):
+        self.bot = bot
+        self.messaging = messaging
+        self.event_rates = {}  # Gateway event type -> events per second over the last minute
+        self.last_event_counts = {}
+        self.last_event_time = time.monotonic()
+        self.update_event_rates.start()
+
+    async def cog_load(self):
+        REGISTRY.collectors.append(self.collect)
+
+    async def cog_unload(self):
+        self.update_event_rates.cancel()
+        if self.collect in REGISTRY.collectors:
+            REGISTRY.collectors.remove(self.collect)
+
+    def collect(self):
+        """Copies values read on demand into their gauges before a scrape."""
+        OUTBOUND_QUEUE_DEPTH.set(self.messaging.queue_depth)
+        CACHED_MEMBERS.set(sum(len(guild.members) for guild in self.bot.guilds))
+        rss = peak_rss()
+        if rss is not None:
+            PEAK_RSS.set(rss)
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        """Notes when a command started, for its latency."""
+        ctx.command_started_at = time.perf_counter()
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        """Records how long a command took."""
+        started_at = getattr(ctx, 'command_started_at', None)
+        if started_at is not None:
+            COMMAND_LATENCY.observe(time.perf_counter() - started_at, command=ctx.command.qualified_name)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        """Counts failed commands."""
+        COMMAND_ERRORS.inc(command=ctx.command.qualified_name if ctx.command else 'unknown')
+
+    @commands.Cog.listener()
+    async def on_socket_event_type(self, event_type):
+        """Counts gateway events by type."""
+        GATEWAY_EVENTS.inc(event=event_type)
+
+    @tasks.loop(seconds=60)
+    async def update_event_rates(self):
+        """Works out each gateway event type's rate over the last minute."""
+        now = time.monotonic()
+        elapsed = now - self.last_event_time
+        counts = {labels[0]: value for labels, value in GATEWAY_EVENTS.values.items()}
+        if elapsed > 0:
+            self.event_rates = {event: (count - self.last_event_counts.get(event, 0)) / elapsed
+                                for event, count in counts.items()}
+        self.last_event_counts = counts
+        self.last_event_time = now
+
+    @commands.command(name='stats', help="Show bot performance statistics (administrators only).")
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx):
+        """Shows startup, command latency, event loop lag, queue depths, presence flushes, gateway event rates
+        and database timings."""
+        REGISTRY.collect()
+        uptime = timedelta(seconds=int(time.time() - START_TIME.get()))
+        embed = discord.Embed(title="Bot Statistics", color=discord.Color.blue())
+        embed.set_footer(text=f"Up for {uptime} - full metrics at /metrics on the metrics port")
+
+        ready_seconds = getattr(self.bot, 'ready_seconds', None)
+        embed.add_field(name="Startup",
+                        value=(f"ready in {ready_seconds:.1f} s" if ready_seconds is not None else "not ready yet")
+                              + f" ({MEMBER_CHUNKING} chunking), {CACHED_MEMBERS.get()} members cached, "
+                              f"peak RSS {PEAK_RSS.get() / 2 ** 20:.0f} MiB", inline=False)
+
+        lines = [f"`{name}`: {COMMAND_LATENCY.count(command=name)} runs, "
+                 f"p50 {COMMAND_LATENCY.quantile(0.5, command=name) * 1000:.0f} ms, "
+                 f"p99 {COMMAND_LATENCY.quantile(0.99, command=name) * 1000:.0f} ms"
+                 for name in top_series(COMMAND_LATENCY)]
+        errors = sum(COMMAND_ERRORS.values.values())
+        lines.append(f"{errors} failed")
+        embed.add_field(name="Commands", value='\n'.join(lines), inline=False)
+
+        embed.add_field(name="Event Loop Lag",
+                        value=f"last {LOOP_LAG_LAST.get() * 1000:.1f} ms, "
+                              f"p99 {LOOP_LAG.quantile(0.99) * 1000:.1f} ms", inline=False)
+        embed.add_field(name="Outbound Queue",
+                        value=f"{OUTBOUND_QUEUE_DEPTH.get()} waiting, {OUTBOUND_SENT.get()} sent, "
+                              f"{OUTBOUND_FAILED.get()} failed, p99 delivery {OUTBOUND_LATENCY.quantile(0.99):.2f} s",
+                        inline=False)
+        pending, failed = await count_actions()
+        embed.add_field(name="Action Journal",
+                        value=f"{pending} pending, {JOURNAL_ACTIONS.get(outcome='completed')} applied, "
+                              f"{JOURNAL_ACTIONS.get(outcome='retried')} retried, {failed} given up on",
+                        inline=False)
+
+        flushes = PRESENCE_FLUSH_LATENCY.count()
+        embed.add_field(name="Presence Flushes",
+                        value=f"{flushes} flushes, {PRESENCE_FLUSH_SIZE.total() / max(flushes, 1):.0f} users on average, "
+                              f"p99 {PRESENCE_FLUSH_SIZE.quantile(0.99):.0f} users, "
+                              f"p99 {PRESENCE_FLUSH_LATENCY.quantile(0.99) * 1000:.0f} ms",
+                        inline=False)
+
+        rates = sorted(self.event_rates.items(), key=lambda item: item[1], reverse=True)[:5]
+        embed.add_field(name="Gateway Events (last minute)",
+                        value='\n'.join(f"`{event}`: {rate:.1f}/s" for event, rate in rates) or "No data yet.",
+                        inline=False)
+
+        lines = [f"`{name}`: {DB_CALL_LATENCY.count(function=name)} calls, "
+                 f"{DB_CALL_LATENCY.total(function=name):.2f} s total, "
+                 f"p99 {DB_CALL_LATENCY.quantile(0.99, function=name) * 1000:.1f} ms"
+                 for name in top_series(DB_CALL_LATENCY, key=lambda series: series[-1])]
+        embed.add_field(name="Database (most time)", value='\n'.join(lines) or "No calls yet.", inline=False)
+        await ctx.send(embed=embed)
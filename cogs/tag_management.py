@@ -3,17 +3,157 @@
 import discord
 from discord.ext import commands
 import logging
-from db import add_tag_to_user, remove_tag_from_user, get_user_tags, get_all_tags, get_tag_roles, set_tag_roles
+from array import array
+from typing import Union
+from db import (get_all_tag_role_ids, set_tag_role_ids, remove_tag_role_ids, get_all_tag_role_rules,
+                remove_tag_role_rule, NOBODY_ROLE_ID)
+from member_cache import resolve_members, ensure_chunked
+from snapshot import string_arrays, strings_from_arrays
+from tag_index import TagIndex
 
-# Set up logging for permission checks
-logging.basicConfig(filename='tag_permissions.log', level=logging.INFO, 
-                    format='%(asctime)s:%(levelname)s:%(message)s')
+# Role allowed to manage tags that have no rule of their own
+DEFAULT_TAG_ROLE = "Survivor"
+
+# Written to its own log file; see LOG_FILES in main.py
+logger = logging.getLogger(__name__)
 
 class TagManagement(commands.Cog, name="Tag Management"):
     """Cog to manage tag assignment, removal, and listing."""
 
-    def __init__(self, bot):
+    def __init__(self, bot, snapshot=None):
         self.bot = bot
+        self.tag_index = TagIndex()
+        self.tag_role_ids = {}  # (guild_id, tag) -> frozenset of role IDs allowed to manage it
+        self.default_role_ids = {}  # guild_id -> frozenset holding the DEFAULT_TAG_ROLE ID
+        self.snapshot = snapshot  # Arrays from snapshot_state to load from instead of the database
+
+    async def cog_load(self):
+        """Loads the tag index and tag-role rules from the startup snapshot, or else from the database."""
+        if self.snapshot:
+            self.load_snapshot(self.snapshot)
+            self.snapshot = None
+            return
+        await self.tag_index.load()
+        self.tag_role_ids = await get_all_tag_role_ids()
+
+    def snapshot_state(self):
+        """The tag index and tag-role rules as arrays for a snapshot.
+
+        Tags are stored once and referred to by number; assignments are stored as the
+        holders of each tag in each guild, one run of user IDs per (guild, tag).
+        """
+        tag_numbers = {}
+        group_guild_ids, group_tags, group_sizes, user_ids = array('q'), array('I'), array('I'), array('q')
+        for guild_id, holders_by_tag in self.tag_index.tag_users.items():
+            for tag, holders in holders_by_tag.items():
+                group_guild_ids.append(guild_id)
+                group_tags.append(tag_numbers.setdefault(tag, len(tag_numbers)))
+                group_sizes.append(len(holders))
+                user_ids.extend(holders)
+        rule_guild_ids, rule_tags, rule_role_ids = array('q'), array('I'), array('q')
+        for (guild_id, tag), role_ids in self.tag_role_ids.items():
+            for role_id in role_ids or (NOBODY_ROLE_ID,):
+                rule_guild_ids.append(guild_id)
+                rule_tags.append(tag_numbers.setdefault(tag, len(tag_numbers)))
+                rule_role_ids.append(role_id)
+        return [*string_arrays(tag_numbers), group_guild_ids, group_tags, group_sizes, user_ids,
+                rule_guild_ids, rule_tags, rule_role_ids]
+
+    def load_snapshot(self, snapshot):
+        """Restores the tag index and tag-role rules from the arrays written by snapshot_state."""
+        (tag_lengths, tag_data, group_guild_ids, group_tags, group_sizes, user_ids,
+         rule_guild_ids, rule_tags, rule_role_ids) = snapshot
+        tag_names = strings_from_arrays(tag_lengths, tag_data)
+        tag_users = {}
+        offset = 0
+        for guild_id, tag, size in zip(group_guild_ids, group_tags, group_sizes):
+            tag_users.setdefault(guild_id, {})[tag_names[tag]] = set(user_ids[offset:offset + size])
+            offset += size
+        self.tag_index.load_holders(tag_users)
+        rules = {}
+        for guild_id, tag, role_id in zip(rule_guild_ids, rule_tags, rule_role_ids):
+            role_ids = rules.setdefault((guild_id, tag_names[tag]), set())
+            if role_id != NOBODY_ROLE_ID:
+                role_ids.add(role_id)
+        self.tag_role_ids = {key: frozenset(role_ids) for key, role_ids in rules.items()}
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """Converts legacy name-based tag rules to role IDs now that guild roles are known.
+
+        Legacy rules predate multi-guild support, so they belong to the bot's original guild.
+        A rule none of whose roles exist is kept and retried on the next ready; meanwhile
+        the tag is locked with a rule that lets no role manage it, as it was before.
+        """
+        guild = self.bot.get_guild(getattr(self.bot, 'legacy_guild_id', None) or 0)
+        if not guild:
+            return
+        for tag, role_names in (await get_all_tag_role_rules()).items():
+            existing = self.tag_role_ids.get((guild.id, tag))
+            if existing:
+                # Set with !set_tag_rule since the legacy rule was locked; that rule wins
+                await remove_tag_role_rule(tag)
+                continue
+            role_ids = set()
+            for role_name in role_names:
+                role = discord.utils.get(guild.roles, name=role_name)
+                if role:
+                    role_ids.add(role.id)
+            if not role_ids:
+                if existing is None:
+                    await set_tag_role_ids(guild.id, tag, role_ids)
+                    self.set_cached_rule(guild.id, tag, role_ids)
+                logger.warning(f"None of the roles {role_names} for tag '{tag}' exist; nobody can manage it "
+                               f"until they are created or !set_tag_rule is used.")
+                continue
+            await set_tag_role_ids(guild.id, tag, role_ids)
+            self.set_cached_rule(guild.id, tag, role_ids)
+            await remove_tag_role_rule(tag)
+            logger.info(f"Converted rule for tag '{tag}' from role names {role_names} to role IDs {sorted(role_ids)}")
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        """Drops the cached default role when a role is renamed."""
+        if before.name != after.name:
+            self.default_role_ids.pop(after.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        """Drops the cached default role when a role is created."""
+        self.default_role_ids.pop(role.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        """Drops the cached default role when a role is deleted."""
+        self.default_role_ids.pop(role.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_members_purged(self, keys):
+        """Drops departed members' tags from the index once their rows have been purged."""
+        self.tag_index.forget_users(keys)
+
+    def set_cached_rule(self, guild_id, tag, role_ids):
+        """Caches a tag's allowed role IDs; an empty set means no role may manage the tag, and None
+        that it has no rule and falls back to DEFAULT_TAG_ROLE."""
+        if role_ids is None:
+            self.tag_role_ids.pop((guild_id, tag), None)
+        else:
+            self.tag_role_ids[(guild_id, tag)] = frozenset(role_ids)
+
+    def get_default_role_ids(self, guild):
+        """Get the cached ID set of the guild's DEFAULT_TAG_ROLE."""
+        role_ids = self.default_role_ids.get(guild.id)
+        if role_ids is None:
+            role = discord.utils.get(guild.roles, name=DEFAULT_TAG_ROLE)
+            role_ids = frozenset((role.id,)) if role else frozenset()
+            self.default_role_ids[guild.id] = role_ids
+        return role_ids
+
+    async def cog_check(self, ctx):
+        """All commands in this cog work on guild-scoped data, so they only run in a guild."""
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage()
+        return True
 
     def validate_tag(self, tag):
         """Validate the tag based on length, characters, and uniqueness."""
@@ -24,18 +164,19 @@ class TagManagement(commands.Cog, name="Tag Management"):
         return True, None
 
     def check_user_roles(self, member, tag):
-        """Check if the user has the required role to assign or modify the tag."""
-        required_roles = get_tag_roles(tag)
-        member_roles = [role.name for role in member.roles]
-        for role in required_roles:
-            if role in member_roles:
-                return True
-        return False
+        """Check if the user has the required role to assign or modify the tag.
+
+        Tags without a rule fall back to DEFAULT_TAG_ROLE; a rule with no roles denies everyone.
+        """
+        allowed_role_ids = self.tag_role_ids.get((member.guild.id, tag))
+        if allowed_role_ids is None:
+            allowed_role_ids = self.get_default_role_ids(member.guild)
+        return not allowed_role_ids.isdisjoint(member._roles)
 
     @commands.command(name='assign_tag', help="Assign a tag to a user. Example: !assign_tag @user tagname")
     async def assign_tag(self, ctx, member: discord.Member, tag: str):
         """Assign a tag to a user, ensuring it's valid and authorized."""
-        logging.info(f"User {ctx.author} ({ctx.author.id}) attempted to assign tag {tag} to {member.name} ({member.id})")
+        logger.info(f"User {ctx.author} ({ctx.author.id}) attempted to assign tag {tag} to {member.name} ({member.id})")
 
         # Validate the tag
         valid, message = self.validate_tag(tag)
@@ -46,48 +187,131 @@ class TagManagement(commands.Cog, name="Tag Management"):
         # Check if the author is allowed to assign this tag
         if not self.check_user_roles(ctx.author, tag):
             await ctx.send(f"Sorry {ctx.author.mention}, you don't have permission to assign the tag '{tag}'.")
-            logging.warning(f"Unauthorized tag assignment attempt by {ctx.author.name} ({ctx.author.id}) for tag '{tag}'")
+            logger.warning(f"Unauthorized tag assignment attempt by {ctx.author.name} ({ctx.author.id}) for tag '{tag}'")
             return
 
         # Add tag to user
-        if add_tag_to_user(member.id, tag):
+        if await self.tag_index.add_tag(ctx.guild.id, member.id, tag):
             await ctx.send(f"Successfully assigned tag '{tag}' to {member.mention}.")
-            logging.info(f"Tag '{tag}' assigned to {member.name} ({member.id}) by {ctx.author.name} ({ctx.author.id})")
+            logger.info(f"Tag '{tag}' assigned to {member.name} ({member.id}) by {ctx.author.name} ({ctx.author.id})")
         else:
             await ctx.send(f"Failed to assign tag '{tag}' to {member.mention}. Tag may already be assigned.")
-            logging.warning(f"Failed to assign tag '{tag}' by {ctx.author.name} ({ctx.author.id})")
+            logger.warning(f"Failed to assign tag '{tag}' by {ctx.author.name} ({ctx.author.id})")
 
     @commands.command(name='remove_tag', help="Remove a tag from a user. Example: !remove_tag @user tagname")
     async def remove_tag(self, ctx, member: discord.Member, tag: str):
         """Remove a tag from a user, ensuring the author is authorized."""
-        logging.info(f"User {ctx.author} ({ctx.author.id}) attempted to remove tag {tag} from {member.name} ({member.id})")
+        logger.info(f"User {ctx.author} ({ctx.author.id}) attempted to remove tag {tag} from {member.name} ({member.id})")
 
         # Check if the author is allowed to remove this tag
         if not self.check_user_roles(ctx.author, tag):
             await ctx.send(f"Sorry {ctx.author.mention}, you don't have permission to remove the tag '{tag}'.")
-            logging.warning(f"Unauthorized tag removal attempt by {ctx.author.name} ({ctx.author.id}) for tag '{tag}'")
+            logger.warning(f"Unauthorized tag removal attempt by {ctx.author.name} ({ctx.author.id}) for tag '{tag}'")
             return
 
         # Remove the tag
-        if remove_tag_from_user(member.id, tag):
+        if await self.tag_index.remove_tag(ctx.guild.id, member.id, tag):
             await ctx.send(f"Successfully removed tag '{tag}' from {member.mention}.")
-            logging.info(f"Tag '{tag}' removed from {member.name} ({member.id}) by {ctx.author.name} ({ctx.author.id})")
+            logger.info(f"Tag '{tag}' removed from {member.name} ({member.id}) by {ctx.author.name} ({ctx.author.id})")
         else:
             await ctx.send(f"Tag '{tag}' not found for {member.mention}.")
-            logging.warning(f"Tag '{tag}' not found for {member.name} ({member.id}) when {ctx.author.name} ({ctx.author.id}) tried to remove it.")
+            logger.warning(f"Tag '{tag}' not found for {member.name} ({member.id}) when {ctx.author.name} ({ctx.author.id}) tried to remove it.")
+
+    async def resolve_bulk_targets(self, ctx, targets):
+        """Collect member IDs from mentioned members and roles, and from an attached file of IDs.
+
+        Returns (member_ids, failed), where failed lists file entries that are not members of the guild.
+        """
+        member_ids = set()
+        failed = []
+        if any(isinstance(target, discord.Role) for target in targets):
+            await ensure_chunked(ctx.guild)  # A role's members are only all known once the guild is chunked
+        for target in targets:
+            if isinstance(target, discord.Role):
+                member_ids.update(member.id for member in target.members)
+            else:
+                member_ids.add(target.id)
+
+        entries = []
+        for attachment in ctx.message.attachments:
+            content = (await attachment.read()).decode('utf-8', errors='replace')
+            entries += content.replace(',', ' ').split()
+        members = await resolve_members(ctx.guild, {int(entry) for entry in entries if entry.isdigit()})
+        for entry in entries:
+            if entry.isdigit() and int(entry) in members:
+                member_ids.add(int(entry))
+            else:
+                failed.append(entry)
+        return sorted(member_ids), failed
+
+    @commands.command(name='bulk_assign_tag', help="Assign a tag to many users at once: mention members or roles, or attach a file of user IDs. Example: !bulk_assign_tag tagname @user1 @user2 @Role")
+    async def bulk_assign_tag(self, ctx, tag: str, *targets: Union[discord.Member, discord.Role]):
+        """Assign a tag to many users in one transaction, replying with a single summary."""
+        # Validate the tag
+        valid, message = self.validate_tag(tag)
+        if not valid:
+            await ctx.send(message)
+            return
+
+        # Check once if the author is allowed to assign this tag
+        if not self.check_user_roles(ctx.author, tag):
+            await ctx.send(f"Sorry {ctx.author.mention}, you don't have permission to assign the tag '{tag}'.")
+            logger.warning(f"Unauthorized bulk tag assignment attempt by {ctx.author.name} ({ctx.author.id}) for tag '{tag}'")
+            return
+
+        member_ids, failed = await self.resolve_bulk_targets(ctx, targets)
+        if not member_ids and not failed:
+            await ctx.send("Please mention members or roles, or attach a file of user IDs.")
+            return
+
+        added, already_had = await self.tag_index.add_tag_bulk(ctx.guild.id, member_ids, tag)
+        await ctx.send(f"Tag '{tag}': added to {len(added)} members, {len(already_had)} already had it, {len(failed)} failed.")
+        logger.info(f"Tag '{tag}' bulk assigned by {ctx.author.name} ({ctx.author.id}): "
+                    f"{len(added)} added, {len(already_had)} already had it, {len(failed)} failed")
+
+    @commands.command(name='bulk_remove_tag', help="Remove a tag from many users at once: mention members or roles, or attach a file of user IDs. Example: !bulk_remove_tag tagname @user1 @Role")
+    async def bulk_remove_tag(self, ctx, tag: str, *targets: Union[discord.Member, discord.Role]):
+        """Remove a tag from many users in one transaction, replying with a single summary."""
+        # Check once if the author is allowed to remove this tag
+        if not self.check_user_roles(ctx.author, tag):
+            await ctx.send(f"Sorry {ctx.author.mention}, you don't have permission to remove the tag '{tag}'.")
+            logger.warning(f"Unauthorized bulk tag removal attempt by {ctx.author.name} ({ctx.author.id}) for tag '{tag}'")
+            return
+
+        member_ids, failed = await self.resolve_bulk_targets(ctx, targets)
+        if not member_ids and not failed:
+            await ctx.send("Please mention members or roles, or attach a file of user IDs.")
+            return
+
+        removed, did_not_have = await self.tag_index.remove_tag_bulk(ctx.guild.id, member_ids, tag)
+        await ctx.send(f"Tag '{tag}': removed from {len(removed)} members, {len(did_not_have)} did not have it, {len(failed)} failed.")
+        logger.info(f"Tag '{tag}' bulk removed by {ctx.author.name} ({ctx.author.id}): "
+                    f"{len(removed)} removed, {len(did_not_have)} did not have it, {len(failed)} failed")
+
+    @commands.command(name='set_tag_rule', help="Set roles allowed to manage a tag; with no roles, nobody can. Example: !set_tag_rule tagname Admin Moderator")
+    @commands.has_permissions(administrator=True)
+    async def set_tag_rule(self, ctx, tag: str, *roles: discord.Role):
+        """Set which roles are allowed to manage a specific tag; no roles locks it."""
+        role_ids = {role.id for role in roles}
+        await set_tag_role_ids(ctx.guild.id, tag, role_ids)
+        self.set_cached_rule(ctx.guild.id, tag, role_ids)
+        role_names = ', '.join(role.name for role in roles) or "nobody"
+        await ctx.send(f"Roles allowed to manage the tag '{tag}': {role_names}")
+        logger.info(f"Admin {ctx.author} updated roles for tag '{tag}' to: {role_names}")
 
-    @commands.command(name='set_tag_rule', help="Set roles allowed to manage a tag. Example: !set_tag_rule tagname Admin Moderator")
+    @commands.command(name='clear_tag_rule', help=f"Remove a tag's rule so {DEFAULT_TAG_ROLE} can manage it. Example: !clear_tag_rule tagname")
     @commands.has_permissions(administrator=True)
-    async def set_tag_rule(self, ctx, tag: str, *roles):
-        """Set which roles are allowed to manage a specific tag."""
-        set_tag_roles(tag, roles)
-        await ctx.send(f"Roles allowed to manage the tag '{tag}': {', '.join(roles)}")
-        logging.info(f"Admin {ctx.author} updated roles for tag '{tag}' to: {', '.join(roles)}")
+    async def clear_tag_rule(self, ctx, tag: str):
+        """Remove a tag's rule, so the tag falls back to DEFAULT_TAG_ROLE."""
+        await remove_tag_role_ids(ctx.guild.id, tag)
+        self.set_cached_rule(ctx.guild.id, tag, None)
+        await ctx.send(f"The tag '{tag}' no longer has a rule; {DEFAULT_TAG_ROLE} can manage it.")
+        logger.info(f"Admin {ctx.author} cleared the rule for tag '{tag}'")
 
     @commands.command(name='list_tags', help="List all available tags.")
     async def list_tags(self, ctx):
         """List all available tags."""
-        tags = get_all_tags()
+        tags = self.tag_index.get_all_tags(ctx.guild.id)
         if tags:
             await ctx.send(f"Available tags: {', '.join(tags)}")
         else:
@@ -96,7 +320,7 @@ class TagManagement(commands.Cog, name="Tag Management"):
     @commands.command(name='user_tags', help="List tags assigned to a user. Example: !user_tags @user")
     async def user_tags(self, ctx, member: discord.Member):
         """List tags assigned to a specific user."""
-        tags = get_user_tags(member.id)
+        tags = self.tag_index.get_user_tags(ctx.guild.id, member.id)
         if tags:
             await ctx.send(f"{member.mention} has the following tags: {', '.join(tags)}")
         else:
@@ -3,64 +3,416 @@
 import discord
 from discord.ext import commands, tasks
 import logging
-from db import store_user_presence, get_user_total_presence  # Ensure this is imported correctly
+import time
+from array import array
+from action_journal import role_action, shard_filter
+from leaderboard import Leaderboard
+from member_cache import resolve_members
+from session_store import SessionStore
+from config import (PROMOTION_TIERS, PRESENCE_HOURLY_RETENTION_DAYS, PRESENCE_DAILY_RETENTION_DAYS,
+                    PRESENCE_WEEKLY_RETENTION_DAYS)
+from db import (save_presence_checkpoint, get_open_sessions, get_user_total_presence, get_all_user_presence,
+                get_all_presence_totals, get_job_runs, set_job_run, get_presence_since, get_guild_presence_since, roll_up_presence,
+                bucket_start, HOUR, DAY, WEEK)
+from metrics import PRESENCE_FLUSH_SIZE, PRESENCE_FLUSH_LATENCY
 from datetime import timedelta
 
-# Set up logging for status changes
-logging.basicConfig(filename='user_status.log', level=logging.INFO,
-                    format='%(asctime)s:%(levelname)s:%(message)s')
+# Written to its own log file; see LOG_FILES in main.py
+logger = logging.getLogger(__name__)
+
+ONLINE_STATUSES = (discord.Status.online, discord.Status.idle, discord.Status.dnd)
+
+# Seconds between promotion sweeps of a guild; last run times are stored, so restarts don't sweep again early
+PROMOTION_SWEEP_INTERVAL = 24 * 3600
+
+# Seconds the presence rollups of each period are kept once rolled up
+ROLLUP_RETENTION = {HOUR: PRESENCE_HOURLY_RETENTION_DAYS * DAY, DAY: PRESENCE_DAILY_RETENTION_DAYS * DAY,
+                    WEEK: PRESENCE_WEEKLY_RETENTION_DAYS * DAY}
+
+# Most members !leaderboard lists at once
+LEADERBOARD_MAX = 25
+
+# Windows, in days, that !active_time reports besides the total
+ACTIVE_TIME_WINDOWS = (7, 30)
+
+
+def hour_buckets(start, end):
+    """Splits the time from `start` to `end` (Unix timestamps) at hour boundaries, yielding (hour start, seconds)."""
+    hour = bucket_start(HOUR, start)
+    while hour < end:
+        yield hour, min(hour + HOUR, end) - max(hour, start)
+        hour += HOUR
+
+
+def window_period(since, now):
+    """The finest rollup period whose buckets are still kept back to `since`."""
+    for period in (HOUR, DAY):
+        if now - since <= ROLLUP_RETENTION[period]:
+            return period
+    return WEEK
 
 class UserStatus(commands.Cog):
     """Cog to monitor and track user presence time for role promotion."""
 
-    def __init__(self, bot):
+    def __init__(self, bot, journal, snapshot=None):
         self.bot = bot
-        self.user_presence_times = {}  # Track when users go online
+        self.journal = journal  # ActionJournal that applies promotions
+        self.snapshot = snapshot  # Arrays from snapshot_state to load from instead of the database
+        self.sessions = SessionStore()  # Open sessions: when each online member went online
+        self.rankings = Leaderboard()  # Members ranked by total presence, buffered time included
+        # Members whose session opened or closed since the last checkpoint
+        self.dirty_sessions = set()
+        # Sessions loaded from the last checkpoint, consumed by the first on_ready
+        self.restored_sessions = None
+        # Unix time of each guild's last checkpoint, as stored; shard processes sharing the
+        # database checkpoint their own guilds
+        self.checkpoint_times = {}
+        self.flushing = False  # Whether a checkpoint is being written
+        # Write-behind buffer of presence seconds not yet stored, flushed every
+        # flush_presence interval or once flush_max_events sessions have closed
+        self.pending_presence = {}
+        self.pending_hourly = {}  # The same time split by hour: (guild_id, user_id, hour start) -> seconds
+        self.pending_events = 0
+        self.flush_max_events = 500
         self.check_role_promotion.start()  # Start the background task for promotions
+        self.flush_presence.start()
+        self.roll_up_presence_buckets.start()
+
+    async def cog_load(self):
+        """Loads the open sessions checkpointed before the last shutdown or crash, and the leaderboard,
+        from the startup snapshot or else from the database."""
+        if self.snapshot:
+            (guild_ids, user_ids, started_at, checkpoint_guild_ids, checkpoint_times,
+             total_guild_ids, total_user_ids, totals) = self.snapshot
+            self.snapshot = None
+            self.restored_sessions = dict(zip(zip(guild_ids, user_ids), started_at))
+            self.checkpoint_times = dict(zip(checkpoint_guild_ids, checkpoint_times))
+            self.rankings.load(zip(total_guild_ids, total_user_ids, totals))
+        else:
+            self.restored_sessions, self.checkpoint_times = await get_open_sessions()
+            self.rankings.load(await get_all_presence_totals())
+
+    def snapshot_state(self):
+        """The checkpointed sessions and stored presence totals as arrays for a snapshot.
+
+        That is what the database holds, so it can only be read off the cog's state when
+        every session change has been checkpointed and no flush is under way, as after
+        close_all_sessions; otherwise returns None. Buffered time is taken back off the
+        leaderboard's totals.
+        """
+        if self.dirty_sessions or self.flushing:
+            return None
+        if self.restored_sessions is not None:
+            sessions = self.restored_sessions
+        else:
+            sessions = {key: self.sessions.started_at(key) for key in self.sessions}
+        total_guild_ids, total_user_ids, totals = array('q'), array('q'), array('d')
+        for guild_id, ranked in self.rankings.guilds.items():
+            for user_id, score in ranked.scores.items():
+                pending = self.pending_presence.get((guild_id, user_id))
+                if pending is not None:
+                    score -= pending
+                    if score < 1e-6:
+                        continue  # Only buffered so far; no stored row yet
+                total_guild_ids.append(guild_id)
+                total_user_ids.append(user_id)
+                totals.append(score)
+        return [array('q', [guild_id for guild_id, _ in sessions]), array('q', [user_id for _, user_id in sessions]),
+                array('d', sessions.values()), array('q', self.checkpoint_times.keys()),
+                array('d', self.checkpoint_times.values()), total_guild_ids, total_user_ids, totals]
+
+    async def cog_unload(self):
+        """Stops the background tasks, credits the open sessions and writes out buffered presence time."""
+        self.check_role_promotion.cancel()
+        self.flush_presence.cancel()
+        self.roll_up_presence_buckets.cancel()
+        await self.close_all_sessions()
+
+    async def cog_check(self, ctx):
+        """Presence is tracked per guild, so the commands only run in a guild."""
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage()
+        return True
+
+    def open_session(self, key, started_at=None):
+        """Starts tracking a member's online session, from Unix time `started_at` or now; key is (guild_id, user_id)."""
+        self.sessions.open(key, started_at)
+        self.dirty_sessions.add(key)
+
+    def close_session(self, key):
+        """Ends a member's online session, buffers its duration and returns it (None if no session was open)."""
+        presence_duration = self.sessions.close(key)
+        if presence_duration is None:
+            return None
+        self.dirty_sessions.add(key)
+        self.add_presence(key, presence_duration)
+        return presence_duration
+
+    async def close_all_sessions(self):
+        """Ends every open session at once, credits its time so far and flushes, for shutdown.
+
+        The sessions are checkpointed as starting now, so members still online at the
+        next startup carry on from here and members who went offline are credited up to now.
+        """
+        now = time.time()
+        closed = self.sessions.close_all()
+        for key, presence_duration in closed.items():
+            self.add_presence(key, presence_duration, now)
+        await self.flush_presence_buffer(dict.fromkeys(closed, now))
+        # Reopen them as checkpointed, so a shutdown snapshot matches the database; if the
+        # flush failed it already reopened them
+        for key in closed:
+            if key not in self.sessions:
+                self.sessions.open(key, now)
+
+    def add_presence(self, key, presence_duration, ended_at=None):
+        """Adds presence time that ended at Unix time `ended_at` (default now) to the write-behind buffer."""
+        self.pending_presence[key] = self.pending_presence.get(key, 0) + presence_duration
+        self.rankings.add(*key, presence_duration)
+        ended_at = time.time() if ended_at is None else ended_at
+        for hour, seconds in hour_buckets(ended_at - presence_duration, ended_at):
+            hour_key = key + (hour,)
+            self.pending_hourly[hour_key] = self.pending_hourly.get(hour_key, 0) + seconds
+        self.pending_events += 1
+
+    async def flush_presence_buffer(self, resumed=None):
+        """Writes buffered presence durations and changed sessions to the database in one transaction.
+
+        `resumed` maps sessions closed by close_all_sessions to the Unix time they are
+        checkpointed as starting.
+        """
+        resumed = resumed or {}
+        if not self.pending_presence and not self.dirty_sessions and not resumed:
+            return
+        batch, self.pending_presence = self.pending_presence, {}
+        hourly, self.pending_hourly = self.pending_hourly, {}
+        dirty, self.dirty_sessions = self.dirty_sessions, set()
+        self.pending_events = 0
+        opened = {key: self.sessions.started_at(key) for key in dirty if key in self.sessions}
+        opened.update(resumed)
+        closed = [key for key in dirty if key not in opened]
+        # Until on_ready has settled the restored sessions, the guilds' checkpoints still describe them
+        guild_ids = [] if self.restored_sessions is not None else [guild.id for guild in self.bot.guilds]
+        start = time.perf_counter()
+        checkpoint_time = time.time()
+        self.flushing = True
+        try:
+            await save_presence_checkpoint(batch, opened, closed, checkpoint_time, hourly, guild_ids)
+        except Exception:
+            # Put everything back so it is retried on the next flush
+            for key, duration in batch.items():
+                self.pending_presence[key] = self.pending_presence.get(key, 0) + duration
+            for hour_key, seconds in hourly.items():
+                self.pending_hourly[hour_key] = self.pending_hourly.get(hour_key, 0) + seconds
+            self.dirty_sessions |= dirty
+            for key, started_at in resumed.items():
+                self.open_session(key, started_at)
+            logger.exception(f"Failed to flush presence for {len(batch)} users; will retry.")
+            return
+        finally:
+            self.flushing = False
+        self.checkpoint_times.update(dict.fromkeys(guild_ids, checkpoint_time))
+        latency = time.perf_counter() - start
+        PRESENCE_FLUSH_SIZE.observe(len(batch))
+        PRESENCE_FLUSH_LATENCY.observe(latency)
+        logger.info(f"Flushed presence for {len(batch)} users and {len(dirty)} session changes "
+                    f"in {latency * 1000:.1f} ms.")
+
+    @tasks.loop(seconds=30)
+    async def flush_presence(self):
+        """Background task that periodically flushes buffered presence time and checkpoints open sessions."""
+        await self.flush_presence_buffer()
+
+    async def get_total_presence(self, member):
+        """Total presence for a member in their guild, including time still waiting in the buffer."""
+        return (await get_user_total_presence(member.guild.id, member.id)
+                + self.pending_presence.get((member.guild.id, member.id), 0))
+
+    def pending_since(self, guild_id, since):
+        """Buffered presence in a guild since Unix time `since`, to the hour, as a mapping of user ID to seconds."""
+        since_hour = bucket_start(HOUR, since)
+        pending = {}
+        for (pending_guild_id, user_id, hour), seconds in self.pending_hourly.items():
+            if pending_guild_id == guild_id and hour >= since_hour:
+                pending[user_id] = pending.get(user_id, 0) + seconds
+        return pending
+
+    async def get_recent_presence(self, member, days):
+        """A member's presence over the last `days` days, from the rollups plus the buffer."""
+        now = time.time()
+        since = now - days * DAY
+        stored = await get_presence_since(member.guild.id, member.id, window_period(since, now), since)
+        return stored + self.pending_since(member.guild.id, since).get(member.id, 0)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """Syncs open sessions with the members' current status.
+
+        On the first ready after startup, sessions from the checkpoint are resumed for
+        members who are still online. Members who went offline while the bot was down
+        are credited up to their guild's last checkpoint. Sessions in guilds served by other
+        shard processes are left for those processes.
+        """
+        restored = self.restored_sessions or {}
+        self.restored_sessions = None
+
+        for guild in self.bot.guilds:
+            for member in guild.members:
+                key = (guild.id, member.id)
+                online = member.status in ONLINE_STATUSES
+                if online and key not in self.sessions:
+                    self.open_session(key, restored.pop(key, None))
+                elif not online and key in self.sessions:
+                    self.close_session(key)
+
+        guild_ids = {guild.id for guild in self.bot.guilds}
+        restored = {key: started_at for key, started_at in restored.items() if key[0] in guild_ids}
+        for key, started_at in restored.items():
+            checkpoint_time = self.checkpoint_times.get(key[0])
+            if checkpoint_time and checkpoint_time > started_at:
+                self.add_presence(key, checkpoint_time - started_at, checkpoint_time)
+            self.dirty_sessions.add(key)  # Drops the stale checkpoint row
+
+        logger.info(f"Presence sessions synced: {len(self.sessions)} open, "
+                    f"{len(restored)} closed from the checkpoint.")
+        await self.flush_presence_buffer()
 
     @commands.Cog.listener()
     async def on_presence_update(self, before: discord.Member, after: discord.Member):
         """Tracks user status changes and calculates presence time."""
-        before_status = before.status
-        after_status = after.status
-
-        logging.info(f"User {after.name} ({after.id}) presence change: {before_status} -> {after_status}")
-        
-        # Log when a user comes online or goes offline
-        if before_status != after_status:
-            if after_status in (discord.Status.online, discord.Status.idle, discord.Status.dnd):
-                self.user_presence_times[after.id] = discord.utils.utcnow()  # Store when they went online
-                logging.info(f"User {after.name} ({after.id}) went online at {self.user_presence_times[after.id]}")
-            elif after_status == discord.Status.offline and after.id in self.user_presence_times:
-                # Calculate presence duration
-                start_time = self.user_presence_times.pop(after.id, None)
-                if start_time:
-                    presence_duration = (discord.utils.utcnow() - start_time).total_seconds()
-                    await store_user_presence(after.id, presence_duration)
-                    logging.info(f"User {after.name} ({after.id}) was online for {presence_duration} seconds.")
-                else:
-                    logging.warning(f"User {after.name} ({after.id}) went offline, but no start time found.")
-
-
-    @tasks.loop(hours=24)
+        if before.status == after.status:
+            return  # Activity or client change only; nothing to track or log
+        await self.track_status(after.guild.id, after.id, after.status)
+
+    @commands.Cog.listener()
+    async def on_raw_presence_update(self, payload):
+        """Tracks status changes of members outside the member cache.
+
+        Only dispatched with MEMBER_CHUNKING=lazy, where discord.py drops presence updates
+        for uncached members; cached members are left to on_presence_update.
+        """
+        if payload.guild is None or payload.guild.get_member(payload.user_id):
+            return
+        await self.track_status(payload.guild_id, payload.user_id, payload.client_status.status)
+
+    async def track_status(self, guild_id, user_id, status):
+        """Opens or closes a member's session for their new status."""
+        key = (guild_id, user_id)
+        if status in ONLINE_STATUSES:
+            # Switching between online, idle and dnd continues the current session
+            if key not in self.sessions:
+                self.open_session(key)  # Store when they went online
+                logger.info("User %s went online", user_id,
+                            extra={'event': 'presence_online', 'guild_id': guild_id, 'user_id': user_id})
+        elif status == discord.Status.offline:
+            # Calculate presence duration
+            presence_duration = self.close_session(key)
+            if presence_duration is not None:
+                logger.info("User %s was online for %.0f seconds", user_id, presence_duration,
+                            extra={'event': 'presence_offline', 'guild_id': guild_id, 'user_id': user_id,
+                                   'duration': presence_duration})
+                if self.pending_events >= self.flush_max_events:
+                    await self.flush_presence_buffer()
+            else:
+                logger.warning("User %s went offline, but no start time found", user_id,
+                               extra={'event': 'presence_offline', 'guild_id': guild_id, 'user_id': user_id})
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload):
+        """Ends the session of a member who left while online."""
+        self.close_session((payload.guild_id, payload.user.id))
+
+    @commands.Cog.listener()
+    async def on_members_purged(self, keys):
+        """Drops buffered presence of departed members whose stored data was purged, so a flush doesn't bring it back."""
+        for key in keys:
+            self.pending_presence.pop(key, None)
+            self.sessions.discard(key)
+            self.dirty_sessions.discard(key)
+        self.rankings.forget_users(keys)
+        purged = set(keys)
+        self.pending_hourly = {hour_key: seconds for hour_key, seconds in self.pending_hourly.items()
+                               if hour_key[:2] not in purged}
+
+    @tasks.loop(hours=1)
     async def check_role_promotion(self):
-        """Background task to check for role promotions every 24 hours."""
-        for guild in self.bot.guilds:
-            for member in guild.members:
-                total_presence_time = get_user_total_presence(member.id)  # Remove `await` here
-                membership_duration = (discord.utils.utcnow() - member.joined_at).total_seconds()
-
-                # Example thresholds for promotions
-                if membership_duration > 30 * 24 * 3600 and total_presence_time > 100 * 3600:  # 30 days, 100 hours online
-                    new_role = discord.utils.get(guild.roles, name="Veteran")
-                    if new_role and new_role not in member.roles:
-                        await member.add_roles(new_role)
-                        logging.info(f"User {member.name} ({member.id}) promoted to Veteran role.")
-                elif membership_duration > 60 * 24 * 3600 and total_presence_time > 200 * 3600:  # 60 days, 200 hours online
-                    new_role = discord.utils.get(guild.roles, name="Elite")
-                    if new_role and new_role not in member.roles:
-                        await member.add_roles(new_role)
-                        logging.info(f"User {member.name} ({member.id}) promoted to Elite role.")
+        """Background task that checks each guild for role promotions every 24 hours.
+
+        Guilds swept less than PROMOTION_SWEEP_INTERVAL ago are skipped. Loads each
+        guild's presence in one query, looks up only the members online long enough
+        for the lowest tier (fetching any that aren't cached), lays membership and
+        online time out as arrays, and checks every tier in a single pass. Tiers with a
+        window are checked against the presence rollups for that window. Promotions
+        are journaled, so ones not yet applied survive a restart.
+        """
+        now = discord.utils.utcnow().timestamp()
+        last_runs = await get_job_runs('promotion_sweep')
+        guilds = [guild for guild in self.bot.guilds if now - last_runs.get(guild.id, 0) >= PROMOTION_SWEEP_INTERVAL]
+        if not guilds:
+            return
+        pending_by_guild = {}
+        for (guild_id, user_id), duration in self.pending_presence.items():
+            pending_by_guild.setdefault(guild_id, {})[user_id] = duration
+
+        promotions = []
+        for guild in guilds:
+            # Resolve each tier's role once per guild, converting thresholds to seconds
+            tiers = []
+            for role_name, min_days, min_hours, window in PROMOTION_TIERS:
+                role = discord.utils.get(guild.roles, name=role_name)
+                if role:
+                    tiers.append((role, min_days * DAY, min_hours * HOUR, window))
+            if not tiers:
+                continue
+
+            presence = await get_all_user_presence(guild.id)
+            for user_id, duration in pending_by_guild.get(guild.id, {}).items():
+                presence[user_id] = presence.get(user_id, 0) + duration
+
+            # Only members online long enough for the lowest tier can qualify, so only they are looked up;
+            # time within a window never exceeds the total, so this holds for windowed tiers too
+            min_presence = min(tier[2] for tier in tiers)
+            candidates = await resolve_members(guild, [user_id for user_id, total in presence.items()
+                                                       if total > min_presence])
+            members = [member for member in candidates.values() if member.joined_at]
+            membership_durations = array('d', (now - member.joined_at.timestamp() for member in members))
+            # Online time for each window the tiers use, read from the rollups; None is all time
+            presence_times = {None: array('d', (presence.get(member.id, 0) for member in members))}
+            for window in {tier[3] for tier in tiers if tier[3]}:
+                since = now - window * DAY
+                recent = await get_guild_presence_since(guild.id, window_period(since, now), since)
+                for user_id, seconds in self.pending_since(guild.id, since).items():
+                    recent[user_id] = recent.get(user_id, 0) + seconds
+                presence_times[window] = array('d', (recent.get(member.id, 0) for member in members))
+            tiers = [(role, min_membership, min_presence, presence_times[window])
+                     for role, min_membership, min_presence, window in tiers]
+
+            for i, (member, membership_duration) in enumerate(zip(members, membership_durations)):
+                for role, min_membership, min_presence, online_times in tiers:
+                    if (membership_duration > min_membership and online_times[i] > min_presence
+                            and not member.get_role(role.id)):
+                        promotions.append(role_action(guild.id, member.id, role.id, True))
+
+        await self.journal.record(promotions)
+        await set_job_run('promotion_sweep', [guild.id for guild in guilds], now)
+        logger.info(f"Role promotion sweep of {len(guilds)} guilds journaled {len(promotions)} promotions.")
+
+    @check_role_promotion.before_loop
+    async def before_check_role_promotion(self):
+        """Waits for the member cache before the first sweep."""
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(hours=1)
+    async def roll_up_presence_buckets(self):
+        """Background task that rolls hourly presence up into daily and weekly buckets and drops expired ones."""
+        start = time.perf_counter()
+        rolled = await roll_up_presence(time.time(), ROLLUP_RETENTION, *shard_filter(self.bot))
+        logger.info(f"Rolled up {rolled} presence buckets in {(time.perf_counter() - start) * 1000:.0f} ms.")
+
+    @roll_up_presence_buckets.before_loop
+    async def before_roll_up_presence_buckets(self):
+        """Waits until the bot is ready, so shard IDs are known."""
+        await self.bot.wait_until_ready()
 
     @commands.command(name='user_level', help="Check the user's current level and promotion progress.")
     async def user_level(self, ctx, member: discord.Member = None):
@@ -73,26 +425,53 @@ class UserStatus(commands.Cog):
         role_str = ', '.join(roles) if roles else "No special roles assigned."
 
         # Fetch the user's total active time and membership duration
-        total_presence_time = get_user_total_presence(member.id)  # Remove `await` here
+        total_presence_time = await self.get_total_presence(member)
         membership_duration = (discord.utils.utcnow() - member.joined_at).total_seconds()
 
-        # Calculate remaining time for the next promotion
-        next_promotion_hours = 100 * 3600 - total_presence_time  # Assuming promotion at 100 hours
+        # Calculate remaining time for the next promotion: the first tier whose role the member lacks
+        held_roles = {role.name for role in member.roles}
+        next_promotion_hours = 0
+        for role_name, min_days, min_hours, window in PROMOTION_TIERS:
+            if role_name not in held_roles:
+                tier_presence_time = await self.get_recent_presence(member, window) if window else total_presence_time
+                next_promotion_hours = min_hours * 3600 - tier_presence_time
+                break
+
+        ranking = self.rankings.rank(ctx.guild.id, member.id)
+        rank_str = f"#{ranking[0]} of {ranking[1]}" if ranking else "Unranked"
 
         await ctx.send(f"{member.mention}'s current roles: {role_str}\n"
                        f"Active Time: {str(timedelta(seconds=total_presence_time))} (HH:MM:SS)\n"
+                       f"Rank: {rank_str}\n"
                        f"Membership Duration: {str(timedelta(seconds=membership_duration))} (HH:MM:SS)\n"
                        f"Time until next promotion: {str(timedelta(seconds=max(0, next_promotion_hours)))} (HH:MM:SS)")
 
-    @commands.command(name='active_time', help="Check the user's total active (online) time.")
+    @commands.command(name='active_time', help="Check the user's active (online) time, in total and over the last 7 and 30 days.")
     async def active_time(self, ctx, member: discord.Member = None):
-        """Check the total time a user has been actively online."""
+        """Check the time a user has been actively online, in total and recently."""
         if not member:
             member = ctx.author
 
-        total_presence_time = get_user_total_presence(member.id)  # Remove `await` here
+        total_presence_time = await self.get_total_presence(member)
+        lines = [f"{member.mention}'s total active time: {str(timedelta(seconds=total_presence_time))} (HH:MM:SS)"]
+        for days in ACTIVE_TIME_WINDOWS:
+            recent = await self.get_recent_presence(member, days)
+            lines.append(f"Last {days} days: {str(timedelta(seconds=recent))} (HH:MM:SS)")
+        await ctx.send('\n'.join(lines))
 
-        # Format the time into hours, minutes, and seconds
-        formatted_time = str(timedelta(seconds=total_presence_time))
-        
-        await ctx.send(f"{member.mention}'s total active time: {formatted_time} (HH:MM:SS)")
+    @commands.command(name='leaderboard', help="Show the most active members by total online time. Example: !leaderboard 10")
+    async def leaderboard(self, ctx, count: int = 10):
+        """Lists the guild's most active members, ranked in memory without a database query."""
+        count = max(1, min(count, LEADERBOARD_MAX))
+        top = self.rankings.top(ctx.guild.id, count)
+        if not top:
+            await ctx.send("No activity recorded yet.")
+            return
+        # Mentions in an embed show names without pinging anyone, even for members not in the cache
+        lines = [f"**{rank}.** <@{user_id}>: {str(timedelta(seconds=int(seconds)))}"
+                 for rank, (user_id, seconds) in enumerate(top, start=1)]
+        embed = discord.Embed(title="Most Active Members", description='\n'.join(lines), color=discord.Color.blue())
+        ranking = self.rankings.rank(ctx.guild.id, ctx.author.id)
+        if ranking:
+            embed.set_footer(text=f"You are #{ranking[0]} of {ranking[1]}")
+        await ctx.send(embed=embed)
@@ -4,11 +4,76 @@ import discord
 from discord.ext import commands
 from datetime import datetime
 import logging
-from db import add_subscription, remove_subscription, get_subscription, get_vip_status
+from db import get_vip_status, get_admin_notifications
+
+# Written to its own log file; see LOG_FILES in main.py
+logger = logging.getLogger(__name__)
+
+class VIPListView(discord.ui.View):
+    """Paginated VIP list; only the page being shown is formatted."""
+
+    def __init__(self, author, active_vips, expired_vips, page_size=15):
+        super().__init__(timeout=180)
+        self.author = author
+        self.active_count = len(active_vips)
+        self.expired_count = len(expired_vips)
+        self.entries = [(user_id, expires_at, True) for user_id, expires_at in active_vips]
+        self.entries += [(user_id, expires_at, False) for user_id, expires_at in expired_vips]
+        self.page_size = page_size
+        self.page = 0
+        self.page_count = max(1, -(-len(self.entries) // page_size))
+        self.message = None
+        self._update_buttons()
+
+    def build_embed(self):
+        """Builds the embed for the current page."""
+        start = self.page * self.page_size
+        active_vip_list = []
+        expired_vip_list = []
+        for user_id, expires_at, active in self.entries[start:start + self.page_size]:
+            expiry_date = datetime.fromtimestamp(expires_at).strftime("%Y-%m-%d %H:%M:%S")
+            if active:
+                active_vip_list.append(f'<@{user_id}> - Expires on {expiry_date}')
+            else:
+                expired_vip_list.append(f'<@{user_id}> - Expired on {expiry_date}')
+
+        embed = discord.Embed(title="VIP List", color=discord.Color.gold())
+        if active_vip_list or not expired_vip_list:
+            embed.add_field(name="Active VIPs", value='\n'.join(active_vip_list) or "None", inline=False)
+        if expired_vip_list or not active_vip_list:
+            embed.add_field(name="Expired VIPs", value='\n'.join(expired_vip_list) or "None", inline=False)
+        embed.set_footer(text=f"Page {self.page + 1}/{self.page_count} - "
+                              f"{self.active_count} active, {self.expired_count} expired")
+        return embed
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def interaction_check(self, interaction):
+        """Only the member who ran the command can turn pages."""
+        return interaction.user.id == self.author.id
+
+    async def _show_page(self, interaction, page):
+        self.page = page
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._show_page(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        """Disables the buttons once the view stops listening."""
+        if self.message:
+            self.previous_page.disabled = True
+            self.next_page.disabled = True
+            await self.message.edit(view=self)
 
-# Set up logging for permission checks and actions
-logging.basicConfig(filename='bot_permissions.log', level=logging.INFO,
-                    format='%(asctime)s:%(levelname)s:%(message)s')
 
 class VIPManagement(commands.Cog, name="VIP Management"):
     """Cog for managing VIP subscriptions."""
@@ -18,72 +83,90 @@ class VIPManagement(commands.Cog, name="VIP Management"):
         self.vip_manager = vip_manager
         self.messaging = messaging
 
+    async def cog_check(self, ctx):
+        """All commands in this cog work on guild-scoped data, so they only run in a guild."""
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage()
+        return True
+
     @commands.command(name='addvip', help='Add a VIP subscription to a member for a specified duration.')
     @commands.has_permissions(administrator=True)  # Require administrator permission
     async def add_vip(self, ctx, member: discord.Member, duration_str: str):
         """Adds a VIP subscription to a member."""
-        logging.info(f"Admin {ctx.author} ({ctx.author.id}) attempted to add VIP to {member.name} ({member.id})")
+        logger.info(f"Admin {ctx.author} ({ctx.author.id}) attempted to add VIP to {member.name} ({member.id})")
         
         # Validate the duration and add the subscription
         try:
             duration = self.vip_manager.parse_duration(duration_str)
             expiry_date = datetime.now() + duration
-            add_subscription(member.id, expiry_date.isoformat())
-            await self.vip_manager.manage_vip_role(member)
+            await self.vip_manager.add_vip(member, expiry_date)
             await ctx.send(f'VIP subscription added for {member.mention} for {duration_str}.')
             await self.messaging.notify_admin(ctx.guild, f'{member.mention} has been added to VIP for {duration_str}.')
-            logging.info(f"VIP subscription added for {member.name} ({member.id}) by {ctx.author.name} ({ctx.author.id})")
+            logger.info(f"VIP subscription added for {member.name} ({member.id}) by {ctx.author.name} ({ctx.author.id})")
         except ValueError as e:
             await ctx.send(str(e))
-            logging.warning(f"Failed VIP addition by {ctx.author.name} ({ctx.author.id}): {str(e)}")
+            logger.warning(f"Failed VIP addition by {ctx.author.name} ({ctx.author.id}): {str(e)}")
 
     @add_vip.error
     async def add_vip_error(self, ctx, error):
         """Handle permission error for the add_vip command."""
         if isinstance(error, commands.MissingPermissions):
             await ctx.send(f"Sorry {ctx.author.mention}, you don't have permission to add VIP roles.")
-            logging.warning(f"Permission denied for {ctx.author.name} ({ctx.author.id}) to add VIP roles.")
+            logger.warning(f"Permission denied for {ctx.author.name} ({ctx.author.id}) to add VIP roles.")
 
     @commands.command(name='removevip', help='Remove a VIP subscription from a member.')
     @commands.has_permissions(administrator=True)  # Require administrator permission
     async def remove_vip(self, ctx, member: discord.Member):
         """Removes a VIP subscription from a member."""
-        logging.info(f"Admin {ctx.author} ({ctx.author.id}) attempted to remove VIP from {member.name} ({member.id})")
+        logger.info(f"Admin {ctx.author} ({ctx.author.id}) attempted to remove VIP from {member.name} ({member.id})")
         
-        await self.vip_manager.remove_vip_role(member)
+        await self.vip_manager.remove_vip(member)
         await ctx.send(f'VIP subscription removed for {member.mention}.')
         await self.messaging.notify_admin(ctx.guild, f'{member.mention} has been removed from VIP.')
-        logging.info(f"VIP subscription removed for {member.name} ({member.id}) by {ctx.author.name} ({ctx.author.id})")
+        logger.info(f"VIP subscription removed for {member.name} ({member.id}) by {ctx.author.name} ({ctx.author.id})")
 
     @remove_vip.error
     async def remove_vip_error(self, ctx, error):
         """Handle permission error for the remove_vip command."""
         if isinstance(error, commands.MissingPermissions):
             await ctx.send(f"Sorry {ctx.author.mention}, you don't have permission to remove VIP roles.")
-            logging.warning(f"Permission denied for {ctx.author.name} ({ctx.author.id}) to remove VIP roles.")
+            logger.warning(f"Permission denied for {ctx.author.name} ({ctx.author.id}) to remove VIP roles.")
+
+    @commands.command(name='reconcilevip', help="Check every member's VIP role against the subscriptions.")
+    @commands.has_permissions(administrator=True)  # Require administrator permission
+    async def reconcile_vip(self, ctx):
+        """Fixes VIP roles that drifted while the bot was offline; role changes while it runs are fixed as they happen."""
+        logger.info(f"Admin {ctx.author} ({ctx.author.id}) started VIP role reconciliation in {ctx.guild.name}")
+        added, removed, elapsed = await self.vip_manager.reconcile_vip_roles([ctx.guild])
+        await ctx.send(f'VIP roles checked in {elapsed:.1f}s: {added} to add, {removed} to remove.')
 
     @commands.command(name='listvip', help='List all active and expired VIP subscriptions.')
     async def list_vip(self, ctx):
         """Lists all VIP subscriptions."""
-        logging.info(f"User {ctx.author} ({ctx.author.id}) requested VIP list.")
+        logger.info(f"User {ctx.author} ({ctx.author.id}) requested VIP list.")
         
-        active_vips, expired_vips = get_vip_status()
-        active_vip_list = []
-        expired_vip_list = []
-
-        for user_id in active_vips:
-            expiry_date = datetime.fromisoformat(get_subscription(user_id))
-            active_vip_list.append(f'<@{user_id}> - Expires on {expiry_date.strftime("%Y-%m-%d %H:%M:%S")}')
-
-        for user_id in expired_vips:
-            expiry_date = datetime.fromisoformat(get_subscription(user_id))
-            expired_vip_list.append(f'<@{user_id}> - Expired on {expiry_date.strftime("%Y-%m-%d %H:%M:%S")}')
+        active_vips, expired_vips = await get_vip_status(ctx.guild.id)
+        view = VIPListView(ctx.author, active_vips, expired_vips)
+        if view.page_count == 1:
+            await ctx.send(embed=view.build_embed())
+        else:
+            view.message = await ctx.send(embed=view.build_embed(), view=view)
 
-        active_vip_list_str = '\n'.join(active_vip_list) if active_vip_list else "None"
-        expired_vip_list_str = '\n'.join(expired_vip_list) if expired_vip_list else "None"
+    @commands.command(name='vip_audit', help='Page through the stored admin notifications. Example: !vip_audit 2')
+    @commands.has_permissions(administrator=True)  # Require administrator permission
+    async def vip_audit(self, ctx, page: int = 1):
+        """Shows one page of this guild's admin notifications, newest first."""
+        page_size = 15
+        page = max(1, page)
+        notifications, total = await get_admin_notifications(ctx.guild.id, page_size, (page - 1) * page_size)
+        page_count = max(1, -(-total // page_size))
 
-        embed = discord.Embed(title="VIP List", color=discord.Color.gold())
-        embed.add_field(name="Active VIPs", value=active_vip_list_str, inline=False)
-        embed.add_field(name="Expired VIPs", value=expired_vip_list_str, inline=False)
+        lines = []
+        for created_at, message, urgent in notifications:
+            timestamp = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f"{'[urgent] ' if urgent else ''}{timestamp} - {message}")
 
+        embed = discord.Embed(title="VIP Audit Log", color=discord.Color.gold())
+        embed.description = '\n'.join(lines) if lines else "No notifications on this page."
+        embed.set_footer(text=f"Page {page}/{page_count} - {total} notifications")
         await ctx.send(embed=embed)
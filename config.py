@@ -9,19 +9,94 @@ load_dotenv()
 
 # Discord Token and other configurations
 TOKEN = os.getenv('DISCORD_TOKEN')
+# Name of the guild that data from before multi-guild support belongs to; only needed
+# when upgrading a database from a single-guild install that is now in several guilds
 GUILD = os.getenv('DISCORD_GUILD')
+# Channel for notices to members whose DMs are closed; guilds without it use their system channel
 GENERAL_CHANNEL_ID = os.getenv('GENERAL_CHANNEL_ID')
 
 # Ensure these variables are set
 if not TOKEN:
     raise ValueError("DISCORD_TOKEN is not set in the environment variables.")
-if not GUILD:
-    raise ValueError("GUILD is not set in the environment variables.")
-if not GENERAL_CHANNEL_ID:
-    raise ValueError("GENERAL_CHANNEL_ID is not set in the environment variables.")
 
 # Convert GENERAL_CHANNEL_ID to an integer
-GENERAL_CHANNEL_ID = int(GENERAL_CHANNEL_ID)
+GENERAL_CHANNEL_ID = int(GENERAL_CHANNEL_ID) if GENERAL_CHANNEL_ID else None
+
+def parse_shard_ids(value):
+    """Parse '0,1,2' into a list of shard IDs, or None if unset."""
+    if not value:
+        return None
+    return [int(shard_id) for shard_id in value.split(',')]
+
+# Sharding: leave both unset to let Discord pick the shard count and run every shard in
+# this process. To split shards across N processes, set the same SHARD_COUNT on each and
+# give each process its own SHARD_IDS; all processes share the same database file.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS'))
+if SHARD_IDS is not None and SHARD_COUNT is None:
+    raise ValueError("SHARD_COUNT must be set when SHARD_IDS is set.")
+
+def parse_promotion_tiers(value):
+    """Parse 'Role:days:hours[:window days],...' into a list of
+    (role name, membership days, online hours, window days or None) tuples."""
+    tiers = []
+    for entry in value.split(','):
+        name, days, hours, *window = entry.split(':')
+        tiers.append((name.strip(), float(days), float(hours), float(window[0]) if window else None))
+    return tiers
+
+# Role promotion tiers: members get a tier's role once they have been in the guild for
+# the given number of days and online for the given number of hours, in total or, if a
+# window is given, within the last that many days (e.g. 'Regular:7:10:7')
+PROMOTION_TIERS = parse_promotion_tiers(os.getenv('PROMOTION_TIERS', 'Veteran:30:100,Elite:60:200'))
+# Role changes and DMs from the action journal applied at once, and attempts at each before giving up
+JOURNAL_CONCURRENCY = int(os.getenv('JOURNAL_CONCURRENCY', '4'))
+JOURNAL_MAX_ATTEMPTS = int(os.getenv('JOURNAL_MAX_ATTEMPTS', '8'))
+# Days hourly, daily and weekly presence rollups are kept once rolled up into the next
+# coarser period; windowed queries use the finest period that still reaches back far enough
+PRESENCE_HOURLY_RETENTION_DAYS = float(os.getenv('PRESENCE_HOURLY_RETENTION_DAYS', '8'))
+PRESENCE_DAILY_RETENTION_DAYS = float(os.getenv('PRESENCE_DAILY_RETENTION_DAYS', '92'))
+PRESENCE_WEEKLY_RETENTION_DAYS = float(os.getenv('PRESENCE_WEEKLY_RETENTION_DAYS', '730'))
+# Days a member's data is kept after they leave a guild, in case they come back
+DEPARTED_RETENTION_DAYS = float(os.getenv('DEPARTED_RETENTION_DAYS', '30'))
+# Seconds over which admin notifications are collected into a single summary DM
+ADMIN_DIGEST_INTERVAL = float(os.getenv('ADMIN_DIGEST_INTERVAL', '300'))
+# Days admin notifications are kept for !vip_audit
+ADMIN_NOTIFICATION_RETENTION_DAYS = float(os.getenv('ADMIN_NOTIFICATION_RETENTION_DAYS', '90'))
+
+def parse_event_settings(value):
+    """Parse 'event:number,...' into a mapping of log event type to number."""
+    settings = {}
+    for entry in filter(None, value.split(',')):
+        event, number = entry.split(':')
+        settings[event.strip()] = float(number)
+    return settings
+
+# Log files: JSON lines, rotated once a file reaches LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old files
+LOG_DIR = os.getenv('LOG_DIR', '.')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+# Fraction of INFO records kept, and most records per second, for high-volume log event types
+LOG_SAMPLE_RATES = parse_event_settings(os.getenv('LOG_SAMPLE_RATES', 'presence_online:0.1,presence_offline:0.1'))
+LOG_RATE_LIMITS = parse_event_settings(os.getenv('LOG_RATE_LIMITS', 'presence_online:20,presence_offline:20'))
+
+# How the member cache is filled: 'startup' downloads every guild's member list before the
+# bot is ready; 'lazy' starts with the members Discord sends on connect (the online ones in
+# large guilds) and fetches others only when a command, VIP expiry or promotion needs them
+MEMBER_CHUNKING = os.getenv('MEMBER_CHUNKING', 'startup')
+if MEMBER_CHUNKING not in ('startup', 'lazy'):
+    raise ValueError("MEMBER_CHUNKING must be 'startup' or 'lazy'.")
+
+# Snapshot of the in-memory caches, written on shutdown and every SNAPSHOT_INTERVAL seconds
+# and read back at startup instead of rebuilding them from the database; processes running
+# only some shards add their shard IDs to the file name. Set SNAPSHOT_PATH to '' to turn
+# snapshots off, or SNAPSHOT_INTERVAL to 0 to write one only on shutdown
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'bot_snapshot.bin')
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '900'))
+
+# Address to serve Prometheus metrics on; set METRICS_PORT to 0 to turn the endpoint off
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
 
 # Setup intents
 intents = discord.Intents.default()
@@ -32,6 +107,11 @@ intents.guilds = True
 intents.members = True
 intents.message_content = True  # Ensure the message content intent is enabled
 
+# Cached members keep their join date (membership tiers need it) but not their voice state,
+# which the bot never reads
+member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+member_cache_flags.voice = False
+
 # Function to get the bot's prefix (now accepts bot and message parameters)
 def get_prefix(bot, message):
     return '!'
@@ -1,208 +1,628 @@
+import asyncio
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial, wraps
+from metrics import DB_CALL_LATENCY, DB_CALL_ERRORS
+from migrations import migrate, GUILD_SCOPED_TABLES, UNSCOPED_GUILD_ID, CHANGE_COUNTERS
 
 DATABASE = 'bot_data.db'
 
-def init_db():
-    """Initialize the database with both VIP and tag tables."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    
-    # Create VIP Subscriptions Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            user_id INTEGER PRIMARY KEY,
-            expiry_date TEXT
-        )
-    ''')
-
-    # Create User Tags Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_tags (
-            user_id INTEGER,
-            tag TEXT,
-            UNIQUE(user_id, tag)
-        )
-    ''')
-
-    # Create Role-Based Rules Table for Tags
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS tag_role_rules (
-            tag TEXT PRIMARY KEY,
-            roles TEXT  -- A comma-separated string of roles allowed to manage the tag
-        )
-    ''')
-
-    # Create User Presence Table to track total online time
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_presence (
-            user_id INTEGER PRIMARY KEY,
-            total_presence REAL  -- Total online presence in seconds
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
+# All database work runs on a single dedicated thread that owns one long-lived
+# connection, so SQLite I/O never blocks the event loop and writes are serialized.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+_conn = None
+
+
+def _get_connection():
+    """Return the shared connection, opening it in WAL mode on first use (database thread only)."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DATABASE)
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute('PRAGMA synchronous=NORMAL')
+        _conn.execute('PRAGMA busy_timeout=5000')
+    return _conn
+
+
+def _close_connection():
+    """Close the shared connection (database thread only)."""
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+
+def db_call(func):
+    """Decorator that runs a blocking database function on the database thread.
+
+    The wrapped function receives the shared connection as its first argument;
+    callers await it with the remaining arguments. Each call's duration, including
+    time spent waiting for the database thread, is recorded per function.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(_executor, partial(_call, func, *args, **kwargs))
+        except Exception:
+            DB_CALL_ERRORS.inc(function=name)
+            raise
+        finally:
+            DB_CALL_LATENCY.observe(time.perf_counter() - start, function=name)
+    return wrapper
+
+
+def _call(func, *args, **kwargs):
+    return func(_get_connection(), *args, **kwargs)
+
+
+async def close_db():
+    """Close the shared connection; the next database call reopens it."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, _close_connection)
+
+
+@db_call
+def init_db(conn):
+    """Bring the database schema up to date by applying any pending migrations."""
+    migrate(conn)
+
+
+@db_call
+def has_unscoped_rows(conn):
+    """Checks whether any rows from the single-guild schema still need a guild."""
+    return any(conn.execute(f'SELECT 1 FROM {table} WHERE guild_id = ? LIMIT 1', (UNSCOPED_GUILD_ID,)).fetchone()
+               for table in GUILD_SCOPED_TABLES)
+
+
+@db_call
+def assign_unscoped_rows(conn, guild_id):
+    """Attributes every row from the single-guild schema to the given guild."""
+    with conn:
+        for table in GUILD_SCOPED_TABLES:
+            conn.execute(f'UPDATE {table} SET guild_id = ? WHERE guild_id = ?', (guild_id, UNSCOPED_GUILD_ID))
+        _bump_change_counters(conn, *CHANGE_COUNTERS)
+
+
+def _bump_change_counters(conn, *names):
+    """Marks the in-memory caches built from the tables a transaction writes to as changed, so
+    snapshots of them taken before are no longer used. Called inside that transaction."""
+    conn.execute(f'UPDATE change_counters SET value = value + 1 WHERE name IN ({", ".join("?" * len(names))})',
+                 names)
+
+@db_call
+def get_change_counters(conn):
+    """The schema version and the change counter of each in-memory cache, as (version, {name: value})."""
+    with conn:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        counters = dict(conn.execute('SELECT name, value FROM change_counters'))
+    return version, counters
 
 
 # -------------------------------
 # VIP Subscription Functions
 # -------------------------------
 
-def add_subscription(user_id, expiry_date):
-    """Adds or updates a VIP subscription for a user."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('REPLACE INTO subscriptions (user_id, expiry_date) VALUES (?, ?)', (user_id, expiry_date))
-    conn.commit()
-    conn.close()
-
-def get_subscription(user_id):
-    """Gets the VIP subscription for a specific user."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT expiry_date FROM subscriptions WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
+@db_call
+def add_subscription(conn, guild_id, user_id, expires_at, actions=()):
+    """Adds or updates a VIP subscription for a user, ending at the given Unix timestamp.
+
+    Any journal actions given are recorded in the same transaction.
+    """
+    with conn:
+        conn.execute('REPLACE INTO subscriptions (guild_id, user_id, expires_at) VALUES (?, ?, ?)',
+                     (guild_id, user_id, int(expires_at)))
+        _bump_change_counters(conn, 'subscriptions')
+        _insert_actions(conn, actions)
+
+@db_call
+def get_subscription(conn, guild_id, user_id):
+    """Gets the Unix timestamp a user's VIP subscription ends at, or None."""
+    result = conn.execute('SELECT expires_at FROM subscriptions WHERE guild_id = ? AND user_id = ?',
+                          (guild_id, user_id)).fetchone()
     return result[0] if result else None
 
-def remove_subscription(user_id):
-    """Removes a VIP subscription for a user."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
-
-def get_vip_status():
-    """Gets the VIP status (active and expired VIPs)."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT user_id, expiry_date FROM subscriptions')
-    subscriptions = c.fetchall()
-    conn.close()
-
-    now = datetime.now()
-    active_vips = []
-    expired_vips = []
-
-    for user_id, expiry_date_str in subscriptions:
-        expiry_date = datetime.fromisoformat(expiry_date_str)
-        if expiry_date > now:
-            active_vips.append(user_id)
+@db_call
+def get_all_subscriptions(conn):
+    """Gets every VIP subscription as a mapping of (guild_id, user_id) to its expiry Unix timestamp."""
+    return {(guild_id, user_id): expires_at
+            for guild_id, user_id, expires_at in conn.execute('SELECT guild_id, user_id, expires_at FROM subscriptions')}
+
+@db_call
+def remove_subscription(conn, guild_id, user_id, actions=()):
+    """Removes a VIP subscription for a user, recording any journal actions given in the same transaction."""
+    with conn:
+        conn.execute('DELETE FROM subscriptions WHERE guild_id = ? AND user_id = ?', (guild_id, user_id))
+        _bump_change_counters(conn, 'subscriptions')
+        _insert_actions(conn, actions)
+
+@db_call
+def remove_subscriptions(conn, keys, actions=(), expired_by=None):
+    """Removes several VIP subscriptions, given as (guild_id, user_id) pairs, and records any
+    journal actions given, all in one transaction.
+
+    Given `expired_by`, only subscriptions ending at or before that Unix timestamp are
+    removed, so one renewed meanwhile is kept, and actions for members of `keys` whose
+    subscription was kept are not journaled. Returns the keys removed.
+    """
+    keys = set(keys)
+    with conn:
+        if expired_by is None:
+            conn.executemany('DELETE FROM subscriptions WHERE guild_id = ? AND user_id = ?', list(keys))
+            removed = keys
         else:
-            expired_vips.append(user_id)
+            removed = {key for key in keys
+                       if conn.execute('DELETE FROM subscriptions WHERE guild_id = ? AND user_id = ? AND expires_at <= ?',
+                                       (*key, expired_by)).rowcount}
+            actions = [action for action in actions
+                       if (action[1], action[2]) not in keys or (action[1], action[2]) in removed]
+        _bump_change_counters(conn, 'subscriptions')
+        _insert_actions(conn, actions)
+    return removed
 
+@db_call
+def get_vip_status(conn, guild_id):
+    """Gets the VIP status as (active, expired) lists of (user_id, expires_at) tuples, soonest first."""
+    now = int(datetime.now().timestamp())
+    active_vips = conn.execute('''
+        SELECT user_id, expires_at FROM subscriptions WHERE guild_id = ? AND expires_at > ? ORDER BY expires_at
+    ''', (guild_id, now)).fetchall()
+    expired_vips = conn.execute('''
+        SELECT user_id, expires_at FROM subscriptions WHERE guild_id = ? AND expires_at <= ? ORDER BY expires_at
+    ''', (guild_id, now)).fetchall()
     return active_vips, expired_vips
 
 # -------------------------------
 # Tag Management Functions
 # -------------------------------
 
-def add_tag_to_user(user_id, tag):
+@db_call
+def add_tag_to_user(conn, guild_id, user_id, tag):
     """Adds a tag to a user."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
     try:
-        c.execute('INSERT INTO user_tags (user_id, tag) VALUES (?, ?)', (user_id, tag))
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('INSERT INTO user_tags (guild_id, user_id, tag) VALUES (?, ?, ?)', (guild_id, user_id, tag))
+            _bump_change_counters(conn, 'tags')
         return True
     except sqlite3.IntegrityError:
-        conn.close()
         return False
 
-def remove_tag_from_user(user_id, tag):
+@db_call
+def remove_tag_from_user(conn, guild_id, user_id, tag):
     """Removes a tag from a user."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('DELETE FROM user_tags WHERE user_id = ? AND tag = ?', (user_id, tag))
-    conn.commit()
-    deleted_rows = c.rowcount
-    conn.close()
+    with conn:
+        deleted_rows = conn.execute('DELETE FROM user_tags WHERE guild_id = ? AND user_id = ? AND tag = ?',
+                                    (guild_id, user_id, tag)).rowcount
+        _bump_change_counters(conn, 'tags')
     return deleted_rows > 0
 
-def get_user_tags(user_id):
-    """Gets all tags for a specific user."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT tag FROM user_tags WHERE user_id = ?', (user_id,))
-    tags = [row[0] for row in c.fetchall()]
-    conn.close()
-    return tags
-
-def get_all_tags():
-    """Gets all unique tags."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT DISTINCT tag FROM user_tags')
-    tags = [row[0] for row in c.fetchall()]
-    conn.close()
-    return tags
+@db_call
+def add_tag_to_users(conn, guild_id, user_ids, tag):
+    """Adds a tag to several users in one transaction, skipping users who already have it."""
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO user_tags (guild_id, user_id, tag) VALUES (?, ?, ?)',
+                         [(guild_id, user_id, tag) for user_id in user_ids])
+        _bump_change_counters(conn, 'tags')
+
+@db_call
+def remove_tag_from_users(conn, guild_id, user_ids, tag):
+    """Removes a tag from several users in one transaction."""
+    with conn:
+        conn.executemany('DELETE FROM user_tags WHERE guild_id = ? AND user_id = ? AND tag = ?',
+                         [(guild_id, user_id, tag) for user_id in user_ids])
+        _bump_change_counters(conn, 'tags')
+
+@db_call
+def get_all_user_tags(conn):
+    """Gets every (guild_id, user_id, tag) assignment."""
+    return conn.execute('SELECT guild_id, user_id, tag FROM user_tags').fetchall()
 
 # -------------------------------
 # Role-Based Tag Rules Functions
 # -------------------------------
 
-def get_tag_roles(tag):
-    """Get roles allowed to manage a specific tag."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT roles FROM tag_role_rules WHERE tag = ?', (tag,))
-    result = c.fetchone()
-    conn.close()
-    
-    if result:
-        return result[0].split(',')  # Split the roles by comma
-    else:
-        return ["Survivor"]  # Default role is 'Survivor'
-
-def set_tag_roles(tag, roles):
-    """Set roles allowed to manage a specific tag."""
-    roles_str = ','.join(roles)  # Store roles as a comma-separated string
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('REPLACE INTO tag_role_rules (tag, roles) VALUES (?, ?)', (tag, roles_str))
-    conn.commit()
-    conn.close()
-
-def get_all_tag_role_rules():
-    """Get all tag-role rules."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT tag, roles FROM tag_role_rules')
-    rules = {row[0]: row[1].split(',') for row in c.fetchall()}  # Convert comma-separated roles to list
-    conn.close()
+# Stored as a tag's only role ID for a rule that lets no role manage the tag; no Discord ID is 0
+NOBODY_ROLE_ID = 0
+
+@db_call
+def get_all_tag_role_ids(conn):
+    """Get the role IDs allowed to manage each tag, as a mapping of (guild_id, tag) to frozenset.
+
+    A rule that lets no role manage its tag is an empty frozenset.
+    """
+    rules = {}
+    for guild_id, tag, role_id in conn.execute('SELECT guild_id, tag, role_id FROM tag_role_ids'):
+        role_ids = rules.setdefault((guild_id, tag), set())
+        if role_id != NOBODY_ROLE_ID:
+            role_ids.add(role_id)
+    return {key: frozenset(role_ids) for key, role_ids in rules.items()}
+
+@db_call
+def set_tag_role_ids(conn, guild_id, tag, role_ids):
+    """Replace the role IDs allowed to manage a specific tag; no role IDs means no role may manage it."""
+    with conn:
+        conn.execute('DELETE FROM tag_role_ids WHERE guild_id = ? AND tag = ?', (guild_id, tag))
+        conn.executemany('INSERT INTO tag_role_ids (guild_id, tag, role_id) VALUES (?, ?, ?)',
+                         [(guild_id, tag, role_id) for role_id in role_ids or (NOBODY_ROLE_ID,)])
+        _bump_change_counters(conn, 'tags')
+
+@db_call
+def remove_tag_role_ids(conn, guild_id, tag):
+    """Delete a tag's rule, so the tag falls back to the default role."""
+    with conn:
+        conn.execute('DELETE FROM tag_role_ids WHERE guild_id = ? AND tag = ?', (guild_id, tag))
+        _bump_change_counters(conn, 'tags')
+
+@db_call
+def get_all_tag_role_rules(conn):
+    """Get all legacy name-based tag-role rules as a mapping of tag to role names."""
+    rules = {}
+    for tag, role_name in conn.execute('SELECT tag, role_name FROM tag_role_names'):
+        rules.setdefault(tag, []).append(role_name)
     return rules
 
+@db_call
+def remove_tag_role_rule(conn, tag):
+    """Delete a legacy name-based tag-role rule."""
+    with conn:
+        conn.execute('DELETE FROM tag_role_names WHERE tag = ?', (tag,))
+
+
+# -------------------------------
+# Admin Notification Functions
+# -------------------------------
+
+@db_call
+def add_admin_notification(conn, guild_id, message, urgent, created_at):
+    """Records an admin notification."""
+    with conn:
+        conn.execute('INSERT INTO admin_notifications (guild_id, created_at, message, urgent) VALUES (?, ?, ?, ?)',
+                     (guild_id, created_at, message, int(urgent)))
+
+@db_call
+def get_admin_notifications(conn, guild_id, limit, offset=0):
+    """Gets a page of a guild's admin notifications, newest first, and the total count."""
+    rows = conn.execute('''
+        SELECT created_at, message, urgent FROM admin_notifications
+        WHERE guild_id = ? ORDER BY id DESC LIMIT ? OFFSET ?
+    ''', (guild_id, limit, offset)).fetchall()
+    total = conn.execute('SELECT COUNT(*) FROM admin_notifications WHERE guild_id = ?', (guild_id,)).fetchone()[0]
+    return rows, total
+
+@db_call
+def purge_admin_notifications(conn, created_before, shard_count=None, shard_ids=None):
+    """Deletes admin notifications created before `created_before`, in guilds on the given shards; returns how many."""
+    clause, params = _shard_clause(shard_count, shard_ids)
+    with conn:
+        return conn.execute(f'DELETE FROM admin_notifications WHERE created_at < ?{clause}',
+                            [created_before, *params]).rowcount
+
+
+# -------------------------------
+# Action Journal Functions
+# -------------------------------
+
+def _shard_clause(shard_count, shard_ids):
+    """An ' AND ...' SQL condition and its parameters matching rows whose guild_id is on the given shards.
+
+    Uses Discord's shard formula; matches every row if no shards are given.
+    """
+    if not (shard_count and shard_ids):
+        return '', []
+    return f' AND (guild_id >> 22) % ? IN ({", ".join("?" * len(shard_ids))})', [shard_count, *shard_ids]
+
+def _insert_actions(conn, actions):
+    """Journals actions inside the caller's transaction (database thread only).
+
+    Each action is (idempotency_key, guild_id, user_id, action, role_id, content); role
+    actions may leave the key as None to have it derived from their guild, user and role.
+    A role action replaces a different pending one with the same key, so the latest wanted
+    state of the role wins; a DM whose key is already journaled is not journaled again.
+    """
+    now = time.time()
+    role_actions = [action + (now, now) for action in actions if action[3] != 'dm']
+    dm_actions = [action + (now, now) for action in actions if action[3] == 'dm']
+    conn.executemany('''
+        INSERT INTO action_journal (idempotency_key, guild_id, user_id, action, role_id, content,
+                                    next_attempt_at, created_at)
+        VALUES (COALESCE(?1, 'role:' || ?2 || ':' || ?3 || ':' || ?5), ?2, ?3, ?4, ?5, ?6, ?7, ?8)
+        ON CONFLICT (idempotency_key) DO UPDATE SET
+            action = excluded.action, revision = revision + 1, attempts = 0,
+            next_attempt_at = excluded.next_attempt_at, failed_at = NULL
+        WHERE action != excluded.action OR failed_at IS NOT NULL
+    ''', role_actions)
+    conn.executemany('''
+        INSERT OR IGNORE INTO action_journal (idempotency_key, guild_id, user_id, action, role_id, content,
+                                              next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', dm_actions)
+
+@db_call
+def add_actions(conn, actions):
+    """Journals role changes and DMs to be applied by the action journal workers."""
+    with conn:
+        _insert_actions(conn, actions)
+
+@db_call
+def get_due_actions(conn, now, limit, shard_count=None, shard_ids=None):
+    """Gets up to `limit` journaled actions due by `now`, oldest first, as
+    (id, revision, guild_id, user_id, action, role_id, content, attempts) tuples.
+
+    Given a shard count and shard IDs, only actions for guilds on those shards are returned.
+    """
+    sql = '''
+        SELECT id, revision, guild_id, user_id, action, role_id, content, attempts FROM action_journal
+        WHERE failed_at IS NULL AND next_attempt_at <= ?
+    '''
+    clause, params = _shard_clause(shard_count, shard_ids)
+    return conn.execute(sql + clause + ' ORDER BY id LIMIT ?', [now, *params, limit]).fetchall()
+
+@db_call
+def complete_actions(conn, actions):
+    """Removes finished actions, given as (id, revision) pairs, except any replaced by another while they ran."""
+    with conn:
+        conn.executemany('DELETE FROM action_journal WHERE id = ? AND revision = ?', actions)
+
+@db_call
+def retry_action(conn, action_id, revision, next_attempt_at):
+    """Counts a failed attempt at an action and makes it due again at the given Unix timestamp."""
+    with conn:
+        conn.execute('''
+            UPDATE action_journal SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ? AND revision = ?
+        ''', (next_attempt_at, action_id, revision))
+
+@db_call
+def fail_action(conn, action_id, revision, failed_at):
+    """Marks an action as given up on; it stays in the journal for inspection until replaced."""
+    with conn:
+        conn.execute('''
+            UPDATE action_journal SET attempts = attempts + 1, failed_at = ? WHERE id = ? AND revision = ?
+        ''', (failed_at, action_id, revision))
+
+@db_call
+def count_actions(conn):
+    """Counts journaled actions as (pending, given up on)."""
+    return conn.execute('SELECT COUNT(*) - COUNT(failed_at), COUNT(failed_at) FROM action_journal').fetchone()
+
+@db_call
+def get_job_runs(conn, job):
+    """Gets when a periodic job last ran for each guild, as a mapping of guild_id to Unix timestamp."""
+    return dict(conn.execute('SELECT guild_id, last_run_at FROM guild_jobs WHERE job = ?', (job,)))
+
+@db_call
+def set_job_run(conn, job, guild_ids, ran_at):
+    """Records that a periodic job ran for the given guilds at the given Unix timestamp."""
+    with conn:
+        conn.executemany('REPLACE INTO guild_jobs (guild_id, job, last_run_at) VALUES (?, ?, ?)',
+                         [(guild_id, job, ran_at) for guild_id in guild_ids])
+
+# -------------------------------
+# Departed Member Functions
+# -------------------------------
+
+@db_call
+def mark_member_departed(conn, guild_id, user_id, left_at):
+    """Records that a member left a guild at the given Unix timestamp."""
+    with conn:
+        conn.execute('REPLACE INTO departed_members (guild_id, user_id, left_at) VALUES (?, ?, ?)',
+                     (guild_id, user_id, left_at))
+
+@db_call
+def clear_member_departed(conn, guild_id, user_id):
+    """Forgets that a member left a guild, e.g. because they rejoined."""
+    with conn:
+        conn.execute('DELETE FROM departed_members WHERE guild_id = ? AND user_id = ?', (guild_id, user_id))
+
+@db_call
+def get_member_records(conn, guild_id):
+    """Gets who a guild's stored data is about, to compare with its member list.
+
+    Returns (IDs of users with tags, presence, an open session or a subscription,
+    mapping of departed user_id to when they left, mapping of subscribed user_id to
+    expiry Unix timestamp).
+    """
+    stored = {user_id for (user_id,) in conn.execute('''
+        SELECT user_id FROM user_tags WHERE guild_id = ?
+        UNION SELECT user_id FROM user_presence WHERE guild_id = ?
+        UNION SELECT user_id FROM open_sessions WHERE guild_id = ?
+        UNION SELECT user_id FROM subscriptions WHERE guild_id = ?
+    ''', (guild_id,) * 4)}
+    departed = dict(conn.execute('SELECT user_id, left_at FROM departed_members WHERE guild_id = ?', (guild_id,)))
+    subscriptions = dict(conn.execute('SELECT user_id, expires_at FROM subscriptions WHERE guild_id = ?', (guild_id,)))
+    return stored, departed, subscriptions
+
+@db_call
+def update_departed_members(conn, guild_id, departed_ids, returned_ids, left_at):
+    """Records members who left a guild at `left_at` and forgets the departure of ones who came back.
+
+    Members already recorded as departed keep their original departure time.
+    """
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO departed_members (guild_id, user_id, left_at) VALUES (?, ?, ?)',
+                         [(guild_id, user_id, left_at) for user_id in departed_ids])
+        conn.executemany('DELETE FROM departed_members WHERE guild_id = ? AND user_id = ?',
+                         [(guild_id, user_id) for user_id in returned_ids])
+
+@db_call
+def purge_departed_members(conn, left_before, now, shard_count=None, shard_ids=None, limit=1000):
+    """Deletes the data of up to `limit` members who left before `left_before`, in one transaction.
+
+    Tags, presence totals and rollups, open sessions, expired subscriptions and pending journal
+    actions are deleted. Subscriptions still running at `now` are kept, so a member who
+    comes back before theirs ends is still VIP. Given a shard count and shard IDs, only
+    members of guilds on those shards are purged. Returns the purged (guild_id, user_id) pairs.
+    """
+    clause, params = _shard_clause(shard_count, shard_ids)
+    with conn:
+        keys = conn.execute(f'SELECT guild_id, user_id FROM departed_members WHERE left_at < ?{clause} LIMIT ?',
+                            [left_before, *params, limit]).fetchall()
+        if not keys:
+            return []
+        for table in ('user_tags', 'user_presence', 'presence_rollups', 'open_sessions', 'departed_members'):
+            conn.executemany(f'DELETE FROM {table} WHERE guild_id = ? AND user_id = ?', keys)
+        conn.executemany('DELETE FROM subscriptions WHERE guild_id = ? AND user_id = ? AND expires_at <= ?',
+                         [key + (now,) for key in keys])
+        _bump_change_counters(conn, *CHANGE_COUNTERS)
+        # The journal isn't indexed by member, so match every key in a single scan
+        conn.execute(f'''
+            DELETE FROM action_journal WHERE failed_at IS NULL
+            AND (guild_id, user_id) IN (VALUES {", ".join(["(?, ?)"] * len(keys))})
+        ''', [value for key in keys for value in key])
+    return keys
 
 # -------------------------------
 # User Presence Functions
 # -------------------------------
-def store_user_presence(user_id, presence_duration):
-    """Stores the total online presence of a user."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    # Check if the user already has some recorded presence
-    c.execute('SELECT total_presence FROM user_presence WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    
-    if result:
-        total_presence = result[0] + presence_duration
-        c.execute('UPDATE user_presence SET total_presence = ? WHERE user_id = ?', (total_presence, user_id))
-    else:
-        total_presence = presence_duration
-        c.execute('INSERT INTO user_presence (user_id, total_presence) VALUES (?, ?)', (user_id, total_presence))
-
-    conn.commit()
-    conn.close()
-
-def get_user_total_presence(user_id):
+
+_UPSERT_PRESENCE = '''
+    INSERT INTO user_presence (guild_id, user_id, total_presence) VALUES (?, ?, ?)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET total_presence = total_presence + excluded.total_presence
+'''
+
+@db_call
+def store_user_presence_batch(conn, presence_durations):
+    """Adds several users' online durations ({(guild_id, user_id): seconds}) in one transaction."""
+    with conn:
+        conn.executemany(_UPSERT_PRESENCE, [(guild_id, user_id, duration)
+                                            for (guild_id, user_id), duration in presence_durations.items()])
+        _bump_change_counters(conn, 'presence')
+
+@db_call
+def save_presence_checkpoint(conn, presence_durations, opened_sessions, closed_sessions, checkpointed_at,
+                             hourly_presence=None, guild_ids=()):
+    """Atomically adds online durations and applies changes to the open sessions checkpoint.
+
+    All arguments are keyed by (guild_id, user_id): presence_durations maps them to
+    seconds online, opened_sessions to the Unix timestamp the session started, and
+    closed_sessions is an iterable of the keys whose session has ended. hourly_presence
+    maps (guild_id, user_id, hour bucket start) to seconds online in that hour.
+    guild_ids are the guilds whose open sessions are all checkpointed as of `checkpointed_at`.
+    """
+    with conn:
+        conn.executemany(_UPSERT_PRESENCE, [(guild_id, user_id, duration)
+                                            for (guild_id, user_id), duration in presence_durations.items()])
+        conn.executemany(_UPSERT_ROLLUP, [(guild_id, user_id, HOUR, hour, seconds)
+                                          for (guild_id, user_id, hour), seconds in (hourly_presence or {}).items()])
+        conn.executemany('REPLACE INTO open_sessions (guild_id, user_id, started_at) VALUES (?, ?, ?)',
+                         [(guild_id, user_id, started_at) for (guild_id, user_id), started_at in opened_sessions.items()])
+        conn.executemany('DELETE FROM open_sessions WHERE guild_id = ? AND user_id = ?', list(closed_sessions))
+        conn.executemany('REPLACE INTO guild_session_checkpoints (guild_id, checkpointed_at) VALUES (?, ?)',
+                         [(guild_id, checkpointed_at) for guild_id in guild_ids])
+        _bump_change_counters(conn, 'presence')
+
+@db_call
+def get_open_sessions(conn):
+    """Gets the checkpointed open sessions ({(guild_id, user_id): started_at}) and the time of each
+    guild's last checkpoint ({guild_id: checkpointed_at})."""
+    sessions = {(guild_id, user_id): started_at
+                for guild_id, user_id, started_at in conn.execute('SELECT guild_id, user_id, started_at FROM open_sessions')}
+    return sessions, dict(conn.execute('SELECT guild_id, checkpointed_at FROM guild_session_checkpoints'))
+
+@db_call
+def get_user_total_presence(conn, guild_id, user_id):
     """Get the total online presence of a user."""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    c.execute('SELECT total_presence FROM user_presence WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    
+    result = conn.execute('SELECT total_presence FROM user_presence WHERE guild_id = ? AND user_id = ?',
+                          (guild_id, user_id)).fetchone()
     return result[0] if result else 0
+
+@db_call
+def get_all_user_presence(conn, guild_id):
+    """Get the total online presence of every user in a guild as a mapping of user ID to seconds."""
+    return dict(conn.execute('SELECT user_id, total_presence FROM user_presence WHERE guild_id = ?', (guild_id,)))
+
+@db_call
+def get_all_presence_totals(conn):
+    """Get the total online presence of every user in every guild as (guild_id, user_id, seconds) rows."""
+    return conn.execute('SELECT guild_id, user_id, total_presence FROM user_presence').fetchall()
+
+# -------------------------------
+# Presence Rollup Functions
+# -------------------------------
+
+HOUR = 3600
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+# The Unix epoch fell on a Thursday; weeks are counted from the Monday after it
+_WEEK_ORIGIN = 4 * DAY
+
+# SQL for the start of the bucket of a given period that a row's bucket_start falls in
+_BUCKET_START_SQL = {
+    DAY: f'bucket_start - bucket_start % {DAY}',
+    WEEK: f'bucket_start - (bucket_start - {_WEEK_ORIGIN}) % {WEEK}',
+}
+
+_UPSERT_ROLLUP = '''
+    INSERT INTO presence_rollups (guild_id, user_id, period, bucket_start, rolled_up, seconds) VALUES (?, ?, ?, ?, 0, ?)
+    ON CONFLICT(guild_id, user_id, period, bucket_start, rolled_up) DO UPDATE SET seconds = seconds + excluded.seconds
+'''
+
+def bucket_start(period, timestamp):
+    """The Unix timestamp the bucket of the given period containing `timestamp` starts at."""
+    origin = _WEEK_ORIGIN if period == WEEK else 0
+    return int((timestamp - origin) // period * period + origin)
+
+def _window_clause(period, since):
+    """A SQL condition and its parameters matching the rollup rows that make up the time since `since`.
+
+    Rows of `period` from the bucket containing `since` on are counted, along with the
+    finer rows that haven't been rolled up into them yet, so no second is counted twice.
+    """
+    return ('(period = ? OR period < ? AND rolled_up = 0) AND bucket_start >= ?',
+            [period, period, bucket_start(period, since)])
+
+@db_call
+def get_presence_since(conn, guild_id, user_id, period, since):
+    """A user's online seconds since the Unix timestamp `since`, to the nearest bucket of `period`."""
+    clause, params = _window_clause(period, since)
+    result = conn.execute(f'SELECT SUM(seconds) FROM presence_rollups WHERE guild_id = ? AND user_id = ? AND {clause}',
+                          [guild_id, user_id, *params]).fetchone()
+    return result[0] or 0
+
+@db_call
+def get_guild_presence_since(conn, guild_id, period, since):
+    """Every user's online seconds in a guild since `since` as a mapping of user ID to seconds; see get_presence_since."""
+    clause, params = _window_clause(period, since)
+    return dict(conn.execute(f'SELECT user_id, SUM(seconds) FROM presence_rollups WHERE guild_id = ? AND {clause} '
+                             'GROUP BY user_id', [guild_id, *params]))
+
+@db_call
+def roll_up_presence(conn, now, retention, shard_count=None, shard_ids=None):
+    """Adds finished hourly buckets into daily ones and daily into weekly ones, then applies `retention`.
+
+    `retention` maps each period to the seconds its buckets are kept once rolled up;
+    time that hasn't been rolled up yet is never deleted. Each step runs in its own
+    transaction. Given a shard count and shard IDs, only guilds on those shards are
+    touched. Returns the number of buckets rolled up.
+    """
+    clause, params = _shard_clause(shard_count, shard_ids)
+    rolled = 0
+    for period, coarser in ((HOUR, DAY), (DAY, WEEK)):
+        pending = f'WHERE period = ? AND rolled_up = 0 AND bucket_start < ?{clause}'
+        pending_params = [period, bucket_start(period, now), *params]
+        with conn:
+            conn.execute(f'''
+                INSERT INTO presence_rollups (guild_id, user_id, period, bucket_start, rolled_up, seconds)
+                SELECT guild_id, user_id, ?, {_BUCKET_START_SQL[coarser]}, 0, SUM(seconds) FROM presence_rollups
+                {pending} GROUP BY guild_id, user_id, {_BUCKET_START_SQL[coarser]}
+                ON CONFLICT(guild_id, user_id, period, bucket_start, rolled_up) DO UPDATE
+                SET seconds = seconds + excluded.seconds
+            ''', [coarser, *pending_params])
+            # Time that reached a bucket after it was rolled up has a row of its own until now
+            conn.execute(f'''
+                INSERT INTO presence_rollups (guild_id, user_id, period, bucket_start, rolled_up, seconds)
+                SELECT guild_id, user_id, period, bucket_start, 1, seconds FROM presence_rollups {pending}
+                ON CONFLICT(guild_id, user_id, period, bucket_start, rolled_up) DO UPDATE
+                SET seconds = seconds + excluded.seconds
+            ''', pending_params)
+            rolled += conn.execute(f'DELETE FROM presence_rollups {pending}', pending_params).rowcount
+    with conn:
+        for period, kept_for in retention.items():
+            # Weekly buckets are never rolled up any further
+            conn.execute(f'DELETE FROM presence_rollups WHERE period = ? AND rolled_up = ? AND bucket_start < ?{clause}',
+                         [period, int(period != WEEK), now - kept_for, *params])
+    return rolled
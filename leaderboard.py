@@ -0,0 +1,160 @@
+# leaderboard.py
+
+from bisect import bisect_left, insort
+
+# Entries per block of a RankedScores; blocks are split at twice this size
+BLOCK_SIZE = 512
+
+
+class RankedScores:
+    """Users ordered by score, highest first, with O(log n) updates, ranks and top-k.
+
+    Entries are (-score, user_id) tuples kept in sorted blocks of at most
+    2 * BLOCK_SIZE, like a B-tree with one level: a bisect over the blocks' last
+    entries finds the block, a bisect within it finds the entry, and a Fenwick tree
+    over the block sizes counts the entries before it. Ties go to the lower user ID.
+    """
+
+    def __init__(self, scores=None):
+        self.scores = dict(scores or {})  # user_id -> score
+        entries = sorted((-score, user_id) for user_id, score in self.scores.items())
+        self.blocks = [entries[i:i + BLOCK_SIZE] for i in range(0, len(entries), BLOCK_SIZE)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self._rebuild_counts()
+
+    def __len__(self):
+        return len(self.scores)
+
+    def set(self, user_id, score):
+        """Sets a user's score."""
+        old = self.scores.get(user_id)
+        if old is not None:
+            self._remove((-old, user_id))
+        self.scores[user_id] = score
+        self._insert((-score, user_id))
+
+    def add(self, user_id, amount):
+        """Adds to a user's score, starting from 0."""
+        self.set(user_id, self.scores.get(user_id, 0) + amount)
+
+    def discard(self, user_id):
+        """Drops a user."""
+        score = self.scores.pop(user_id, None)
+        if score is not None:
+            self._remove((-score, user_id))
+
+    def rank(self, user_id):
+        """A user's 1-based rank, or None if they have no score."""
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        entry = (-score, user_id)
+        i = bisect_left(self.maxes, entry)
+        return self._count_before(i) + bisect_left(self.blocks[i], entry) + 1
+
+    def top(self, count, offset=0):
+        """The (user_id, score) pairs ranked offset + 1 to offset + count."""
+        result = []
+        skip = offset
+        for block in self.blocks:
+            if skip >= len(block):
+                skip -= len(block)
+                continue
+            for negated_score, user_id in block[skip:skip + count - len(result)]:
+                result.append((user_id, -negated_score))
+            skip = 0
+            if len(result) >= count:
+                break
+        return result
+
+    def _insert(self, entry):
+        if not self.blocks:
+            self.blocks.append([entry])
+            self.maxes.append(entry)
+            self._rebuild_counts()
+            return
+        i = min(bisect_left(self.maxes, entry), len(self.blocks) - 1)
+        block = self.blocks[i]
+        insort(block, entry)
+        self.maxes[i] = block[-1]
+        if len(block) > 2 * BLOCK_SIZE:
+            self.blocks[i:i + 1] = [block[:BLOCK_SIZE], block[BLOCK_SIZE:]]
+            self.maxes[i:i + 1] = [block[BLOCK_SIZE - 1], block[-1]]
+            self._rebuild_counts()
+        else:
+            self._add_count(i, 1)
+
+    def _remove(self, entry):
+        i = bisect_left(self.maxes, entry)
+        block = self.blocks[i]
+        del block[bisect_left(block, entry)]
+        if block:
+            self.maxes[i] = block[-1]
+            self._add_count(i, -1)
+        else:
+            del self.blocks[i]
+            del self.maxes[i]
+            self._rebuild_counts()
+
+    # Fenwick tree over block sizes; rebuilt when blocks are split or dropped, which is rare
+
+    def _rebuild_counts(self):
+        self.counts = [0] * (len(self.blocks) + 1)
+        for i, block in enumerate(self.blocks):
+            self._add_count(i, len(block))
+
+    def _add_count(self, i, delta):
+        i += 1
+        while i < len(self.counts):
+            self.counts[i] += delta
+            i += i & -i
+
+    def _count_before(self, i):
+        total = 0
+        while i > 0:
+            total += self.counts[i]
+            i -= i & -i
+        return total
+
+
+class Leaderboard:
+    """Presence totals ranked per guild, kept in memory so rankings never query the database.
+
+    Loaded once at startup from user_presence; afterwards the presence cog adds each
+    closed session as it buffers it, so rankings include time not yet flushed.
+    """
+
+    def __init__(self):
+        self.guilds = {}  # guild_id -> RankedScores
+
+    def load(self, totals):
+        """Builds the rankings from (guild_id, user_id, total_presence) rows."""
+        by_guild = {}
+        for guild_id, user_id, total in totals:
+            by_guild.setdefault(guild_id, {})[user_id] = total
+        self.guilds = {guild_id: RankedScores(scores) for guild_id, scores in by_guild.items()}
+
+    def add(self, guild_id, user_id, seconds):
+        """Adds online time to a member's total."""
+        ranked = self.guilds.get(guild_id)
+        if ranked is None:
+            ranked = self.guilds[guild_id] = RankedScores()
+        ranked.add(user_id, seconds)
+
+    def rank(self, guild_id, user_id):
+        """A member's (rank, number of ranked members), or None if they have no online time."""
+        ranked = self.guilds.get(guild_id)
+        rank = ranked.rank(user_id) if ranked else None
+        return (rank, len(ranked)) if rank else None
+
+    def top(self, guild_id, count, offset=0):
+        """The (user_id, seconds) pairs of a guild's most active members, from rank offset + 1."""
+        ranked = self.guilds.get(guild_id)
+        return ranked.top(count, offset) if ranked else []
+
+    def forget_users(self, keys):
+        """Drops (guild_id, user_id) pairs, e.g. members whose data was purged."""
+        for guild_id, user_id in keys:
+            ranked = self.guilds.get(guild_id)
+            if ranked:
+                ranked.discard(user_id)
@@ -0,0 +1,145 @@
+# log_pipeline.py
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from datetime import datetime, timezone
+
+# Logging pipeline: loggers hand records to a QueueHandler, which only samples and
+# enqueues them on the event loop; a QueueListener thread formats them as JSON
+# lines and writes them to size-rotated files.
+#
+# Hot-path log calls tag their records with an event type, e.g.
+#     logger.info("User %s went online", member.id, extra={'event': 'presence_online', 'user_id': member.id})
+# so INFO records of that type can be sampled and rate limited. Warnings and
+# errors are never dropped.
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'event'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, including any `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'event', None):
+            entry['event'] = record.event
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Samples and rate limits INFO and lower records by their `event` type.
+
+    sample_rates maps an event type to the fraction of its records kept, spread
+    evenly rather than at random. rate_limits maps an event type to the most
+    records per second let through. Each kept record carries the sample rate and
+    how many records of its type were dropped since the last one that was kept.
+    """
+
+    def __init__(self, sample_rates=None, rate_limits=None):
+        super().__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.rate_limits = dict(rate_limits or {})
+        self.sample_credit = {}  # event -> accumulated fraction of a record to keep
+        self.tokens = {}  # event -> (tokens left, time last refilled)
+        self.dropped = {}  # event -> records dropped since the last kept one
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno >= logging.WARNING:
+            return True
+
+        sample_rate = self.sample_rates.get(event)
+        if sample_rate is not None:
+            credit = self.sample_credit.get(event, 1.0) + sample_rate
+            if credit < 1.0:
+                self.sample_credit[event] = credit
+                return self._drop(event)
+            self.sample_credit[event] = credit - 1.0
+            record.sample_rate = sample_rate
+
+        limit = self.rate_limits.get(event)
+        if limit is not None:
+            now = time.monotonic()
+            tokens, refilled_at = self.tokens.get(event, (limit, now))
+            tokens = min(limit, tokens + (now - refilled_at) * limit)
+            if tokens < 1:
+                self.tokens[event] = (tokens, now)
+                return self._drop(event)
+            self.tokens[event] = (tokens - 1, now)
+
+        dropped = self.dropped.pop(event, 0)
+        if dropped:
+            record.dropped = dropped
+        return True
+
+    def _drop(self, event):
+        self.dropped[event] = self.dropped.get(event, 0) + 1
+        return False
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    The stock prepare() formats the message on the calling thread; records here
+    are only handed to a thread in the same process, so they can go as they are.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def _only(names):
+    return lambda record: record.name in names
+
+
+def _except(names):
+    return lambda record: record.name not in names
+
+
+def configure_logging(log_files, default_file, log_dir='.', max_bytes=10 * 1024 * 1024, backup_count=5,
+                      sample_rates=None, rate_limits=None, level=logging.INFO):
+    """Routes all logging through a queue to rotating JSON files and returns the started listener.
+
+    log_files maps logger names to their own file; every other logger writes to
+    default_file. Stop the returned listener on shutdown to flush what is queued.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    formatter = JSONFormatter()
+    handlers = []
+    for filename, record_filter in ([(default_file, _except(set(log_files)))]
+                                    + [(filename, _only({name})) for name, filename in log_files.items()]):
+        handler = logging.handlers.RotatingFileHandler(os.path.join(log_dir, filename), maxBytes=max_bytes,
+                                                       backupCount=backup_count, encoding='utf-8')
+        handler.setFormatter(formatter)
+        handler.addFilter(record_filter)
+        handlers.append(handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rates, rate_limits))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
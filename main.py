@@ -1,10 +1,20 @@
 # main.py
 
 import asyncio
+import logging
+import os
+import time
+import discord
 from discord.ext import commands
-from config import TOKEN, intents, get_prefix
-from db import init_db
+from config import (TOKEN, GUILD, SHARD_COUNT, SHARD_IDS, METRICS_HOST, METRICS_PORT, LOG_DIR, LOG_MAX_BYTES,
+                    LOG_BACKUP_COUNT, LOG_SAMPLE_RATES, LOG_RATE_LIMITS, MEMBER_CHUNKING, SNAPSHOT_PATH, SNAPSHOT_INTERVAL,
+                    intents, member_cache_flags, get_prefix)
+from db import init_db, close_db, has_unscoped_rows, assign_unscoped_rows, get_all_tag_role_rules
 from messaging import Messaging
+from action_journal import ActionJournal
+from metrics import LoopLagMonitor, MetricsServer, START_TIME, READY_SECONDS, CACHED_MEMBERS, PEAK_RSS, peak_rss
+from log_pipeline import configure_logging
+from snapshot import SnapshotWriter, load_snapshot
 from vip_manager import VIPManager
 from cogs.vip_management import VIPManagement
 from cogs.event_handlers import EventHandlers
@@ -12,36 +22,163 @@ from cogs.error_handler import ErrorHandler
 from cogs.tag_management import TagManagement
 from help_command import MyHelpCommand
 from cogs.user_status import UserStatus
+from cogs.stats import Stats
 
+# Log files by logger name; everything else goes to bot.log
+LOG_FILES = {
+    'cogs.user_status': 'user_status.log',
+    'cogs.tag_management': 'tag_permissions.log',
+    'cogs.vip_management': 'bot_permissions.log',
+}
 
-class MyBot(commands.Bot):
-    """Custom bot class for initializing and running the Discord bot."""
+
+class MyBot(commands.AutoShardedBot):
+    """Custom bot class for initializing and running the Discord bot.
+
+    Runs every shard given by SHARD_IDS (or all shards) in this process. Several
+    processes can each run a subset of the shards against the same database.
+
+    With MEMBER_CHUNKING=lazy, guild member lists aren't downloaded before the bot
+    is ready; raw presence updates are turned on so members missing from the cache
+    still have their online time tracked.
+
+    The VIP expiry heap, tag index and presence state are restored from the snapshot
+    at SNAPSHOT_PATH when it is still current, and written back to it periodically
+    and on shutdown.
+    """
 
     def __init__(self, command_prefix, intents):
-        super().__init__(command_prefix=command_prefix, intents=intents, help_command=MyHelpCommand())
+        super().__init__(command_prefix=command_prefix, intents=intents, help_command=MyHelpCommand(),
+                         shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+                         chunk_guilds_at_startup=MEMBER_CHUNKING == 'startup',
+                         enable_raw_presences=MEMBER_CHUNKING == 'lazy', member_cache_flags=member_cache_flags)
         self.messaging = Messaging(self)
-        self.vip_manager = VIPManager(self, self.messaging)
+        self.action_journal = ActionJournal(self, self.messaging)
+        self.vip_manager = VIPManager(self, self.action_journal)
+        self.legacy_guild_id = None  # Guild that single-guild data and tag rules belong to
+        self.loop_lag_monitor = LoopLagMonitor()
+        self.metrics_server = None
+        self.ready_seconds = None  # Seconds from process start to the first ready event
+        self.snapshot_writer = None
 
     async def setup_hook(self):
         """Sets up the bot by initializing the database and loading cogs."""
         # Initialize the database (for both VIP and tags)
-        init_db()
+        await init_db()
+        await self.assign_legacy_guild()
+        snapshot = await load_snapshot(self.snapshot_path())
+        await self.vip_manager.start_expiry_scheduler(snapshot.get('subscriptions'))
+        self.messaging.start()
+        self.action_journal.start()  # Resumes whatever was journaled before the last shutdown or crash
+        self.loop_lag_monitor.start()
+        await self.start_metrics_server()
         # Load cogs
         await self.add_cog(VIPManagement(self, self.vip_manager, self.messaging))
         await self.add_cog(EventHandlers(self, self.vip_manager))
         await self.add_cog(ErrorHandler(self))
-        await self.add_cog(TagManagement(self))  # Add the tag management cog
-        await self.add_cog(UserStatus(self))
+        # Kept here as well, since shutdown snapshots are taken after the cogs are removed
+        tag_management = TagManagement(self, snapshot.get('tags'))
+        user_status = UserStatus(self, self.action_journal, snapshot.get('presence'))
+        await self.add_cog(tag_management)  # Add the tag management cog
+        await self.add_cog(user_status)
+        await self.add_cog(Stats(self, self.messaging))
+        if self.snapshot_path():
+            self.snapshot_writer = SnapshotWriter(self.snapshot_path(), {
+                'subscriptions': self.vip_manager.snapshot_state,
+                'tags': tag_management.snapshot_state,
+                'presence': user_status.snapshot_state,
+            }, SNAPSHOT_INTERVAL, prepare=user_status.flush_presence_buffer)
+            self.snapshot_writer.start()
+
+    async def assign_legacy_guild(self):
+        """Attributes data stored before multi-guild support to the guild it came from.
+
+        That guild is the one named by DISCORD_GUILD, or the bot's only guild.
+        """
+        if not await has_unscoped_rows() and not await get_all_tag_role_rules():
+            return
+        guilds = [guild async for guild in self.fetch_guilds(limit=None)]
+        guild = discord.utils.get(guilds, name=GUILD) if GUILD else None
+        if guild is None and len(guilds) == 1:
+            guild = guilds[0]
+        if guild is None:
+            logging.warning("Found data from before multi-guild support but can't tell which guild it belongs to; "
+                            "set DISCORD_GUILD to that guild's name.")
+            return
+        self.legacy_guild_id = guild.id
+        await assign_unscoped_rows(guild.id)
+        logging.info(f"Assigned single-guild data to {guild.name} ({guild.id}).")
+
+    def snapshot_path(self):
+        """SNAPSHOT_PATH, with the shard IDs added when this process runs only some shards."""
+        if not SNAPSHOT_PATH or not SHARD_IDS:
+            return SNAPSHOT_PATH
+        root, ext = os.path.splitext(SNAPSHOT_PATH)
+        return f"{root}-shards-{'-'.join(map(str, SHARD_IDS))}{ext}"
+
+    async def start_metrics_server(self):
+        """Serves Prometheus metrics on METRICS_PORT, offset by the first shard ID so shard processes don't collide."""
+        if not METRICS_PORT:
+            return
+        port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+        self.metrics_server = MetricsServer(METRICS_HOST, port)
+        try:
+            await self.metrics_server.start()
+        except OSError as e:
+            logging.warning(f"Could not serve metrics on {METRICS_HOST}:{port}: {e}")
+            self.metrics_server = None
+
+    async def close(self):
+        """Closes the Discord connection, snapshots the caches, then closes the database.
+
+        The snapshot comes after the cogs are removed, so buffered presence is flushed first.
+        """
+        self.loop_lag_monitor.stop()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        self.vip_manager.stop_expiry_scheduler()
+        await self.action_journal.stop()
+        await self.messaging.stop()
+        await super().close()
+        if self.snapshot_writer:
+            self.snapshot_writer.stop()
+            try:
+                await self.snapshot_writer.write()
+            except Exception:
+                logging.exception("Failed to write the shutdown snapshot.")
+            self.snapshot_writer = None
+        await close_db()
 
     async def on_ready(self):
         """Event handler for when the bot is ready."""
         print(f'Logged in as {self.user} (ID: {self.user.id})')
         print('------')
+        if self.ready_seconds is None:
+            self.report_startup()
+
+    def report_startup(self):
+        """Logs and records how long startup took and how much memory it used."""
+        self.ready_seconds = time.time() - START_TIME.get()
+        cached = sum(len(guild.members) for guild in self.guilds)
+        rss = peak_rss()
+        READY_SECONDS.set(self.ready_seconds)
+        CACHED_MEMBERS.set(cached)
+        if rss is not None:
+            PEAK_RSS.set(rss)
+        logging.info(f"Ready in {self.ready_seconds:.1f}s with {MEMBER_CHUNKING} member chunking: "
+                     f"{len(self.guilds)} guilds, {cached} members cached"
+                     + (f", peak RSS {rss / 2 ** 20:.0f} MiB." if rss is not None else "."))
 
 def main():
     """Main function to run the bot."""
-    bot = MyBot(command_prefix=get_prefix, intents=intents)
-    bot.run(TOKEN)
+    listener = configure_logging(LOG_FILES, 'bot.log', LOG_DIR, LOG_MAX_BYTES, LOG_BACKUP_COUNT,
+                                 LOG_SAMPLE_RATES, LOG_RATE_LIMITS)
+    try:
+        bot = MyBot(command_prefix=get_prefix, intents=intents)
+        # log_handler=None keeps discord.py from adding its own handler; its logs go through the pipeline too
+        bot.run(TOKEN, log_handler=None)
+    finally:
+        listener.stop()
 
 if __name__ == '__main__':
     main()
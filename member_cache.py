@@ -0,0 +1,52 @@
+# member_cache.py
+
+import asyncio
+import logging
+import time
+
+# With MEMBER_CHUNKING=lazy, guilds aren't chunked at startup, so the member cache
+# only holds members who are online or have joined since. These helpers find the
+# other members when a command, expiry or promotion actually needs them.
+
+# Most user IDs one gateway member request can ask for
+QUERY_BATCH_SIZE = 100
+
+
+async def resolve_members(guild, user_ids):
+    """The members of `guild` with the given IDs, as a mapping of user ID to Member.
+
+    Cached members are returned as they are. If the guild isn't fully cached, the rest
+    are requested over the gateway QUERY_BATCH_SIZE at a time and added to the cache.
+    IDs that don't belong to a member of the guild are left out.
+    """
+    found = {}
+    missing = []
+    for user_id in user_ids:
+        member = guild.get_member(user_id)
+        if member:
+            found[user_id] = member
+        else:
+            missing.append(user_id)
+    if not missing or guild.chunked:
+        return found
+
+    for i in range(0, len(missing), QUERY_BATCH_SIZE):
+        batch = missing[i:i + QUERY_BATCH_SIZE]
+        try:
+            members = await guild.query_members(user_ids=batch, limit=len(batch), cache=True)
+        except asyncio.TimeoutError:
+            logging.warning(f"Timed out fetching {len(batch)} members of {guild.name} ({guild.id}).")
+            continue
+        for member in members:
+            found[member.id] = member
+    return found
+
+
+async def ensure_chunked(guild):
+    """Downloads a guild's full member list if it isn't cached yet, for work that has to see every member."""
+    if guild.chunked:
+        return
+    start = time.perf_counter()
+    await guild.chunk()
+    logging.info(f"Fetched all {guild.member_count} members of {guild.name} ({guild.id}) "
+                 f"in {time.perf_counter() - start:.1f}s.")
@@ -2,58 +2,395 @@
 
 import discord
 import asyncio
-from config import GENERAL_CHANNEL_ID
+import logging
+import random
+import time
+from collections import deque
+from config import GENERAL_CHANNEL_ID, ADMIN_DIGEST_INTERVAL
+from db import add_admin_notification
+from member_cache import resolve_members
+from metrics import OUTBOUND_SENT, OUTBOUND_FAILED, OUTBOUND_LATENCY
+
+class TokenBucket:
+    """Token bucket allowing `rate` sends per `per` seconds, with bursts of up to `rate`."""
+
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Takes a token and returns how many seconds to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.fill_rate
+
+    def is_full(self):
+        """Whether the bucket has refilled completely, i.e. the route has been idle."""
+        elapsed = time.monotonic() - self.updated
+        return self.tokens + elapsed * self.fill_rate >= self.capacity
+
+
+class OutboundMessage:
+    """A message waiting in the outbound queue."""
+
+    __slots__ = ('route', 'target', 'content', 'embeds', 'fallback', 'enqueued_at', 'attempt', 'future', 'reserved')
+
+    def __init__(self, route, target, content=None, embeds=None, fallback=None, future=None):
+        self.route = route  # Rate-limit bucket key, e.g. ('dm', user_id) or ('channel', channel_id)
+        self.target = target  # Anything with an async send(), e.g. a Member or channel
+        self.content = content
+        self.embeds = embeds
+        self.fallback = fallback  # (guild, content, embed) to post in the guild's general channel if the target is Forbidden
+        self.enqueued_at = time.monotonic()
+        self.attempt = 0
+        self.future = future  # Set to whether the message was delivered, once it is delivered or given up on
+        self.reserved = False  # Whether it holds a token from its route's bucket and is waiting to use it
+
+
+# Discord limits for a single message
+MAX_MESSAGE_LENGTH = 2000
+MAX_EMBEDS_PER_MESSAGE = 10
+
+
+def chunk_lines(lines, limit=MAX_MESSAGE_LENGTH):
+    """Joins lines into as few newline-separated messages of at most `limit` characters as possible."""
+    chunks = []
+    current = []
+    length = 0
+    for line in lines:
+        line = line[:limit]
+        if current and length + len(line) + 1 > limit:
+            chunks.append('\n'.join(current))
+            current, length = [], 0
+        current.append(line)
+        length += len(line) + 1
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
 
 class Messaging:
-    """Handles messaging functionalities for the bot."""
+    """Handles messaging functionalities for the bot.
 
-    def __init__(self, bot):
+    Messages are enqueued and return immediately; worker tasks deliver them under
+    per-route token buckets. A message whose route is out of tokens is set aside
+    until its token is due rather than holding a worker, so a burst to one route
+    doesn't hold up the others. Only rate-limit (429) and server (5xx) errors are retried,
+    after the delay Discord asks for or else with jittered exponential backoff.
+    Forbidden is permanent and is never retried.
+
+    Notices that fall back to the general channel because DMs are closed are held
+    for at most fallback_delay seconds and posted as combined digest messages.
+    Admin notifications are stored for !vip_audit and sent to the guild owner as
+    one summary per admin_digest_interval, unless marked urgent; one urgent
+    notification per guild per interval is sent right away, and any more go into
+    the summary, so a burst of failures doesn't flood the owner's DMs.
+    """
+
+    def __init__(self, bot, workers=4, route_rate=5, route_per=5.0, max_retries=5, backoff_base=1.0,
+                 fallback_delay=3.0, admin_digest_interval=ADMIN_DIGEST_INTERVAL):
         self.bot = bot
+        self.queue = asyncio.Queue()
+        self.worker_count = workers
+        self.route_rate = route_rate
+        self.route_per = route_per
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.buckets = {}
+        self.workers = []
+        self.deferred = 0  # Messages waiting for a token, a retry or their guild owner before going on the queue
+        self.deferred_requeued = asyncio.Event()  # Set whenever no message is deferred
+        self.deferred_requeued.set()
+        self.recent_latencies = deque(maxlen=1000)  # Seconds from enqueue to delivery
+        self.sent_count = 0
+        self.failed_count = 0
+        self.fallback_delay = fallback_delay
+        self.pending_fallbacks = {}  # channel_id -> list of (content, embed) notices
+        self.fallback_timers = {}  # channel_id -> TimerHandle of the scheduled digest flush
+        self.admin_digest_interval = admin_digest_interval
+        self.pending_admin_notices = {}  # guild_id -> (guild, list of messages)
+        self.admin_digest_timers = {}  # guild_id -> TimerHandle of the scheduled summary
+        self.last_urgent_notice = {}  # guild_id -> monotonic time the last urgent notification was sent
+        self.owner_lookups = set()  # Tasks fetching guild owners missing from the member cache
 
-    def retry_on_permission_denied(retries=3, delay=5):
-        """Decorator to retry a function upon encountering a Permission Denied error."""
-        def decorator(func):
-            async def wrapper(*args, **kwargs):
-                last_exception = None
-                for attempt in range(retries):
-                    try:
-                        return await func(*args, **kwargs)
-                    except discord.errors.Forbidden as e:
-                        last_exception = e
-                        print(f"Attempt {attempt + 1} failed: Permission Denied. Retrying in {delay} seconds...")
-                        await asyncio.sleep(delay)
-                raise last_exception
-            return wrapper
-        return decorator
-
-    @retry_on_permission_denied(retries=3, delay=5)
-    async def send_private_message(self, member, message):
-        """Sends a private message to a member."""
+    def start(self):
+        """Starts the delivery workers."""
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self, timeout=5.0):
+        """Waits up to `timeout` seconds for the queue to drain, deferred messages included, then stops the workers."""
+        for guild_id in list(self.pending_admin_notices):
+            self._flush_admin_notices(guild_id)
+        for channel_id in list(self.pending_fallbacks):
+            self._flush_fallbacks(channel_id)
         try:
-            await member.send(message)
-        except discord.errors.Forbidden:
-            general_channel = self.bot.get_channel(GENERAL_CHANNEL_ID)
-            if general_channel:
-                await general_channel.send(f"{member.mention}, {message}")
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Stopping messaging with {self.queue.qsize()} messages still queued "
+                            f"and {self.deferred} waiting for a rate limit or retry.")
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
 
-    @retry_on_permission_denied(retries=3, delay=5)
-    async def send_embed_message(self, member, embed):
-        """Sends an embedded message to a member."""
+    async def join(self):
+        """Waits until every queued message is delivered or given up on, including deferred ones."""
+        while True:
+            await self.queue.join()
+            if not self.deferred:
+                return
+            # A message is requeued before the count drops, so the next join() waits for it
+            await self.deferred_requeued.wait()
+
+    @property
+    def queue_depth(self):
+        """Number of messages waiting to be delivered."""
+        return self.queue.qsize() + self.deferred
+
+    def latency_percentile(self, percentile):
+        """Enqueue-to-delivery latency in seconds at the given percentile of recent sends."""
+        if not self.recent_latencies:
+            return 0.0
+        latencies = sorted(self.recent_latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    def enqueue(self, message):
+        """Adds a message to the outbound queue."""
+        self.queue.put_nowait(message)
+
+    def _get_bucket(self, route):
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            if len(self.buckets) > 10000:
+                # Forget idle routes so per-member buckets don't accumulate forever
+                self.buckets = {key: value for key, value in self.buckets.items() if not value.is_full()}
+            bucket = self.buckets[route] = TokenBucket(self.route_rate, self.route_per)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            message = await self.queue.get()
+            try:
+                await self._deliver(message)
+            except Exception:
+                self.failed_count += 1
+                OUTBOUND_FAILED.inc()
+                logging.exception(f"Unexpected error delivering message to {message.route}.")
+                self._resolve(message, False)
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, message):
+        if message.reserved:
+            message.reserved = False
+        else:
+            delay = self._get_bucket(message.route).reserve()
+            if delay:
+                message.reserved = True
+                self._defer(message, delay)
+                return
         try:
-            await member.send(embed=embed)
+            kwargs = {'embeds': message.embeds} if message.embeds else {}
+            await message.target.send(message.content, **kwargs)
         except discord.errors.Forbidden:
-            general_channel = self.bot.get_channel(GENERAL_CHANNEL_ID)
-            if general_channel:
-                await general_channel.send(f"{member.mention}", embed=embed)
+            if message.fallback:
+                self._resolve(message, self._send_fallback(*message.fallback))
+            else:
+                self.failed_count += 1
+                OUTBOUND_FAILED.inc()
+                logging.warning(f"Permission denied sending to {message.route}; not retrying.")
+                self._resolve(message, False)
+            return
+        except discord.errors.RateLimited as e:
+            # Raised instead of waiting when Discord asks for a longer wait than the client allows
+            self._retry(message, e, 429, e.retry_after)
+            return
+        except discord.errors.HTTPException as e:
+            if e.status == 429 or e.status >= 500:
+                self._retry(message, e, e.status, getattr(e, 'retry_after', None))
+            else:
+                self._give_up(message, e)
+            return
+        latency = time.monotonic() - message.enqueued_at
+        self.sent_count += 1
+        self.recent_latencies.append(latency)
+        OUTBOUND_SENT.inc()
+        OUTBOUND_LATENCY.observe(latency)
+        self._resolve(message, True)
 
-    async def notify_admin(self, guild, message):
-        """Notifies the guild administrator with a message."""
+    def _retry(self, message, error, status, retry_after=None):
+        """Puts a message back on the queue after `retry_after` seconds or a backoff, unless it is out of retries."""
+        if message.attempt >= self.max_retries:
+            self._give_up(message, error)
+            return
+        message.attempt += 1
+        if retry_after:
+            backoff = retry_after
+        else:
+            backoff = self.backoff_base * 2 ** message.attempt * random.uniform(0.5, 1.5)
+        logging.info(f"Send to {message.route} failed with {status}; retry {message.attempt} in {backoff:.1f}s.")
+        self._defer(message, backoff)
+
+    def _defer(self, message, delay):
+        """Puts a message back on the queue after `delay` seconds, without holding a worker meanwhile."""
+        self.deferred += 1
+        self.deferred_requeued.clear()
+        asyncio.get_running_loop().call_later(delay, self._requeue, message)
+
+    def _requeue(self, message):
+        self.queue.put_nowait(message)
+        self._undefer()
+
+    def _undefer(self):
+        self.deferred -= 1
+        if not self.deferred:
+            self.deferred_requeued.set()
+
+    def _give_up(self, message, error):
+        self.failed_count += 1
+        OUTBOUND_FAILED.inc()
+        logging.warning(f"Giving up sending to {message.route}: {error}")
+        self._resolve(message, False)
+
+    def _resolve(self, message, delivered):
+        """Tells whoever is waiting on a message whether it was delivered."""
+        if message.future and not message.future.done():
+            message.future.set_result(delivered)
+
+    def _fallback_channel_id(self, guild):
+        """The channel a guild's fallback notices go to: GENERAL_CHANNEL_ID if it is in the guild, else the system channel."""
+        channel = self.bot.get_channel(GENERAL_CHANNEL_ID) if GENERAL_CHANNEL_ID else None
+        if channel and getattr(channel, 'guild', None) == guild:
+            return channel.id
+        return guild.system_channel.id if guild.system_channel else None
+
+    def _send_fallback(self, guild, content, embed=None):
+        """Adds a notice to the next digest for the guild's general channel; returns False if there is no channel."""
+        channel_id = self._fallback_channel_id(guild)
+        if channel_id is None:
+            self.failed_count += 1
+            OUTBOUND_FAILED.inc()
+            logging.warning(f"No general channel to post a fallback notice in {guild.name} ({guild.id}).")
+            return False
+        pending = self.pending_fallbacks.get(channel_id, [])
+        if embed:
+            full = sum(1 for text, notice_embed in pending if notice_embed) >= MAX_EMBEDS_PER_MESSAGE
+        else:
+            text_length = sum(len(text) + 1 for text, notice_embed in pending if not notice_embed)
+            full = text_length + len(content) > MAX_MESSAGE_LENGTH
+        if full:
+            # The digest can't take this notice; send what is pending now rather than waiting
+            self._flush_fallbacks(channel_id)
+
+        self.pending_fallbacks.setdefault(channel_id, []).append((content, embed))
+        if channel_id not in self.fallback_timers:
+            self.fallback_timers[channel_id] = asyncio.get_running_loop().call_later(
+                self.fallback_delay, self._flush_fallbacks, channel_id)
+        return True
+
+    def _flush_fallbacks(self, channel_id):
+        """Queues the pending notices for a channel as as few messages as the limits allow."""
+        timer = self.fallback_timers.pop(channel_id, None)
+        if timer:
+            timer.cancel()
+        pending = self.pending_fallbacks.pop(channel_id, [])
+        channel = self.bot.get_channel(channel_id)
+        if not pending or not channel:
+            return
+
+        route = ('channel', channel_id)
+        for digest in chunk_lines([content for content, embed in pending if not embed]):
+            self.enqueue(OutboundMessage(route, channel, digest))
+
+        embed_notices = [(content, embed) for content, embed in pending if embed]
+        for i in range(0, len(embed_notices), MAX_EMBEDS_PER_MESSAGE):
+            chunk = embed_notices[i:i + MAX_EMBEDS_PER_MESSAGE]
+            mentions = ' '.join(content for content, embed in chunk)
+            self.enqueue(OutboundMessage(route, channel, mentions, [embed for content, embed in chunk]))
+
+    async def send_private_message(self, member, message):
+        """Queues a private message to a member, falling back to the general channel if DMs are closed."""
+        self.enqueue(OutboundMessage(('dm', member.id), member, message,
+                                     fallback=(member.guild, f"{member.mention}, {message}", None)))
+
+    async def deliver_private_message(self, member, message):
+        """Sends a private message like send_private_message, but waits until it is delivered or given up on.
+
+        Returns whether it reached the member, or was handed to the general channel digest.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.enqueue(OutboundMessage(('dm', member.id), member, message,
+                                     fallback=(member.guild, f"{member.mention}, {message}", None), future=future))
+        return await future
+
+    async def send_embed_message(self, member, embed):
+        """Queues an embedded message to a member, falling back to the general channel if DMs are closed."""
+        self.enqueue(OutboundMessage(('dm', member.id), member, embeds=[embed],
+                                     fallback=(member.guild, f"{member.mention}", embed)))
+
+    async def notify_admin(self, guild, message, urgent=False):
+        """Records an admin notification and tells the guild owner.
+
+        Urgent notifications are sent right away, unless one already was in the last
+        admin_digest_interval seconds; the rest are collected into one summary per
+        guild every admin_digest_interval seconds.
+        """
+        await add_admin_notification(guild.id, message, urgent, time.time())
+        now = time.monotonic()
+        if urgent and now - self.last_urgent_notice.get(guild.id, -self.admin_digest_interval) >= self.admin_digest_interval:
+            self.last_urgent_notice[guild.id] = now
+            self._send_to_admin(guild, [message])
+            return
+
+        if guild.id not in self.pending_admin_notices:
+            self.pending_admin_notices[guild.id] = (guild, [])
+            self.admin_digest_timers[guild.id] = asyncio.get_running_loop().call_later(
+                self.admin_digest_interval, self._flush_admin_notices, guild.id)
+        self.pending_admin_notices[guild.id][1].append(message)
+
+    def _flush_admin_notices(self, guild_id):
+        """Sends the guild owner a summary of the notifications collected since the last one."""
+        timer = self.admin_digest_timers.pop(guild_id, None)
+        if timer:
+            timer.cancel()
+        guild, messages = self.pending_admin_notices.pop(guild_id, (None, []))
+        if not messages:
+            return
+        lines = [f"{len(messages)} VIP updates in {guild.name}:"] + [f"- {message}" for message in messages]
+        self._send_to_admin(guild, chunk_lines(lines))
+
+    def _send_to_admin(self, guild, messages):
+        """Queues DMs to the guild owner, fetching the owner first if they aren't in the member cache."""
         admin = guild.owner  # Retrieves the guild owner
         if admin:
-            try:
-                await admin.send(message)
-            except discord.errors.Forbidden:
-                # Fallback to sending the message in the general channel if DM is not possible
-                general_channel = self.bot.get_channel(GENERAL_CHANNEL_ID)
-                if general_channel:
-                    await general_channel.send(f"{admin.mention}, {message}")
+            self._enqueue_for_admin(guild, admin, messages)
+            return
+        # Usual with MEMBER_CHUNKING=lazy; counted as deferred so stop() waits for the lookup
+        self.deferred += 1
+        self.deferred_requeued.clear()
+        task = asyncio.create_task(self._send_to_uncached_admin(guild, messages))
+        self.owner_lookups.add(task)
+        task.add_done_callback(self.owner_lookups.discard)
+
+    async def _send_to_uncached_admin(self, guild, messages):
+        try:
+            admin = (await resolve_members(guild, [guild.owner_id])).get(guild.owner_id)
+            if admin:
+                self._enqueue_for_admin(guild, admin, messages)
+            else:
+                logging.warning(f"Could not find the owner of {guild.name} ({guild.id}) to send "
+                                f"{len(messages)} admin notifications to.")
+        except Exception:
+            logging.exception(f"Failed to look up the owner of {guild.name} ({guild.id}).")
+        finally:
+            self._undefer()
+
+    def _enqueue_for_admin(self, guild, admin, messages):
+        for message in messages:
+            # Fallback to sending the message in the general channel if DM is not possible
+            self.enqueue(OutboundMessage(('dm', admin.id), admin, message,
+                                         fallback=(guild, f"{admin.mention}, {message}", None)))
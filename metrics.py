@@ -0,0 +1,284 @@
+# metrics.py
+
+import asyncio
+import bisect
+import logging
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# In-process metrics: counters, gauges and histograms kept in one registry and
+# rendered in the Prometheus text exposition format. Everything here is updated
+# from the event loop thread, so no locking is needed.
+
+# Latency buckets in seconds, from sub-millisecond database calls to slow commands
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge:
+    """A value that goes up and down, optionally split by labels."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[_label_key(self.labelnames, labels)] = value
+
+    def get(self, **labels):
+        return self.values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, like a Prometheus histogram."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, **labels):
+        series = self.series.get(_label_key(self.labelnames, labels))
+        return sum(series[:-1]) if series else 0
+
+    def total(self, **labels):
+        series = self.series.get(_label_key(self.labelnames, labels))
+        return series[-1] if series else 0.0
+
+    def quantile(self, q, **labels):
+        """Estimates a quantile by interpolating within its bucket, as histogram_quantile() does."""
+        series = self.series.get(_label_key(self.labelnames, labels))
+        return self._quantile(series, q) if series else 0.0
+
+    def _quantile(self, series, q):
+        counts = series[:-1]
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def samples(self):
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                yield f'{self.name}_bucket', _format_labels(self.labelnames, key, (('le', bound),)), cumulative
+            yield f'{self.name}_count', _format_labels(self.labelnames, key), cumulative
+            yield f'{self.name}_sum', _format_labels(self.labelnames, key), series[-1]
+
+
+class Registry:
+    """Holds every metric and renders them for scraping.
+
+    Collectors are callables run before each scrape, to copy values such as queue
+    depths that are cheaper to read on demand than to track on every change.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            return self.metrics[metric.name]
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collect(self):
+        """Runs the collectors so gauges reflect the current state."""
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception:
+                logging.exception("Metrics collector failed.")
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        self.collect()
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+COMMAND_LATENCY = REGISTRY.histogram('bot_command_duration_seconds', 'Time from command invocation to completion.',
+                                     ('command',))
+COMMAND_ERRORS = REGISTRY.counter('bot_command_errors_total', 'Commands that raised an error.', ('command',))
+DB_CALL_LATENCY = REGISTRY.histogram('bot_db_call_duration_seconds',
+                                     'Time from calling a db.py function to getting its result, queueing included.',
+                                     ('function',))
+DB_CALL_ERRORS = REGISTRY.counter('bot_db_call_errors_total', 'db.py calls that raised an exception.', ('function',))
+GATEWAY_EVENTS = REGISTRY.counter('bot_gateway_events_total', 'Gateway events received, by event type.', ('event',))
+LOOP_LAG = REGISTRY.histogram('bot_event_loop_lag_seconds', 'How late the event loop ran a timer callback.',
+                              buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+LOOP_LAG_LAST = REGISTRY.gauge('bot_event_loop_lag_last_seconds', 'Event loop lag at the last check.')
+OUTBOUND_QUEUE_DEPTH = REGISTRY.gauge('bot_outbound_queue_depth', 'Messages waiting in the outbound queue.')
+OUTBOUND_SENT = REGISTRY.counter('bot_outbound_messages_sent_total', 'Messages delivered.')
+OUTBOUND_FAILED = REGISTRY.counter('bot_outbound_messages_failed_total', 'Messages given up on.')
+OUTBOUND_LATENCY = REGISTRY.histogram('bot_outbound_delivery_seconds', 'Time from enqueueing a message to delivering it.')
+JOURNAL_ACTIONS = REGISTRY.counter('bot_journal_actions_total',
+                                   'Journaled role changes and DMs, by outcome: completed, retried or failed.',
+                                   ('outcome',))
+PRESENCE_FLUSH_SIZE = REGISTRY.histogram('bot_presence_flush_users', 'Members whose buffered presence one flush wrote.',
+                                        buckets=(1, 10, 100, 500, 1000, 5000, 10000, 50000))
+PRESENCE_FLUSH_LATENCY = REGISTRY.histogram('bot_presence_flush_seconds', 'Time one presence flush took to write.')
+START_TIME = REGISTRY.gauge('bot_start_time_seconds', 'Unix time the process started.')
+START_TIME.set(time.time())
+READY_SECONDS = REGISTRY.gauge('bot_ready_seconds', 'Seconds from process start to the first ready event.')
+CACHED_MEMBERS = REGISTRY.gauge('bot_cached_members', 'Members in the member cache.')
+PEAK_RSS = REGISTRY.gauge('bot_peak_rss_bytes', 'Peak resident memory of the process.')
+
+
+def peak_rss():
+    """Peak resident memory of the process in bytes, or None where the platform doesn't report it."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Kilobytes everywhere but macOS
+
+
+class LoopLagMonitor:
+    """Schedules a check every `interval` seconds and records how late it ran."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+
+
+class MetricsServer:
+    """Serves REGISTRY in the Prometheus text format at http://host:port/metrics."""
+
+    def __init__(self, host='127.0.0.1', port=9108, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5.0)
+            # Skip the headers; nothing in them matters here
+            while (await asyncio.wait_for(reader.readline(), 5.0)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                status, body, content_type = '404 Not Found', b'Not found\n', 'text/plain'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,481 @@
+# migrations.py
+
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Schema migrations, applied in order by migrate(). PRAGMA user_version records the
+# last migration applied, so each one runs exactly once per database.
+#
+# Databases created before versioning existed start at version 0 in whatever shape
+# the code of the time left them, so every migration checks what is already there.
+#
+# Data is converted in chunks of CHUNK_SIZE rows, each in its own short write
+# transaction, so another bot process sharing the database is never locked out for
+# long. Chunked steps are idempotent: if the process stops half way, the migration
+# starts over on the next run and skips the rows already converted. The schema
+# change that completes a migration runs in one transaction with its version bump;
+# a rebuilt table catches up there on rows that processes still on the old schema
+# changed after they were copied.
+
+CHUNK_SIZE = 5000
+
+# Guild ID given to rows carried over from the single-guild schema until
+# assign_unscoped_rows attributes them to the bot's original guild
+UNSCOPED_GUILD_ID = 0
+
+# Tables keyed by guild, with their schema and the columns copied over from the
+# single-guild tables
+GUILD_SCOPED_TABLES = {
+    'subscriptions': ('''
+        CREATE TABLE IF NOT EXISTS {name} (
+            guild_id INTEGER,
+            user_id INTEGER,
+            expires_at INTEGER NOT NULL,  -- Unix timestamp the subscription ends
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''', ('user_id', 'expires_at')),
+    'user_tags': ('''
+        CREATE TABLE IF NOT EXISTS {name} (
+            guild_id INTEGER,
+            user_id INTEGER,
+            tag TEXT,
+            UNIQUE(guild_id, user_id, tag)
+        )
+    ''', ('user_id', 'tag')),
+    'tag_role_ids': ('''
+        CREATE TABLE IF NOT EXISTS {name} (
+            guild_id INTEGER,
+            tag TEXT,
+            role_id INTEGER,
+            PRIMARY KEY (guild_id, tag, role_id)
+        )
+    ''', ('tag', 'role_id')),
+    'user_presence': ('''
+        CREATE TABLE IF NOT EXISTS {name} (
+            guild_id INTEGER,
+            user_id INTEGER,
+            total_presence REAL,  -- Total online presence in seconds
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''', ('user_id', 'total_presence')),
+    'open_sessions': ('''
+        CREATE TABLE IF NOT EXISTS {name} (
+            guild_id INTEGER,
+            user_id INTEGER,
+            started_at REAL,  -- Unix timestamp the user came online
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''', ('user_id', 'started_at')),
+}
+
+MIGRATIONS = []
+
+
+def migration(version):
+    """Registers a migration function that brings the schema to `version`."""
+    def register(func):
+        MIGRATIONS.append((version, func))
+        return func
+    return register
+
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+@contextmanager
+def transaction(conn):
+    """Runs a block in a write transaction, including DDL, which sqlite3 would otherwise autocommit."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def migrate(conn, chunk_size=CHUNK_SIZE):
+    """Applies every migration newer than the database's user_version, in order."""
+    MIGRATIONS.sort()
+    for version, func in MIGRATIONS:
+        if get_version(conn) >= version:
+            continue
+        start = time.perf_counter()
+        func(conn, version, chunk_size)
+        logging.info(f"Applied schema migration {version} ({func.__name__}) in {time.perf_counter() - start:.2f}s.")
+
+
+@contextmanager
+def _finish(conn, version):
+    """Transaction that completes a migration; the block is skipped if another process got there first."""
+    with transaction(conn):
+        if get_version(conn) >= version:
+            yield False
+            return
+        yield True
+        conn.execute(f'PRAGMA user_version = {version}')
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _in_chunks(conn, version, select_sql, apply, chunk_size):
+    """Feeds rows from a keyset-paginated query to `apply` a chunk at a time, one transaction per chunk.
+
+    select_sql must select rowid first and take the last rowid seen and a limit as parameters.
+    Stops early if another process finishes the migration meanwhile.
+    """
+    last_rowid = -1
+    while True:
+        with transaction(conn):
+            if get_version(conn) >= version:
+                return
+            rows = conn.execute(select_sql, (last_rowid, chunk_size)).fetchall()
+            if rows:
+                apply(rows)
+        if len(rows) < chunk_size:
+            return
+        last_rowid = rows[-1][0]
+
+
+def _iso_to_epoch(expiry_date):
+    """Convert an ISO expiry date string to a Unix timestamp."""
+    return int(datetime.fromisoformat(expiry_date).timestamp())
+
+
+@migration(1)
+def create_initial_schema(conn, version, chunk_size):
+    """The schema as it was before migrations existed."""
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                user_id INTEGER PRIMARY KEY,
+                expiry_date TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_tags (
+                user_id INTEGER,
+                tag TEXT,
+                UNIQUE(user_id, tag)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tag_role_rules (
+                tag TEXT PRIMARY KEY,
+                roles TEXT  -- A comma-separated string of roles allowed to manage the tag
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_presence (
+                user_id INTEGER PRIMARY KEY,
+                total_presence REAL  -- Total online presence in seconds
+            )
+        ''')
+
+
+@migration(2)
+def add_subscription_epochs(conn, version, chunk_size):
+    """Stores each subscription's ISO expiry date as a Unix timestamp as well."""
+    if 'expires_at' not in _columns(conn, 'subscriptions'):
+        with transaction(conn):
+            if 'expires_at' not in _columns(conn, 'subscriptions'):
+                conn.execute('ALTER TABLE subscriptions ADD COLUMN expires_at INTEGER')
+
+    def convert(rows):
+        # A subscription without an expiry date is treated as already expired
+        conn.executemany('UPDATE subscriptions SET expires_at = ? WHERE rowid = ?',
+                         [(_iso_to_epoch(expiry_date) if expiry_date else 0, rowid) for rowid, expiry_date in rows])
+
+    _in_chunks(conn, version, '''
+        SELECT rowid, expiry_date FROM subscriptions
+        WHERE rowid > ? AND expires_at IS NULL ORDER BY rowid LIMIT ?
+    ''', convert, chunk_size)
+    with _finish(conn, version):
+        pass
+
+
+@migration(3)
+def create_session_and_rule_tables(conn, version, chunk_size):
+    """Tables added before migrations existed, in the shape they were first created in."""
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tag_role_ids (
+                tag TEXT,
+                role_id INTEGER,
+                PRIMARY KEY (tag, role_id)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS open_sessions (
+                user_id INTEGER PRIMARY KEY,
+                started_at REAL  -- Unix timestamp the user came online
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS session_checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                checkpointed_at REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS admin_notifications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                guild_id INTEGER,
+                created_at REAL,  -- Unix timestamp
+                message TEXT,
+                urgent INTEGER
+            )
+        ''')
+
+
+def _rebuild_table(conn, version, table, schema, columns, chunk_size, guild_id=None):
+    """Copies a table into a new one with the given schema in chunks, then swaps it in.
+
+    With guild_id set, the copied rows get that guild_id. The caller swaps the new
+    table in with _swap_table, with the same columns and guild_id, when it finishes
+    the migration.
+    """
+    new_table = f'{table}_new'
+    with transaction(conn):
+        if get_version(conn) >= version:
+            return
+        conn.execute(schema.format(name=new_table))
+
+    column_list = ', '.join(columns)
+    if guild_id is None:
+        insert_sql = f'INSERT OR IGNORE INTO {new_table} ({column_list}) VALUES ({", ".join("?" * len(columns))})'
+        values = lambda rows: [row[1:] for row in rows]
+    else:
+        insert_sql = (f'INSERT OR IGNORE INTO {new_table} (guild_id, {column_list}) '
+                      f'VALUES (?, {", ".join("?" * len(columns))})')
+        values = lambda rows: [(guild_id, *row[1:]) for row in rows]
+
+    _in_chunks(conn, version,
+               f'SELECT rowid, {column_list} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+               lambda rows: conn.executemany(insert_sql, values(rows)), chunk_size)
+
+
+def _swap_table(conn, table, columns, guild_id=None):
+    """Replaces a table with the copy _rebuild_table made of it; run inside _finish.
+
+    A process still on the old schema may have updated, deleted or added rows after they
+    were copied, so the copy is first brought up to date. _finish holds the write lock,
+    so nothing can change between this catch-up and the swap.
+    """
+    new_table = f'{table}_new'
+    column_list = ', '.join(columns)
+    # Rows updated or deleted since they were copied
+    conn.execute(f'''
+        DELETE FROM {new_table} WHERE NOT EXISTS (
+            SELECT 1 FROM {table} WHERE {' AND '.join(f'{table}.{column} IS {new_table}.{column}' for column in columns)}
+        )
+    ''')
+    # Their current values, and rows added since
+    if guild_id is None:
+        conn.execute(f'''
+            INSERT OR IGNORE INTO {new_table} ({column_list})
+            SELECT {column_list} FROM {table} EXCEPT SELECT {column_list} FROM {new_table}
+        ''')
+    else:
+        conn.execute(f'''
+            INSERT OR IGNORE INTO {new_table} (guild_id, {column_list})
+            SELECT ?, {column_list} FROM {table} EXCEPT SELECT guild_id, {column_list} FROM {new_table}
+        ''', (guild_id,))
+    conn.execute(f'DROP TABLE {table}')
+    conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+
+@migration(4)
+def scope_tables_by_guild(conn, version, chunk_size):
+    """Adds guild_id to every per-member table; existing rows get UNSCOPED_GUILD_ID.
+
+    Subscriptions lose their ISO expiry_date column on the way, keeping only the epoch.
+    """
+    rebuilt = []
+    for table, (schema, columns) in GUILD_SCOPED_TABLES.items():
+        if 'guild_id' not in _columns(conn, table):
+            _rebuild_table(conn, version, table, schema, columns, chunk_size, guild_id=UNSCOPED_GUILD_ID)
+            rebuilt.append((table, columns))
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        for table, columns in rebuilt:
+            _swap_table(conn, table, columns, guild_id=UNSCOPED_GUILD_ID)
+
+
+@migration(5)
+def drop_subscription_iso_dates(conn, version, chunk_size):
+    """Drops the ISO expiry_date column from guild-scoped subscriptions that still have it."""
+    rebuilt = 'expiry_date' in _columns(conn, 'subscriptions')
+    schema, columns = GUILD_SCOPED_TABLES['subscriptions']
+    if rebuilt:
+        _rebuild_table(conn, version, 'subscriptions', schema, ('guild_id',) + columns, chunk_size)
+    with _finish(conn, version) as needed:
+        if needed and rebuilt:
+            _swap_table(conn, 'subscriptions', ('guild_id',) + columns)
+
+
+@migration(6)
+def split_tag_role_names(conn, version, chunk_size):
+    """Replaces the comma-separated role names of legacy tag rules with one row per role name."""
+    with transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tag_role_names (
+                tag TEXT,
+                role_name TEXT,
+                PRIMARY KEY (tag, role_name)
+            )
+        ''')
+
+    def split(rows):
+        conn.executemany('INSERT OR IGNORE INTO tag_role_names (tag, role_name) VALUES (?, ?)',
+                         [(tag, role_name.strip()) for rowid, tag, roles in rows
+                          for role_name in (roles or '').split(',') if role_name.strip()])
+
+    _in_chunks(conn, version, 'SELECT rowid, tag, roles FROM tag_role_rules WHERE rowid > ? ORDER BY rowid LIMIT ?',
+               split, chunk_size)
+    with _finish(conn, version) as needed:
+        if needed:
+            conn.execute('DROP TABLE tag_role_rules')
+
+
+@migration(7)
+def add_indexes(conn, version, chunk_size):
+    """Indexes for expiry range queries, lookups by tag and the admin audit log."""
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        conn.execute('DROP INDEX IF EXISTS idx_subscriptions_expires_at')
+        conn.execute('DROP INDEX IF EXISTS idx_user_tags_tag')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_guild_expires_at ON subscriptions (guild_id, expires_at)')
+        # UNIQUE(guild_id, user_id, tag) already indexes lookups by user; this one covers lookups by tag
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_user_tags_guild_tag ON user_tags (guild_id, tag)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_admin_notifications_guild ON admin_notifications (guild_id, id)')
+
+
+@migration(8)
+def create_action_journal(conn, version, chunk_size):
+    """Durable outbox of role changes and DMs, and the per-guild record of when each sweep last ran."""
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS action_journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                guild_id INTEGER,
+                user_id INTEGER,
+                action TEXT,  -- 'add_role', 'remove_role' or 'dm'
+                role_id INTEGER,  -- For role actions
+                content TEXT,  -- For DMs
+                revision INTEGER DEFAULT 0,  -- Bumped when a pending role action is replaced
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,  -- Unix timestamp the action is due
+                created_at REAL,
+                failed_at REAL  -- Set once the action has been given up on
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_action_journal_due ON action_journal (failed_at, next_attempt_at)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS guild_jobs (
+                guild_id INTEGER,
+                job TEXT,
+                last_run_at REAL,  -- Unix timestamp the job last finished for the guild
+                PRIMARY KEY (guild_id, job)
+            )
+        ''')
+
+
+@migration(9)
+def create_departed_members(conn, version, chunk_size):
+    """Members who have left a guild, so their data can be purged once they have been gone long enough."""
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS departed_members (
+                guild_id INTEGER,
+                user_id INTEGER,
+                left_at REAL,  -- Unix timestamp the member left
+                PRIMARY KEY (guild_id, user_id)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_departed_members_left_at ON departed_members (left_at)')
+
+
+@migration(10)
+def create_presence_rollups(conn, version, chunk_size):
+    """Online time per member in hourly, daily and weekly buckets, for questions about recent activity."""
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        # A bucket has a row with rolled_up = 0 for time not yet added to the next coarser
+        # period's bucket, and one with rolled_up = 1 for time that has been
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS presence_rollups (
+                guild_id INTEGER,
+                user_id INTEGER,
+                period INTEGER,  -- Bucket length in seconds: 3600, 86400 or 604800
+                bucket_start INTEGER,  -- Unix timestamp the bucket starts (UTC; weeks start on Monday)
+                rolled_up INTEGER,
+                seconds REAL,
+                PRIMARY KEY (guild_id, user_id, period, bucket_start, rolled_up)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_presence_rollups_period '
+                     'ON presence_rollups (period, rolled_up, bucket_start)')
+
+
+# One change counter per in-memory cache, bumped by every db.py function that writes to
+# the tables the cache is built from
+CHANGE_COUNTERS = ('subscriptions', 'tags', 'presence')
+
+
+@migration(11)
+def create_change_counters(conn, version, chunk_size):
+    """Counters of writes to the tables behind the in-memory caches, so a startup snapshot
+    of a cache can be checked against the database."""
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS change_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        ''')
+        conn.executemany('INSERT OR IGNORE INTO change_counters (name, value) VALUES (?, 0)',
+                         [(name,) for name in CHANGE_COUNTERS])
+
+
+@migration(12)
+def create_guild_session_checkpoints(conn, version, chunk_size):
+    """The time of the last open-session checkpoint per guild, since shard processes sharing
+    the database checkpoint their own guilds' sessions independently.
+
+    Guilds with checkpointed sessions start from the single checkpoint time of before,
+    which processes not yet upgraded keep writing to session_checkpoint.
+    """
+    with _finish(conn, version) as needed:
+        if not needed:
+            return
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS guild_session_checkpoints (
+                guild_id INTEGER PRIMARY KEY,
+                checkpointed_at REAL  -- Unix timestamp of the guild's last checkpoint
+            )
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO guild_session_checkpoints (guild_id, checkpointed_at)
+            SELECT DISTINCT guild_id, (SELECT checkpointed_at FROM session_checkpoint) FROM open_sessions
+            WHERE EXISTS (SELECT 1 FROM session_checkpoint)
+        ''')
@@ -0,0 +1,106 @@
+# session_store.py
+
+import time
+from array import array
+
+
+class SessionStore:
+    """Start times of open presence sessions, kept compactly for large numbers of online members.
+
+    Each guild maps user IDs to a slot in one array('d') of time.monotonic() start
+    times, so a session costs a dict entry and an 8-byte double instead of a tuple
+    key and a timezone-aware datetime. Slots freed by closed sessions are reused
+    before the array grows. Keys are (guild_id, user_id), as everywhere else in the
+    cog; start times go in and out as Unix time so checkpoints stay comparable
+    across restarts.
+    """
+
+    def __init__(self):
+        self.guilds = {}  # guild_id -> user_id -> slot in starts
+        self.starts = array('d')  # Monotonic start time per slot
+        self.free = []  # Slots of closed sessions, reused first
+        self.count = 0
+        # Adding this to a monotonic time gives Unix time
+        self.wall_offset = time.time() - time.monotonic()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        guild_id, user_id = key
+        users = self.guilds.get(guild_id)
+        return users is not None and user_id in users
+
+    def __iter__(self):
+        for guild_id, users in self.guilds.items():
+            for user_id in users:
+                yield guild_id, user_id
+
+    def open(self, key, started_at=None):
+        """Starts a session, at Unix time `started_at` if given or else now. Returns False if one was already open."""
+        guild_id, user_id = key
+        users = self.guilds.setdefault(guild_id, {})
+        if user_id in users:
+            return False
+        start = time.monotonic() if started_at is None else started_at - self.wall_offset
+        if self.free:
+            slot = self.free.pop()
+            self.starts[slot] = start
+        else:
+            slot = len(self.starts)
+            self.starts.append(start)
+        users[user_id] = slot
+        self.count += 1
+        return True
+
+    def close(self, key):
+        """Ends a session and returns its length in seconds, or None if none was open."""
+        start = self._pop(key)
+        if start is None:
+            return None
+        return time.monotonic() - start
+
+    def discard(self, key):
+        """Drops a session without measuring it."""
+        self._pop(key)
+
+    def started_at(self, key):
+        """Unix time a session started."""
+        guild_id, user_id = key
+        return self.starts[self.guilds[guild_id][user_id]] + self.wall_offset
+
+    def close_all(self):
+        """Ends every session at once and returns {key: seconds online}, for shutdown.
+
+        The slots are dropped wholesale rather than returned to the free list one by one.
+        """
+        now = time.monotonic()
+        starts = self.starts
+        durations = {(guild_id, user_id): now - starts[slot]
+                     for guild_id, users in self.guilds.items() for user_id, slot in users.items()}
+        self.guilds = {}
+        self.starts = array('d')
+        self.free = []
+        self.count = 0
+        return durations
+
+    def _pop(self, key):
+        """Removes a session and returns its monotonic start time, or None if none was open."""
+        guild_id, user_id = key
+        users = self.guilds.get(guild_id)
+        if users is None:
+            return None
+        slot = users.pop(user_id, None)
+        if slot is None:
+            return None
+        if not users:
+            del self.guilds[guild_id]
+        start = self.starts[slot]
+        self.count -= 1
+        if self.count:
+            self.free.append(slot)
+        else:
+            # Nothing open: let go of the space a past peak left behind
+            self.starts = array('d')
+            self.free = []
+        return start
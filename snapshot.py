@@ -0,0 +1,234 @@
+# snapshot.py
+
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from array import array
+from db import get_change_counters
+
+# A snapshot holds the in-memory caches that are otherwise rebuilt from the database
+# at startup: the VIP expiry heap, the tag index and tag-role rules, and the open
+# presence sessions and totals behind the leaderboard. Each cache is one section,
+# stamped with the database change counter of the tables it was built from (see
+# create_change_counters in migrations.py). At startup a section is used only if its
+# counter still matches, so anything written to those tables after the snapshot, by
+# this process before a crash or by another shard process, means a normal rebuild.
+#
+# Layout, little-endian: a header, then per section a section header and a payload of
+# typed arrays, each a typecode, a byte length and the array's raw bytes.
+
+SNAPSHOT_VERSION = 1
+
+_MAGIC = b'GURAKSNP'
+_HEADER = struct.Struct('<8sIIdI')  # magic, format version, schema version, written at, section count
+_SECTION = struct.Struct('<16sqQI')  # name, change counter, payload length, CRC-32 of the payload
+_ARRAY_COUNT = struct.Struct('<I')
+_ARRAY = struct.Struct('<cQ')  # typecode, byte length
+
+
+class SnapshotError(Exception):
+    """Raised for a snapshot file that can't be read."""
+
+
+def string_arrays(strings):
+    """Packs strings into a pair of arrays: UTF-8 lengths and the concatenated bytes."""
+    encoded = [string.encode() for string in strings]
+    return [array('I', map(len, encoded)), array('B', b''.join(encoded))]
+
+
+def strings_from_arrays(lengths, data):
+    """Unpacks strings packed by string_arrays."""
+    data = data.tobytes()
+    strings = []
+    offset = 0
+    for length in lengths:
+        strings.append(data[offset:offset + length].decode())
+        offset += length
+    return strings
+
+
+def _pack_section(arrays):
+    parts = [_ARRAY_COUNT.pack(len(arrays))]
+    for values in arrays:
+        data = values.tobytes()
+        parts.append(_ARRAY.pack(values.typecode.encode(), len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def _unpack_section(view, offset, end):
+    (count,) = _ARRAY_COUNT.unpack_from(view, offset)
+    offset += _ARRAY_COUNT.size
+    arrays = []
+    for _ in range(count):
+        typecode, length = _ARRAY.unpack_from(view, offset)
+        offset += _ARRAY.size
+        if offset + length > end:
+            raise SnapshotError("array runs past the end of its section")
+        values = array(typecode.decode())
+        values.frombytes(view[offset:offset + length])
+        arrays.append(values)
+        offset += length
+    return arrays
+
+
+def write_snapshot(path, schema_version, sections, written_at=None):
+    """Writes sections, a mapping of name to (change counter, list of arrays), to `path`.
+
+    The file is written beside the old one and renamed over it, so a crash mid-write
+    leaves the previous snapshot in place. Each write has its own temporary file, since
+    a cancelled periodic write may still be finishing on its thread at shutdown; the
+    snapshot that is renamed last wins, and either one is checked at startup.
+    Returns the file size in bytes.
+    """
+    written_at = time.time() if written_at is None else written_at
+    fd, temp_path = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix='.tmp',
+                                     dir=os.path.dirname(path) or '.')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, SNAPSHOT_VERSION, schema_version, written_at, len(sections)))
+            for name, (counter, arrays) in sections.items():
+                payload = _pack_section(arrays)
+                f.write(_SECTION.pack(name.encode(), counter, len(payload), zlib.crc32(payload)))
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return size
+
+
+def read_snapshot(path, schema_version, counters):
+    """Reads the sections of the snapshot at `path` that are still current.
+
+    Returns ({name: list of arrays}, Unix time the snapshot was written). Sections whose
+    change counter differs from `counters` are skipped without being decoded; a missing
+    file, or one written by another format or schema version, gives no sections.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return {}, None
+    with f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            raise SnapshotError("file is too short")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            try:
+                return _read_sections(view, schema_version, counters)
+            except struct.error as e:
+                raise SnapshotError(str(e)) from e
+
+
+def _read_sections(view, schema_version, counters):
+    magic, version, snapshot_schema, written_at, count = _HEADER.unpack_from(view, 0)
+    if magic != _MAGIC:
+        raise SnapshotError("not a snapshot file")
+    if version != SNAPSHOT_VERSION or snapshot_schema != schema_version:
+        logging.info(f"Ignoring snapshot from format {version}, schema {snapshot_schema}.")
+        return {}, written_at
+    sections = {}
+    offset = _HEADER.size
+    for _ in range(count):
+        name, counter, length, crc = _SECTION.unpack_from(view, offset)
+        name = name.rstrip(b'\0').decode()
+        start = offset + _SECTION.size
+        offset = start + length
+        if offset > len(view):
+            raise SnapshotError(f"section {name} runs past the end of the file")
+        if counters.get(name) != counter:
+            logging.info(f"Snapshot section {name} is stale (counter {counter}, database {counters.get(name)}).")
+            continue
+        if zlib.crc32(view[start:offset]) != crc:
+            logging.warning(f"Snapshot section {name} is corrupt; rebuilding it from the database.")
+            continue
+        sections[name] = _unpack_section(view, start, offset)
+    return sections, written_at
+
+
+async def load_snapshot(path):
+    """Reads the current sections of the snapshot at `path`, as a mapping of name to list of arrays.
+
+    Any problem with the file is logged and treated as having no snapshot.
+    """
+    if not path:
+        return {}
+    start = time.perf_counter()
+    schema_version, counters = await get_change_counters()
+    try:
+        sections, written_at = await asyncio.to_thread(read_snapshot, path, schema_version, counters)
+    except (OSError, SnapshotError, ValueError) as e:
+        logging.warning(f"Could not read snapshot {path}: {e}")
+        return {}
+    if written_at is not None:
+        logging.info(f"Restoring {sorted(sections) or 'nothing'} from snapshot {path}, written "
+                     f"{time.time() - written_at:.0f}s ago, read in {(time.perf_counter() - start) * 1000:.1f} ms; "
+                     f"other caches are loaded from the database.")
+    return sections
+
+
+class SnapshotWriter:
+    """Writes a snapshot of the in-memory caches every `interval` seconds (if nonzero) and on request.
+
+    `sections` maps each section name to a function returning the cache as a list of
+    arrays, or None when the cache can't be captured consistently right now (say, a
+    write to its tables is in flight); that section is then left out. A section is
+    also left out if its tables changed while the snapshot was taken. `prepare`, if
+    given, is awaited before each snapshot to write out what a cache can't be
+    captured with, such as buffered presence and changed sessions.
+    """
+
+    def __init__(self, path, sections, interval=0, prepare=None):
+        self.path = path
+        self.sections = sections
+        self.interval = interval
+        self.prepare = prepare
+        self.task = None
+
+    def start(self):
+        if self.task is None and self.interval:
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.write()
+            except Exception:
+                logging.exception(f"Failed to write snapshot {self.path}.")
+
+    async def write(self):
+        """Captures every section that is consistent with the database and writes the file."""
+        start = time.perf_counter()
+        if self.prepare:
+            await self.prepare()
+        _, before = await get_change_counters()
+        # Caches are updated right after the database write they follow, in the same task
+        # or in a listener it dispatches (on_members_purged); yielding once lets those
+        # listeners run, so the caches reflect every write counted in `before`
+        await asyncio.sleep(0)
+        captured = {}
+        for name, capture in self.sections.items():
+            arrays = capture()
+            if arrays is not None:
+                captured[name] = arrays
+        schema_version, after = await get_change_counters()
+        sections = {name: (after[name], arrays) for name, arrays in captured.items()
+                    if name in after and before.get(name) == after[name]}
+        size = await asyncio.to_thread(write_snapshot, self.path, schema_version, sections)
+        skipped = sorted(set(self.sections) - set(sections))
+        logging.info(f"Wrote snapshot {self.path} ({size / 1024:.0f} KiB) in {(time.perf_counter() - start) * 1000:.1f} ms"
+                     + (f"; left out {skipped}, which changed meanwhile or had writes in flight." if skipped else "."))
+        return sections
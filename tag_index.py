@@ -0,0 +1,128 @@
+# tag_index.py
+
+from db import add_tag_to_user, remove_tag_from_user, add_tag_to_users, remove_tag_from_users, get_all_user_tags
+
+class TagIndex:
+    """In-memory bidirectional index of tag assignments, written through to the database.
+
+    Loaded once at startup; afterwards reads are served from memory and every change
+    goes to the database first, then to the index, so the two never disagree.
+    Every lookup is scoped to a guild.
+    """
+
+    def __init__(self):
+        self.user_tags = {}  # guild_id -> user_id -> set of tags
+        self.tag_users = {}  # guild_id -> tag -> set of user_ids
+
+    async def load(self):
+        """Builds the index from the user_tags table."""
+        self.user_tags = {}
+        self.tag_users = {}
+        for guild_id, user_id, tag in await get_all_user_tags():
+            self._add(guild_id, user_id, tag)
+
+    def load_holders(self, tag_users):
+        """Builds the index from a {guild_id: {tag: set of user_ids}} mapping, which it takes over.
+
+        Faster than load for a large index, since only the per-user side is built row by row.
+        """
+        self.tag_users = tag_users
+        self.user_tags = {}
+        for guild_id, holders_by_tag in tag_users.items():
+            user_tags = self.user_tags[guild_id] = {}
+            for tag, user_ids in holders_by_tag.items():
+                for user_id in user_ids:
+                    tags = user_tags.get(user_id)
+                    if tags is None:
+                        user_tags[user_id] = {tag}
+                    else:
+                        tags.add(tag)
+
+    def _add(self, guild_id, user_id, tag):
+        self.user_tags.setdefault(guild_id, {}).setdefault(user_id, set()).add(tag)
+        self.tag_users.setdefault(guild_id, {}).setdefault(tag, set()).add(user_id)
+
+    def _remove(self, guild_id, user_id, tag):
+        user_tags = self.user_tags.get(guild_id, {})
+        tags = user_tags.get(user_id)
+        if tags:
+            tags.discard(tag)
+            if not tags:
+                del user_tags[user_id]
+        tag_users = self.tag_users.get(guild_id, {})
+        users = tag_users.get(tag)
+        if users:
+            users.discard(user_id)
+            if not users:
+                del tag_users[tag]
+
+    async def add_tag(self, guild_id, user_id, tag):
+        """Assigns a tag to a user. Returns False if the user already had it."""
+        if self.has_tag(guild_id, user_id, tag):
+            return False
+        if not await add_tag_to_user(guild_id, user_id, tag):
+            return False
+        self._add(guild_id, user_id, tag)
+        return True
+
+    async def remove_tag(self, guild_id, user_id, tag):
+        """Removes a tag from a user. Returns False if the user didn't have it."""
+        if not self.has_tag(guild_id, user_id, tag):
+            return False
+        removed = await remove_tag_from_user(guild_id, user_id, tag)
+        self._remove(guild_id, user_id, tag)
+        return removed
+
+    async def add_tag_bulk(self, guild_id, user_ids, tag):
+        """Assigns a tag to many users in one transaction.
+
+        Returns (added, already_had) lists of user IDs.
+        """
+        holders = self.tag_users.get(guild_id, {}).get(tag, set())
+        added = [user_id for user_id in user_ids if user_id not in holders]
+        already_had = [user_id for user_id in user_ids if user_id in holders]
+        if added:
+            await add_tag_to_users(guild_id, added, tag)
+            for user_id in added:
+                self._add(guild_id, user_id, tag)
+        return added, already_had
+
+    async def remove_tag_bulk(self, guild_id, user_ids, tag):
+        """Removes a tag from many users in one transaction.
+
+        Returns (removed, did_not_have) lists of user IDs.
+        """
+        holders = self.tag_users.get(guild_id, {}).get(tag, set())
+        removed = [user_id for user_id in user_ids if user_id in holders]
+        did_not_have = [user_id for user_id in user_ids if user_id not in holders]
+        if removed:
+            await remove_tag_from_users(guild_id, removed, tag)
+            for user_id in removed:
+                self._remove(guild_id, user_id, tag)
+        return removed, did_not_have
+
+    def forget_users(self, keys):
+        """Drops the tags of (guild_id, user_id) pairs whose rows were already deleted from the database."""
+        for guild_id, user_id in keys:
+            for tag in list(self.user_tags.get(guild_id, {}).get(user_id, ())):
+                self._remove(guild_id, user_id, tag)
+
+    def has_tag(self, guild_id, user_id, tag):
+        """Checks whether a user has a tag."""
+        return tag in self.user_tags.get(guild_id, {}).get(user_id, ())
+
+    def get_user_tags(self, guild_id, user_id):
+        """Gets the sorted tags of a user."""
+        return sorted(self.user_tags.get(guild_id, {}).get(user_id, ()))
+
+    def get_tag_users(self, guild_id, tag):
+        """Gets the IDs of the users who have a tag."""
+        return set(self.tag_users.get(guild_id, {}).get(tag, ()))
+
+    def get_tag_count(self, guild_id, tag):
+        """Gets how many users have a tag."""
+        return len(self.tag_users.get(guild_id, {}).get(tag, ()))
+
+    def get_all_tags(self, guild_id):
+        """Gets every tag assigned to at least one user in a guild, sorted."""
+        return sorted(self.tag_users.get(guild_id, {}))
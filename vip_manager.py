@@ -1,16 +1,33 @@
+import asyncio
 import discord
+import heapq
+import logging
+import time
+from array import array
 from discord.ext import commands
-from db import get_subscription, remove_subscription
-from datetime import datetime, timedelta
+from action_journal import role_action, dm_action, shard_filter
+from db import add_subscription, get_subscription, remove_subscription, get_all_subscriptions, remove_subscriptions
+from member_cache import resolve_members, ensure_chunked
+from datetime import timedelta
 from dateutil.relativedelta import relativedelta  # For handling months
 
 class VIPManager:
     """Manages VIP roles and related operations."""
 
-    def __init__(self, bot, messaging):
+    def __init__(self, bot, journal):
         self.bot = bot
-        self.messaging = messaging
+        self.journal = journal  # ActionJournal that applies the role changes and DMs
         self.vip_role_name = 'VIP'
+        self.expiry_batch_size = 50
+        self.expiry_retry_delay = 60  # Seconds before expiring subscriptions in an unavailable guild again
+        # Min-heap of (expiry timestamp, (guild_id, user_id)). Entries superseded by a
+        # renewal or removal stay in the heap and are discarded lazily when they reach
+        # the top; _expiry_deadlines holds the one live deadline per subscription.
+        self._expiry_heap = []
+        self._expiry_deadlines = {}
+        self._expiring = {}  # The batch being expired: popped from the heap, not yet deleted in the database
+        self._expiry_wakeup = asyncio.Event()
+        self._expiry_task = None
 
     def parse_duration(self, duration_str):
         """Parse a duration string into a timedelta or relativedelta object."""
@@ -31,31 +48,297 @@ class VIPManager:
         else:
             raise ValueError("Invalid duration unit. Use 'm' for minutes, 'h' for hours, 'd' for days, or 'M' for months.")
 
-    async def manage_vip_role(self, member):
-        """Assigns or removes the VIP role based on subscription status."""
-        vip_role = discord.utils.get(member.guild.roles, name=self.vip_role_name)
+    async def get_vip_role(self, guild):
+        """Returns the guild's VIP role, creating it if it doesn't exist."""
+        vip_role = discord.utils.get(guild.roles, name=self.vip_role_name)
         if not vip_role:
-            # Create the VIP role if it doesn't exist
-            vip_role = await member.guild.create_role(name=self.vip_role_name, color=discord.Color.gold())
-
-        expiry_date_str = get_subscription(member.id)
-        if expiry_date_str:
-            expiry_date = datetime.fromisoformat(expiry_date_str)
-            if expiry_date > datetime.now():
-                if vip_role not in member.roles:
-                    await member.add_roles(vip_role)
-                    await self.messaging.send_private_message(member, "You have been granted the VIP role!")
+            vip_role = await guild.create_role(name=self.vip_role_name, color=discord.Color.gold())
+        return vip_role
+
+    def _grant_actions(self, guild_id, user_id, vip_role, expires_at, notify=True):
+        """Journal actions that give the VIP role for a subscription ending at `expires_at`, with a DM if `notify`."""
+        actions = [role_action(guild_id, user_id, vip_role.id, True)]
+        if notify:
+            actions.append(dm_action(guild_id, user_id, "You have been granted the VIP role!",
+                                     f'vip_granted:{int(expires_at)}'))
+        return actions
+
+    def _revoke_actions(self, guild_id, user_id, vip_role, expires_at=0, notify=True):
+        """Journal actions that take the VIP role away, with a DM if `notify`."""
+        actions = [role_action(guild_id, user_id, vip_role.id, False)]
+        if notify:
+            actions.append(dm_action(guild_id, user_id, "Your VIP subscription has expired.",
+                                     f'vip_expired:{int(expires_at)}'))
+        return actions
+
+    async def manage_vip_role(self, member):
+        """Journals giving or taking the VIP role based on subscription status."""
+        vip_role = await self.get_vip_role(member.guild)
+
+        expires_at = await get_subscription(member.guild.id, member.id)
+        if expires_at is not None:
+            if expires_at > time.time():
+                # Journaled even if the member has the role, to override a removal still pending
+                await self.journal.record(self._grant_actions(member.guild.id, member.id, vip_role, expires_at,
+                                                              notify=vip_role not in member.roles))
             else:
                 await self.handle_expired_vip(member)
         else:
             if vip_role in member.roles:
-                await member.remove_roles(vip_role)
-                await self.messaging.send_private_message(member, "Your VIP subscription has expired.")
+                await self.journal.record(self._revoke_actions(member.guild.id, member.id, vip_role))
+
+    async def sync_vip_role(self, member):
+        """Undoes a change to a member's VIP role that disagrees with their subscription, without a DM.
+
+        Used when the role is added or removed by hand; a change that agrees with the
+        subscription, such as one the journal just made, costs a single lookup.
+        """
+        vip_role = discord.utils.get(member.guild.roles, name=self.vip_role_name)
+        if not vip_role:
+            return
+        expires_at = await get_subscription(member.guild.id, member.id)
+        active = expires_at is not None and expires_at > time.time()
+        has_role = vip_role in member.roles
+        if active and not has_role:
+            logging.warning(f"VIP role removed from {member.name} ({member.id}) in {member.guild.name} while their "
+                            f"subscription is active; restoring it. Use !removevip to end a subscription.")
+            await self.journal.record(self._grant_actions(member.guild.id, member.id, vip_role, expires_at,
+                                                          notify=False))
+        elif not active and has_role:
+            logging.warning(f"VIP role given to {member.name} ({member.id}) in {member.guild.name} without an active "
+                            f"subscription; removing it. Use !addvip to grant VIP.")
+            await self.journal.record(self._revoke_actions(member.guild.id, member.id, vip_role, notify=False))
+
+    async def add_vip(self, member, expiry_date):
+        """Stores a VIP subscription, schedules its expiry and journals granting the role."""
+        vip_role = await self.get_vip_role(member.guild)
+        expires_at = expiry_date.timestamp()
+        await add_subscription(member.guild.id, member.id, expires_at,
+                               self._grant_actions(member.guild.id, member.id, vip_role, expires_at,
+                                                   notify=vip_role not in member.roles))
+        self._schedule_expiry((member.guild.id, member.id), expiry_date)
+        self.journal.wake()
+
+    async def remove_vip(self, member):
+        """Deletes a VIP subscription and journals taking the VIP role away."""
+        vip_role = discord.utils.get(member.guild.roles, name=self.vip_role_name)
+        actions = self._revoke_actions(member.guild.id, member.id, vip_role, notify=False) if vip_role else []
+        await remove_subscription(member.guild.id, member.id, actions)
+        self._unschedule_expiry((member.guild.id, member.id))
+        self.journal.wake()
 
     async def handle_expired_vip(self, member):
-        """Handles the expiration of a VIP subscription."""
+        """Handles the expiration of a VIP subscription.
+
+        The subscription is deleted in the same transaction that journals taking the role away.
+        """
         vip_role = discord.utils.get(member.guild.roles, name=self.vip_role_name)
-        if vip_role and vip_role in member.roles:
-            await member.remove_roles(vip_role)
-            await self.messaging.send_private_message(member, "Your VIP subscription has expired.")
-        remove_subscription(member.id)
+        expires_at = self._expiry_deadlines.get((member.guild.id, member.id), 0)
+        actions = (self._revoke_actions(member.guild.id, member.id, vip_role, expires_at,
+                                        notify=vip_role in member.roles) if vip_role else [])
+        await remove_subscription(member.guild.id, member.id, actions)
+        self._unschedule_expiry((member.guild.id, member.id))
+        self.journal.wake()
+
+    async def reconcile_vip_roles(self, guilds):
+        """Brings the VIP role of every member in line with the subscriptions table.
+
+        All subscriptions are loaded in one query and the VIP role is resolved once
+        per guild, so only members whose role actually has to change are journaled.
+        Guilds whose member lists aren't cached (lazy chunking) are chunked first.
+        Lapsed subscriptions are deleted in the same transaction. Returns a tuple of
+        (roles to add, roles to remove, seconds taken).
+        """
+        start = time.perf_counter()
+        subscriptions = await get_all_subscriptions()
+        now = time.time()
+        active_by_guild = {}  # guild_id -> set of user IDs with an active subscription
+        expired_by_guild = {}  # guild_id -> set of user IDs with an expired subscription
+        for (guild_id, user_id), expires_at in subscriptions.items():
+            by_guild = active_by_guild if expires_at > now else expired_by_guild
+            by_guild.setdefault(guild_id, set()).add(user_id)
+
+        added = removed = 0
+        actions = []
+        lapsed_keys = set()
+        for guild in guilds:
+            await ensure_chunked(guild)  # Every member has to be seen, not just the cached ones
+            active_ids = active_by_guild.get(guild.id, set())
+            expired_ids = expired_by_guild.get(guild.id, set())
+            vip_role = await self.get_vip_role(guild)
+            role_holder_ids = {member.id for member in vip_role.members}
+
+            for member in guild.members:
+                if member.id in active_ids:
+                    if member.id not in role_holder_ids:
+                        actions += self._grant_actions(guild.id, member.id, vip_role,
+                                                       subscriptions[(guild.id, member.id)])
+                        added += 1
+                    continue
+
+                if member.id in expired_ids:
+                    lapsed_keys.add((guild.id, member.id))
+                if member.id in role_holder_ids:
+                    actions += self._revoke_actions(guild.id, member.id, vip_role,
+                                                    subscriptions.get((guild.id, member.id), 0))
+                    removed += 1
+
+        if lapsed_keys or actions:
+            await remove_subscriptions(lapsed_keys, actions)
+            for key in lapsed_keys:
+                self._unschedule_expiry(key)
+            self.journal.wake()
+
+        elapsed = time.perf_counter() - start
+        logging.info(f"VIP reconciliation finished in {elapsed:.2f}s: {added} roles to add, {removed} roles to remove, "
+                     f"{len(lapsed_keys)} expired subscriptions cleared.")
+        return added, removed, elapsed
+
+    # -------------------------------
+    # Expiry Scheduler
+    # -------------------------------
+
+    async def start_expiry_scheduler(self, snapshot=None):
+        """Loads every subscription into the expiry heap and starts the scheduler task.
+
+        `snapshot` is the arrays written by snapshot_state, which restore the heap as it
+        was instead of loading it from the database.
+        """
+        if snapshot:
+            heap_deadlines, heap_guild_ids, heap_user_ids, guild_ids, user_ids, deadlines = snapshot
+            self._expiry_heap = list(zip(heap_deadlines, zip(heap_guild_ids, heap_user_ids)))
+            self._expiry_deadlines = dict(zip(zip(guild_ids, user_ids), deadlines))
+        else:
+            self._expiry_deadlines = await get_all_subscriptions()
+            self._expiry_heap = [(deadline, key) for key, deadline in self._expiry_deadlines.items()]
+            heapq.heapify(self._expiry_heap)
+        self._expiry_task = asyncio.create_task(self._run_expiry_scheduler())
+
+    def stop_expiry_scheduler(self):
+        """Cancels the scheduler task."""
+        if self._expiry_task:
+            self._expiry_task.cancel()
+            self._expiry_task = None
+
+    def snapshot_state(self):
+        """The expiry heap, in heap order, and the live deadlines as arrays for a snapshot.
+
+        Returns None while a batch is being expired, since its subscriptions are out of
+        the heap but may still be in the database.
+        """
+        if self._expiring:
+            return None
+        heap_deadlines = array('d')
+        heap_guild_ids = array('q')
+        heap_user_ids = array('q')
+        for deadline, (guild_id, user_id) in self._expiry_heap:
+            heap_deadlines.append(deadline)
+            heap_guild_ids.append(guild_id)
+            heap_user_ids.append(user_id)
+        keys = self._expiry_deadlines.keys()
+        return [heap_deadlines, heap_guild_ids, heap_user_ids, array('q', [guild_id for guild_id, _ in keys]),
+                array('q', [user_id for _, user_id in keys]), array('d', self._expiry_deadlines.values())]
+
+    def _schedule_expiry(self, key, expiry_date):
+        """Sets the expiry deadline for a (guild_id, user_id) subscription, replacing any earlier one, in O(log n)."""
+        deadline = expiry_date.timestamp()
+        self._expiry_deadlines[key] = deadline
+        heapq.heappush(self._expiry_heap, (deadline, key))
+        if self._expiry_heap[0] == (deadline, key):
+            # The new deadline is now the earliest one, so the scheduler must re-arm its timer.
+            self._expiry_wakeup.set()
+
+    def _unschedule_expiry(self, key):
+        """Drops the expiry deadline for a (guild_id, user_id) subscription; its heap entry is discarded lazily."""
+        self._expiry_deadlines.pop(key, None)
+        # Rebuild once stale entries make up most of the heap so it can't grow without bound.
+        if len(self._expiry_heap) > 2 * len(self._expiry_deadlines) + 64:
+            self._expiry_heap = [(deadline, key) for key, deadline in self._expiry_deadlines.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _pop_due_expiries(self, now):
+        """Pops up to expiry_batch_size subscriptions whose live deadline has passed, as a mapping of key to deadline."""
+        due = {}
+        while self._expiry_heap and self._expiry_heap[0][0] <= now and len(due) < self.expiry_batch_size:
+            deadline, key = heapq.heappop(self._expiry_heap)
+            if self._expiry_deadlines.get(key) == deadline:
+                del self._expiry_deadlines[key]
+                due[key] = deadline
+        return due
+
+    async def _run_expiry_scheduler(self):
+        """Sleeps until the earliest deadline, then expires due subscriptions in batches."""
+        await self.bot.wait_until_ready()
+        while True:
+            now = time.time()
+            if not self._expiry_heap or self._expiry_heap[0][0] > now:
+                timeout = self._expiry_heap[0][0] - now if self._expiry_heap else None
+                self._expiry_wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._expiry_wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self._pop_due_expiries(now)
+            if due:
+                # Left set if the scheduler is cancelled mid-batch, which keeps the heap out of shutdown snapshots
+                self._expiring = due
+                try:
+                    await self._expire_batch(list(due), due)
+                except Exception:
+                    logging.exception(f"Failed to expire a batch of {len(due)} VIP subscriptions; "
+                                      f"retrying in {self.expiry_retry_delay}s.")
+                    self._retry_expiries(due, time.time() + self.expiry_retry_delay)
+                self._expiring = {}
+
+    def _retry_expiries(self, keys, retry_at):
+        """Puts popped (guild_id, user_id) subscriptions back on the heap, due at `retry_at`.
+
+        Ones renewed while they were out of the heap already have a new deadline and are skipped.
+        """
+        for key in keys:
+            if key not in self._expiry_deadlines:
+                self._expiry_deadlines[key] = retry_at
+                heapq.heappush(self._expiry_heap, (retry_at, key))
+
+    async def _expire_batch(self, keys, deadlines):
+        """Deletes a batch of expired (guild_id, user_id) subscriptions and journals taking their VIP roles away,
+        all in one transaction.
+
+        Subscriptions in guilds this process doesn't serve (another shard) are left alone.
+        Ones in a guild on this process's shards that is unavailable, e.g. during an
+        outage, go back on the heap and are tried again after expiry_retry_delay seconds.
+        Members missing from the member cache are fetched, so those who still hold the
+        role get their DM; ones no longer in the guild are journaled without one.
+        Subscriptions renewed while the batch runs are left alone.
+        """
+        by_guild = {}  # guild_id -> user IDs
+        for guild_id, user_id in keys:
+            by_guild.setdefault(guild_id, []).append(user_id)
+        shard_count, shard_ids = shard_filter(self.bot)
+        retry_at = time.time() + self.expiry_retry_delay
+        expired = []
+        actions = []
+        for guild_id, user_ids in by_guild.items():
+            guild = self.bot.get_guild(guild_id)
+            if not guild:
+                if not shard_count or (guild_id >> 22) % shard_count in shard_ids:
+                    self._retry_expiries([(guild_id, user_id) for user_id in user_ids], retry_at)
+                continue
+            vip_role = discord.utils.get(guild.roles, name=self.vip_role_name)
+            members = await resolve_members(guild, user_ids) if vip_role else {}
+            for user_id in user_ids:
+                if (guild_id, user_id) in self._expiry_deadlines:
+                    continue  # Renewed while the members were being fetched
+                expired.append((guild_id, user_id))
+                if vip_role:
+                    member = members.get(user_id)
+                    actions += self._revoke_actions(guild_id, user_id, vip_role, deadlines[(guild_id, user_id)],
+                                                    notify=member is not None and vip_role in member.roles)
+        removed = set()
+        if expired:
+            # The database check catches a renewal written while this batch waits for the database
+            removed = await remove_subscriptions(expired, actions, expired_by=time.time())
+            self.journal.wake()
+        logging.info(f"Expired {len(removed)} VIP subscriptions from a batch of {len(keys)}.")